@@ -1,79 +1,141 @@
 import time
 import yaml
 
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
-
 from src import game, config
-from src.neopets import neo_driver
+from src.neopets import neo_driver, http_driver, browser_pool
 
 # The code in this file initializes the Selenium webdriver and 
 # then starts the NeoQuest II auto-player. The user must login 
 # to Neopets.com using their own credentials in order for the 
 # game to run.
 
-def get_firefox():
+def get_firefox(game_url = neo_driver.game_url, profile_dir = None, cookie_path = None):
 
     # This function initializes a Firefox browser using Selenium,
     # attempts to install the uBlock Origin extension (not included),
-    # and then navigates to the NeoQuest II page.
+    # and then navigates to the NeoQuest II page. If a persistent profile
+    # is given, the extension is only installed the first time. If saved
+    # cookies restore the session, no login is needed; otherwise the user
+    # is asked to login, and the new cookies are saved for the next run.
 
-    options = Options()
-    options.page_load_strategy = "none"
-    driver = webdriver.Firefox(options = options)
-    try:
-        driver.install_addon("ublock_origin-1.50.0.xpi")
-    except:
-        pass
-    driver.get("https://www.neopets.com/games/nq2/nq2.phtml")
+    driver = browser_pool.make_firefox(
+        game_url, profile_dir = profile_dir, headless = False, addon_path = "ublock_origin-1.50.0.xpi"
+    )
+    if not browser_pool.restore_session(driver, cookie_path, game_url):
+        input("Login (press enter to continue)")
+        if cookie_path is not None:
+            browser_pool.save_session(driver, cookie_path)
+    return driver
+
+def get_driver(selenium_driver, flag, backend, game_url = neo_driver.game_url):
+
+    # This function wraps the logged-in browser in the requested driver
+    # backend. For the "http" backend, the browser's cookies are copied into
+    # an HttpDriver and the browser is closed, since it is no longer needed.
+
+    if backend == "http":
+        (cookies, user_agent) = http_driver.get_browser_cookies(selenium_driver)
+        selenium_driver.quit()
+        driver = http_driver.HttpDriver(flag, cookies, game_url = game_url, user_agent = user_agent)
+    else:
+        driver = neo_driver.Driver(selenium_driver, flag, game_url = game_url)
     return driver
 
-def run_automatic(selenium_driver, schedule, logging):
+def run_automatic(driver, flag, schedule, logging):
 
     # This function runs the auto-players main game loop in
     # automatic mode, which allows the user to halt operation
-    # by typing "kill".
+    # by typing "kill", or to see the logging backlog by typing
+    # "stats".
 
-    flag = [True]
     callback = None
-    driver = neo_driver.Driver(selenium_driver, flag)
     game_thread = game.GameThread(flag, driver, schedule, logging = logging, callback = callback)
     game_thread.start()
     while game_thread.is_alive():
         action = input("Control: ")
         if action == "kill":
             flag[0] = False
+            game_thread.join() # Waits for the queued logs to be written
+        elif action == "stats":
+            stats = game_thread.get_log_stats()
+            if stats is not None:
+                print(f"Log queue: {stats['queued']} batches, {stats['written']} written, {stats['dropped']} dropped, lag {stats['lag']:.2f}s")
         time.sleep(1)
+    return game_thread
 
-def run_manual(selenium_driver, schedule, logging):
+def run_manual(driver, flag, schedule, logging):
 
     # This function runs the auto-player in manual mode. At this
     # level of code, the only difference is that the game loop does
     # not listen for a kill command from the user.
 
-    flag = [True]
     callback = None
-    driver = neo_driver.Driver(selenium_driver, flag)
     game_thread = game.GameThread(flag, driver, schedule, logging = logging, callback = callback)
     game_thread.start()
     while game_thread.is_alive():
         time.sleep(1)
+    return game_thread
+
+def run_pooled(pool, flag, schedule, config_dict, capture = None, restarts = 3):
+
+    # This function runs the auto-player on browsers taken from a BrowserPool
+    # (see 'browser_pool.py'), which start headless and already logged in. If
+    # the game loop gives up because its browser stopped responding, that
+    # browser is recycled and the current segment is continued on a spare one,
+    # up to 'restarts' times, instead of restarting the whole process.
+
+    run = (run_manual if config_dict["manual"] else run_automatic)
+    game_url = config_dict.get("url", neo_driver.game_url)
+    for attempt in range(restarts + 1):
+        selenium_driver = pool.acquire()
+        driver = neo_driver.Driver(selenium_driver, flag, game_url = game_url)
+        driver.capture = capture
+        game_thread = run(driver, flag, schedule, config_dict["log"])
+        if game_thread.error is None or not flag[0]:
+            pool.release(selenium_driver)
+            break
+        pool.recycle(selenium_driver)
+        schedule.retry_handler()
+        print(f"Restarting on a new browser ({attempt + 1}/{restarts})")
 
 if __name__ == "__main__":
 
     # When this file is executed as a top-level script, it initializes
     # the auto-player and then waits for the user to singal that they
     # have signed in before starting the game loop with the configuration
-    # specified in `config.yml`.
+    # specified in `config.yml`. If 'browsers' is set, the game is instead
+    # run on a pool of headless browsers restored from the saved cookies.
 
     with open("config.yml", "r", encoding = "utf-8") as target:
         config_dict = yaml.safe_load(target)
-    driver = get_firefox()
-    input("Login (press enter to continue)")
+    game_url = config_dict.get("url", neo_driver.game_url)
+    flag = [True]
+    capture_writer = None
+    if config_dict.get("capture") is not None:
+        from src.neopets import capture # Only imported when used, since it needs 'zstandard'
+        capture_writer = capture.CaptureWriter(config_dict["capture"])
     schedule = config.Schedule(config_dict)
     logging = config_dict["log"]
-    if config_dict["manual"]:
-        run_manual(driver, schedule, logging)
-    else:
-        run_automatic(driver, schedule, logging)
-    driver.quit()
\ No newline at end of file
+    try:
+        if config_dict.get("browsers"):
+            pool = browser_pool.BrowserPool(
+                config_dict["browsers"], config_dict.get("profile"), config_dict.get("cookies"),
+                game_url = game_url, addon_path = "ublock_origin-1.50.0.xpi"
+            )
+            try:
+                pool.start()
+                run_pooled(pool, flag, schedule, config_dict, capture = capture_writer)
+            finally:
+                pool.close()
+        else:
+            selenium_driver = get_firefox(game_url, config_dict.get("profile"), config_dict.get("cookies"))
+            driver = get_driver(selenium_driver, flag, config_dict.get("backend", "selenium"), game_url)
+            driver.capture = capture_writer
+            if config_dict["manual"]:
+                run_manual(driver, flag, schedule, logging)
+            else:
+                run_automatic(driver, flag, schedule, logging)
+            driver.quit()
+    finally: # Pages captured before a crash or Ctrl-C are kept
+        if capture_writer is not None:
+            capture_writer.close()
\ No newline at end of file
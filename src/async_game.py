@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+
+import aiohttp
+import yaml
+
+from . import config, fight, logs, migrations
+from .game import GameState, update_inventory_after_fight
+from .neopets import async_driver, http_driver, neo_driver
+from .neopets.neo_driver import DriverFailure
+
+# This module contains an asyncio version of the game loop in 'game.py', for use
+# with the AsyncDriver. Each session is a coroutine, so many of them can be run
+# in one process, each with its own driver and Schedule but sharing one log writer
+# and one connection pool. The handlers from 'src/handling' are used unchanged:
+# since they read the GameState synchronously, it is created without a driver and
+# its sections are refreshed explicitly with awaited driver calls, as the original
+# game loop did. The calls that can block on the database (allocating a game ID
+# and handing a batch to the LogWriter, which waits while its queue is full) are
+# run in a thread, so that they never stall the other sessions. Run it with
+# 'python -m src.async_game'.
+
+async def run_session(flag, driver, schedule, conn, writer, callback = None):
+
+    # This function plays one session until its Schedule is exhausted or the
+    # flag is cleared, following the same steps as 'GameThread.run'. The 'conn'
+    # is used only to allocate game IDs, while every log goes through 'writer'.
+
+    game_id = await asyncio.to_thread(logs.get_next_game_id, conn)
+    game_state = GameState(game_id, move_id = 0)
+    await state_update(driver, game_state, ["characters", "inventory", "skills", "explore"])
+    batch = logs.LogBatch(writer)
+    logs.log_all(game_state, batch)
+    await asyncio.to_thread(batch.flush)
+    (handler, state) = schedule.get_next_handler()
+    while flag[0]:
+        if state == "released":
+            break
+        if callback:
+            callback(game_state)
+        game_state = await game_step(driver, game_state, handler, writer)
+        if not game_state.live:
+            if state == "reset":
+                await driver.reset_game()
+                game_id = await asyncio.to_thread(logs.get_next_game_id, conn)
+                game_state = GameState(game_id, move_id = 0)
+                await state_update(driver, game_state, ["characters", "inventory", "skills", "explore"])
+            (handler, state) = schedule.get_next_handler()
+            game_state.live = True
+
+async def game_step(driver, game_state, handler, writer):
+
+    # This function runs a single step, as in 'game.game_step'. The explore
+    # section comes from the move itself and the party status from the same
+    # page. After a fight the skills are reloaded, while the inventory is
+    # updated from the fight's results unless it is due to be reloaded. The
+    # step's logs are collected in one batch and handed to 'writer' at the end.
+
+    batch = logs.LogBatch(writer)
+    move_dict = await make_move(driver, handler, game_state)
+    if move_dict is None:
+        game_state.live = False
+        return game_state
+    game_state.move_id += 1
+    fought = move_dict["fighting"]
+    reload_inventory = False
+    if fought:
+        (end_message, potions_used) = await fight_loop(driver, handler, game_state.game_id, game_state.move_id, batch)
+        await state_update(driver, game_state, ["explore"])
+        reload_inventory = update_inventory_after_fight(game_state, end_message, potions_used)
+        await driver.prefetch_state(inventory = reload_inventory) # Loads the needed pages together
+    else:
+        game_state.update_explore(move_dict["explore"])
+    await state_update(driver, game_state, ["characters"])
+    await process_inventory(driver, handler, game_state, update = reload_inventory)
+    await process_skills(driver, handler, game_state, update = fought)
+    logs.log_all(game_state, batch)
+    await driver._log_local_map(batch)
+    await asyncio.to_thread(batch.flush)
+    return game_state
+
+async def make_move(driver, handler, game_state):
+
+    # This function executes moves or actions from the move handler
+    # until the position changes or a fight begins.
+
+    old_coords = game_state.explore.coords
+    while True:
+        direction = handler.get_move_action(game_state)
+        if direction == "release":
+            return None
+        if direction not in ["n", "s", "e", "w", "nw", "ne", "sw", "se"]:
+            move_dict = await driver.action(direction)
+        else:
+            move_dict = await driver.move(direction)
+        if move_dict["fighting"] or move_dict["explore"]["coords"] != old_coords:
+            break
+    return move_dict
+
+async def fight_loop(driver, handler, game_id, move_id, batch):
+
+    # This function handles the combat loop, as in 'game.fight_loop', adding
+    # its logs to the step's batch.
+
+    turn_id = 0
+    potions_used = []
+    await driver.begin_fight()
+    fight_state = fight.FightState(await driver.get_fight_dict())
+    logs.log_fight(fight_state, game_id, move_id, turn_id, batch)
+    while not fight_state.ended:
+        if fight_state.is_player_turn():
+            action = await make_fight_move(driver, handler, fight_state)
+            if "potion" in action:
+                potions_used.append(action.split("_")[-1])
+        else:
+            await driver.take_enemy_turn()
+        fight_state = fight.FightState(await driver.get_fight_dict())
+        turn_id += 1
+        logs.log_fight(fight_state, game_id, move_id, turn_id, batch)
+    await driver.end_fight()
+    end_message = driver.get_fight_end_message()
+    logs.log_fight_end(game_id, move_id, end_message, batch)
+    await driver.return_from_fight()
+    return (end_message, potions_used)
+
+async def make_fight_move(driver, handler, fight_state):
+
+    # This function executes the next fight action from the handler
+    # and returns it.
+
+    action = handler.get_fight_action(fight_state)
+    while "trg" in action: # Targetting does not count as a full action
+        driver.choose_target(action[-1])
+        action = handler.get_fight_action(fight_state)
+    if "wt" in action:
+        await driver.wait(action[-1])
+    elif action == "attk":
+        await driver.melee_attack()
+    elif action == "flee":
+        await driver.flee()
+    elif "ability" in action:
+        await driver.use_ability(action.split("_")[-1])
+    elif "potion" in action:
+        await driver.use_fight_potion(action.split("_")[-1])
+    return action
+
+async def process_inventory(driver, handler, game_state, update = True):
+
+    # This function executes any inventory actions from the handler.
+
+    if update:
+        await state_update(driver, game_state, ["inventory"])
+    action_type = ""
+    while action_type != "nothing":
+        (action_type, action) = handler.get_inventory_action(game_state)
+        if action_type == "heal":
+            (potion_name, char_id) = action.split("_")
+            await driver.drink_inventory_potion(potion_name, char_id)
+            if game_state.inventory.remove_item(potion_name):
+                await state_update(driver, game_state, ["characters"])
+            else:
+                await state_update(driver, game_state, ["inventory", "characters"])
+
+async def process_skills(driver, handler, game_state, update = True):
+
+    # This function executes any skill point actions from the handler.
+
+    if update:
+        await state_update(driver, game_state, ["skills"])
+    action = handler.get_skills_action(game_state)
+    while action != "nothing":
+        (char_name, skill, points) = action.split("_")
+        await driver.upgrade_skill(char_name, skill, points)
+        await state_update(driver, game_state, ["skills"])
+        action = handler.get_skills_action(game_state)
+
+async def state_update(driver, game_state, info_sequence):
+
+    # This function updates the passed GameState instance with
+    # the types of data requested in the 'info_sequence' list.
+
+    for info_type in info_sequence:
+        if info_type == "characters":
+            game_state.update_characters(await driver.get_characters_dict())
+        if info_type == "inventory":
+            game_state.update_inventory(await driver.get_inventory_list())
+        if info_type == "skills":
+            game_state.update_skills(await driver.get_skills_dict())
+        if info_type == "explore":
+            game_state.update_explore(await driver.get_explore_dict())
+
+async def run_sessions(sessions, db_path = "test.db", pool_size = 100):
+
+    # This function runs every session concurrently and waits for all of them.
+    # Each session is a dictionary with an optional 'cookies' file, 'user_agent'
+    # and 'url', and a 'config' dictionary in the format of 'config.yml' for its
+    # Schedule. All drivers share one connection pool of at most 'pool_size'
+    # connections, one log writer and one cache of logged map tiles. Nothing
+    # is run if there are no sessions. The connection used for game IDs is
+    # shared by the sessions' threads (see 'run_session').
+
+    if not sessions:
+        print("No sessions to run (add them under 'accounts' in config.yml).")
+        return
+    conn = logs.connect(db_path, check_same_thread = False)
+    migrations.migrate(conn)
+    writer = logs.LogWriter(db_path)
+    connector = aiohttp.TCPConnector(limit = pool_size)
+    flag = [True]
+    drivers = []
+    for session in sessions:
+        if session.get("cookies"):
+            (cookies, user_agent) = http_driver.load_cookies(session["cookies"])
+        else:
+            (cookies, user_agent) = ([], None)
+        driver = async_driver.AsyncDriver(
+            flag, cookies, game_url = session.get("url", neo_driver.game_url),
+            user_agent = user_agent, connector = connector
+        )
+        drivers.append(driver)
+    drivers[0].load_seen_tiles(conn)
+    for driver in drivers[1:]:
+        driver.seen_tiles = drivers[0].seen_tiles
+    try:
+        results = await asyncio.gather(*[
+            run_session(flag, driver, config.Schedule(session["config"]), conn, writer)
+            for (driver, session) in zip(drivers, sessions)
+        ], return_exceptions = True)
+        for (i, result) in enumerate(results):
+            if isinstance(result, DriverFailure): # One failing session does not stop the others
+                print(f"Session {i} stopped: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+    finally:
+        flag[0] = False
+        for driver in drivers:
+            await driver.quit()
+        await connector.close()
+        writer.close()
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run the config.yml accounts as concurrent async sessions")
+    parser.add_argument("--config", default = "config.yml")
+    parser.add_argument("--db", default = "data.db")
+    args = parser.parse_args()
+    with open(args.config, "r", encoding = "utf-8") as target:
+        config_dict = yaml.safe_load(target)
+    sessions = [dict(account, config = config_dict) for account in config_dict["accounts"]]
+    asyncio.run(run_sessions(sessions, db_path = args.db))
@@ -49,6 +49,15 @@ class Schedule():
             self.handler_index += 1
         return (handler, state)
 
+    def retry_handler(self):
+
+        # This method makes the next call to 'get_next_handler' return the
+        # last handler again, such as when the game loop has been restarted
+        # on a new browser partway through a segment.
+
+        if self.handler_index > 0:
+            self.handler_index -= 1
+
     def _create_handler(self, config):
 
         # This internal method retrieves the four sub-handlers by handing
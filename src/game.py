@@ -1,12 +1,19 @@
-import sqlite3
 import threading
 
-from . import fight, inventory, characters, explore, skills, logs
+from . import fight, inventory, characters, explore, skills, logs, migrations
+from .neopets.neo_driver import DriverFailure
 
 # This module contains the logic needed to run iterations of NeoQuest's game
 # loop. A GameThread instance is created and run in 'main.py', which then executes
 # calls to other helper functions that process the game step.
 
+section_getters = { # Driver methods and state classes used to load each GameState section
+    "explore": ("get_explore_dict", explore.ExploreState),
+    "characters": ("get_characters_dict", characters.CharactersState),
+    "inventory": ("get_inventory_list", inventory.InventoryState),
+    "skills": ("get_skills_dict", skills.SkillsState)
+}
+
 class GameState():
 
     # This class holds all relevant game information, and is updated after each
@@ -15,37 +22,93 @@ class GameState():
     # The '*_dict' arguments in '__init__' and the four update methods all
     # expect specific data structures returned by the auto-player driver after
     # calling its 'get_*_dict' or 'get_*_list' methods. 
-
-    def __init__(self, game_id, move_id, explore_dict = None, characters_dict = None, inventory_list = None, skills_dict = None):
+    #
+    # If a driver is passed, the sections are loaded on demand: reading one that
+    # has not been loaded, or that has been marked out-of-date with 'invalidate',
+    # makes the driver navigate to the page that holds it. Sections that are never
+    # read never cost a page load. Without a driver, the sections only change
+    # through the update methods.
+
+    def __init__(self, game_id, move_id, explore_dict = None, characters_dict = None, inventory_list = None, skills_dict = None, driver = None):
         self.game_id = game_id
         self.move_id = move_id
+        self.driver = driver
+        self.sections = {}
+        self.stale = set()
         if explore_dict is not None:
             self.update_explore(explore_dict)
-        else:
-            self.explore = None
         if characters_dict is not None:
             self.update_characters(characters_dict)
-        else:
-            self.characters = None
         if inventory_list is not None:
             self.update_inventory(inventory_list)
-        else:
-            self.inventory = None
         if skills_dict is not None:
             self.update_skills(skills_dict)
         self.live = True
 
+    @property
+    def explore(self):
+        return self._get_section("explore")
+
+    @property
+    def characters(self):
+        return self._get_section("characters")
+
+    @property
+    def inventory(self):
+        return self._get_section("inventory")
+
+    @property
+    def skills(self):
+        return self._get_section("skills")
+
     def update_explore(self, explore_dict):
-        self.explore = explore.ExploreState(explore_dict)
+        self._set_section("explore", explore_dict)
 
     def update_characters(self, characters_dict):
-        self.characters = characters.CharactersState(characters_dict)
+        self._set_section("characters", characters_dict)
         
     def update_inventory(self, inventory_list):
-        self.inventory = inventory.InventoryState(inventory_list)
+        self._set_section("inventory", inventory_list)
 
     def update_skills(self, skills_dict):
-        self.skills = skills.SkillsState(skills_dict)
+        self._set_section("skills", skills_dict)
+
+    def invalidate(self, *section_names):
+
+        # This method marks the passed sections as out-of-date, so that
+        # they are reloaded from the driver the next time they are read.
+
+        self.stale.update(section_names)
+
+    def is_loaded(self, section_name):
+
+        # This method returns whether the passed section holds
+        # data that is up-to-date.
+
+        loaded = (section_name in self.sections and section_name not in self.stale)
+        return loaded
+
+    def _get_section(self, section_name):
+
+        # This internal method returns the state object for the passed section,
+        # loading it through the driver first if it is missing or out-of-date.
+
+        if self.driver is not None and not self.is_loaded(section_name):
+            (method_name, _) = section_getters[section_name]
+            data = getattr(self.driver, method_name)()
+            if data is not None: # The driver returns nothing during combat
+                self._set_section(section_name, data)
+        section = self.sections.get(section_name)
+        return section
+
+    def _set_section(self, section_name, data):
+
+        # This internal method builds the state object for the passed
+        # section from the driver data and marks it as up-to-date.
+
+        (_, state_class) = section_getters[section_name]
+        self.sections[section_name] = state_class(data)
+        self.stale.discard(section_name)
 
 class GameThread(threading.Thread):
 
@@ -54,12 +117,13 @@ class GameThread(threading.Thread):
     # 'main.py'. Unless manually stopped, the thread will run until 
     # the Schedule instance is exhausted. 
 
-    def __init__(self, flag, driver, schedule, logging, callback = None):
+    def __init__(self, flag, driver, schedule, logging, callback = None, db_path = None):
 
         # An instance is initialized with a control flag to allow for manual
         # termination, a driver instance (only accepts a `Driver` from 'neo_driver.py' 
         # currently), a Schedule instance from config.py', a boolean that control whether
-        # data should be logged, and an optional callback function.
+        # data should be logged, and an optional callback function. If 'db_path' is
+        # passed, it replaces the database chosen by 'logging'.
 
         super().__init__()
         self.schedule = schedule
@@ -67,40 +131,64 @@ class GameThread(threading.Thread):
         self.driver = driver
         self.callback = callback
         self.log = logging
+        self.db_path = db_path
+        self.writer = None
+        self.error = None # Set if the driver gave up on the game
+
+    def get_log_stats(self):
+
+        # This method returns the queue depth and write lag of the
+        # log writer (see 'logs.LogWriter.get_stats').
+
+        stats = (self.writer.get_stats() if self.writer is not None else None)
+        return stats
 
     def run(self):
 
         # When run, the GameThread instance will create a connection to the SQLite
-        # database, create and new GameState instance and update it using the current
-        # game state (the game does not have to be restarted), log the initial state,
-        # retrieve the first handler, and then start the game loop. Each loop iteration
-        # is processed by the 'game_step' function, with the GameThread instance only
-        # checking to see if a new handler needs to be assigned or if the game needs to
-        # be reset. Once every handler has been assigned and released, the game loop
-        # terminates.
-
-        conn = (sqlite3.connect("data.db") if self.log else sqlite3.connect("test.db"))
-        game_id = logs.get_next_game_id(conn)
-        game_state = GameState(game_id, move_id = 0)
-        state_update(self.driver, game_state, ["characters", "inventory", "skills", "explore"])
-        if game_state.move_id == 0:
-            logs.log_all(game_state, conn)
-        (handler, state) = self.schedule.get_next_handler()
-        while self.flag[0]: # Can be manually terminated by the input loop in 'main.py'
-            if state == "released":
-                break
-            if self.callback:
-                self.callback(game_state)
-            game_state = game_step(self.driver, game_state, handler, conn)
-            if not game_state.live:
-                if state == "reset":
-                    self.driver.reset_game()
-                    game_id = logs.get_next_game_id(conn)
-                    game_state = GameState(game_id, move_id = 0)
-                    state_update(self.driver, game_state, ["characters", "inventory", "skills", "explore"])
-                (handler, state) = self.schedule.get_next_handler()
-                game_state.live = True
-        conn.close()
+        # database (bringing its schema up-to-date) along with a background
+        # LogWriter that performs all writes, create a new GameState instance and
+        # update it using the current game state (the game does not have to be
+        # restarted), log the initial state, retrieve the first handler, and then
+        # start the game loop. Each loop iteration is processed by the 'game_step'
+        # function, with the GameThread instance only checking to see if a new
+        # handler needs to be assigned or if the game needs to be reset. Once
+        # every handler has been assigned and released, the game loop terminates.
+
+        db_path = (self.db_path or ("data.db" if self.log else "test.db"))
+        conn = logs.connect(db_path)
+        migrations.migrate(conn)
+        self.driver.load_seen_tiles(conn)
+        self.writer = logs.LogWriter(db_path)
+        try:
+            game_id = logs.get_next_game_id(conn)
+            game_state = GameState(game_id, move_id = 0, driver = self.driver)
+            state_update(self.driver, game_state, ["characters", "inventory", "skills", "explore"])
+            if game_state.move_id == 0:
+                batch = logs.LogBatch(self.writer)
+                logs.log_all(game_state, batch)
+                batch.flush()
+            (handler, state) = self.schedule.get_next_handler()
+            while self.flag[0]: # Can be manually terminated by the input loop in 'main.py'
+                if state == "released":
+                    break
+                if self.callback:
+                    self.callback(game_state)
+                game_state = game_step(self.driver, game_state, handler, self.writer)
+                if not game_state.live:
+                    if state == "reset":
+                        self.driver.reset_game()
+                        game_id = logs.get_next_game_id(conn)
+                        game_state = GameState(game_id, move_id = 0, driver = self.driver)
+                        state_update(self.driver, game_state, ["characters", "inventory", "skills", "explore"])
+                    (handler, state) = self.schedule.get_next_handler()
+                    game_state.live = True
+        except DriverFailure as error: # The site stopped responding, so the run is stopped
+            print(f"Stopping: {error}")
+            self.error = error
+        finally: # Queued logs are written even if the loop is killed or fails
+            self.writer.close()
+            conn.close()
         print("Released")
 
 def game_step(driver, game_state, handler, conn):
@@ -109,27 +197,37 @@ def game_step(driver, game_state, handler, conn):
     # specified handler. First, a move is made by the move handler,
     # which may trigger a fight. If so, control is passed to `fight_loop`
     # until the fight has concluded. After that, the state of the game 
-    # is updated and any requested inventory or skill actions are performed.
-    # Finally, the step is concluded by logging all relevant game data.
-
+    # is marked out-of-date and any requested inventory or skill actions are
+    # performed. The state is only reloaded for the sections that the handlers
+    # actually read, and the inventory is updated from the fight's results
+    # instead of being reloaded (see 'update_inventory_after_fight'). Finally,
+    # the step is concluded by logging the game data.
+    # Everything logged during the step is written in a single transaction,
+    # where 'conn' may be either a connection or a 'logs.LogWriter'.
+
+    batch = logs.LogBatch(conn)
     fought = False
-    moved = make_move(driver, handler, game_state)
-    if not moved:
+    reload_inventory = False
+    move_dict = make_move(driver, handler, game_state)
+    if move_dict is None:
         game_state.live = False
         return game_state
     game_state.move_id += 1
-    if driver.is_fighting():
-        fight_loop(driver, handler, game_state.game_id, game_state.move_id, conn)
+    if move_dict["fighting"]:
+        (end_message, potions_used) = fight_loop(driver, handler, game_state.game_id, game_state.move_id, batch)
         fought = True
-    state_update(driver, game_state, ["explore", "characters"])
-    process_inventory(driver, handler, game_state, update = fought)
+        game_state.invalidate("explore")
+        reload_inventory = update_inventory_after_fight(game_state, end_message, potions_used)
+        driver.prefetch_state(inventory = reload_inventory) # Loads the needed pages together
+    else:
+        game_state.update_explore(move_dict["explore"])
+    game_state.invalidate("characters")
+    process_inventory(driver, handler, game_state, update = reload_inventory)
     process_skills(driver, handler, game_state, update = fought)
 
-    logs.log_explore_info(game_state, conn)
-    logs.log_status_info(game_state, conn)
-    logs.log_item_info(game_state, conn)
-    logs.log_skill_info(game_state, conn)
-    driver._log_local_map(conn)
+    logs.log_loaded(game_state, batch)
+    driver._log_local_map(batch)
+    batch.flush()
     return game_state
 
 def make_move(driver, handler, game_state):
@@ -137,19 +235,21 @@ def make_move(driver, handler, game_state):
     # This function executes the next move or action from the
     # assigned move handler. The handler will continue to be
     # queried until the map position changes or a fight begins.
+    # The driver's result for the final move is returned, or None
+    # if the handler has been released.
 
     old_coords = game_state.explore.coords
     while True:
         direction = handler.get_move_action(game_state)
         if direction == "release":
-            return False
+            return None
         if direction not in ["n", "s", "e", "w", "nw", "ne", "sw", "se"]:
-            driver.action(direction)
+            move_dict = driver.action(direction)
         else:
-            driver.move(direction)
-        if driver.is_fighting() or driver.get_explore_dict()["coords"] != old_coords:
+            move_dict = driver.move(direction)
+        if move_dict["fighting"] or move_dict["explore"]["coords"] != old_coords:
             break
-    return True
+    return move_dict
 
 def fight_loop(driver, handler, game_id, move_id, conn):
 
@@ -157,16 +257,20 @@ def fight_loop(driver, handler, game_id, move_id, conn):
     # iteration consisting of either a player or enemy move. During the
     # player's moves, actions are returned by the assigned fight handler
     # based on the current game state. After all enemies or party members
-    # are defeated, the fight loop terminates.
+    # are defeated, the fight loop terminates. The fight end message and the
+    # names of the potions used during the fight are returned.
 
     turn_id = 0
+    potions_used = []
     driver.begin_fight()
     fight_dict = driver.get_fight_dict()
     fight_state = fight.FightState(fight_dict)
     logs.log_fight(fight_state, game_id, move_id, turn_id, conn)
     while not fight_state.ended:
         if fight_state.is_player_turn():
-            make_fight_move(driver, handler, fight_state)
+            action = make_fight_move(driver, handler, fight_state)
+            if "potion" in action:
+                potions_used.append(action.split("_")[-1])
         else:
             driver.take_enemy_turn()
         fight_dict = driver.get_fight_dict()
@@ -177,11 +281,12 @@ def fight_loop(driver, handler, game_id, move_id, conn):
     end_message = driver.get_fight_end_message()
     logs.log_fight_end(game_id, move_id, end_message, conn)
     driver.return_from_fight()
+    return (end_message, potions_used)
 
 def make_fight_move(driver, handler, fight_state):
 
     # This function executes the next fight action from the
-    # assigned fight handler.
+    # assigned fight handler, and returns that action.
 
     action = handler.get_fight_action(fight_state)
     while "trg" in action: # Targetting does not count as a full action
@@ -201,45 +306,63 @@ def make_fight_move(driver, handler, fight_state):
     elif "potion" in action:
         potion_name = action.split("_")[-1]
         driver.use_fight_potion(potion_name)
+    return action
+
+def update_inventory_after_fight(game_state, end_message, potions_used):
+
+    # This function applies the results of a fight to the inventory, if it
+    # has been loaded, and returns true if it should be reloaded instead:
+    # either because a change could not be applied (such as finding a new
+    # kind of item) or because it has not been checked for many fights.
+
+    if not game_state.is_loaded("inventory"): # It will be loaded in full when next read
+        return False
+    inventory_state = game_state.inventory
+    applied = inventory_state.apply_fight(end_message, potions_used)
+    reload = (not applied or inventory_state.needs_reload())
+    return reload
 
 def process_inventory(driver, handler, game_state, update = True):
 
     # This function executes any inventory actions returned by the
     # assigned inventory handler. An optional 'update' argument
-    # can be passed to determine whether a state update should be
-    # requested from the driver.
+    # can be passed to mark the inventory as out-of-date, so that
+    # it is reloaded if the handler reads it. A potion that is drunk
+    # is removed from the inventory directly, without a reload.
 
     if update:
-        state_update(driver, game_state, ["inventory"])
+        game_state.invalidate("inventory")
     action_type = ""
     while action_type != "nothing":
         (action_type, action) = handler.get_inventory_action(game_state)
         if action_type == "heal":
             (potion_name, char_id) = action.split("_")
             driver.drink_inventory_potion(potion_name, char_id)
-            state_update(driver, game_state, ["inventory", "characters"])
+            if not (game_state.is_loaded("inventory") and game_state.inventory.remove_item(potion_name)):
+                game_state.invalidate("inventory")
+            game_state.invalidate("characters")
     
 def process_skills(driver, handler, game_state, update = True):
 
     # This function executes any skill point actions returned by the
     # assigned skills handler. An optional 'update' argument can be
-    # passed to determine whether a state update should be requested
-    # from the driver.
+    # passed to mark the skills as out-of-date, so that they are
+    # reloaded if the handler reads them.
 
     if update:
-        state_update(driver, game_state, ["skills"])
+        game_state.invalidate("skills")
     action = handler.get_skills_action(game_state)
     while action != "nothing":
         (char_name, skill, points) = action.split("_")
         driver.upgrade_skill(char_name, skill, points)
-        state_update(driver, game_state, ["skills"])
+        game_state.invalidate("skills")
         action = handler.get_skills_action(game_state)
 
 def state_update(driver, game_state, info_sequence):
 
-    # This function updates the passed GameState instance with 
-    # the types of data requested in the 'info_sequence' string
-    # list.
+    # This function immediately updates the passed GameState 
+    # instance with the types of data requested in the 
+    # 'info_sequence' string list.
 
     for info_type in info_sequence:
         if info_type == "characters":
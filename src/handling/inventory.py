@@ -16,10 +16,10 @@ class SimpleHeal():
         # a blank action string. 
 
         injured_ids = game_state.characters.get_injured_ids(dmg_thresh = 7)
-        inventory = game_state.inventory
         (action_type, action) = ("nothing", "")
-        if injured_ids:
+        if injured_ids: # The inventory is only read (and loaded) when needed
             char_id = injured_ids[0]
+            inventory = game_state.inventory
             if inventory.get_item("Healing Vial"):
                 (action_type, action) = ("heal", f"Healing Vial_{char_id}")
             elif inventory.get_item("Healing Flask"):
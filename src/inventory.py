@@ -1,6 +1,14 @@
+import re
+
 # This module contains all classes and functions which involve
 # inventory items.
 
+inventory_settings = {
+    "reload_interval": 25 # Fights after which the inventory is reloaded even if nothing looks wrong
+}
+
+loot_pattern = re.compile(r"You found (\d+) (.+?)!") # Item lines in the fight end message
+
 class InventoryState():
 
     # This class contains the state of the player's inventory,
@@ -11,7 +19,8 @@ class InventoryState():
         # 'inventory_list' is the data structure returned by the 
         # auto-player driver's `get_inventory_list` method.
 
-        self.inventory = inventory_list 
+        self.inventory = [dict(i_dict) for i_dict in inventory_list] # Copied, since it is changed in place
+        self.fights = 0 # Fights applied with 'apply_fight' since the list was loaded
 
     def get_item_type(self, item_type):
 
@@ -38,3 +47,69 @@ class InventoryState():
         # This function returns every inventory item.
 
         return self.inventory
+
+    def add_item(self, name, quant):
+
+        # This method adds 'quant' of the named item, returning false if
+        # it cannot be done reliably. Only stackable items that are already
+        # held can be added, since the type of a new item is not known.
+
+        for name_form in [name, name[:-1], name[:-2]]: # Loot messages may use the plural
+            for i_dict in self.get_item(name_form):
+                if i_dict["quant"]:
+                    i_dict["quant"] = str(int(i_dict["quant"]) + quant)
+                    return True
+        return False
+
+    def remove_item(self, name, quant = 1):
+
+        # This method removes 'quant' of the named stackable item, returning
+        # false if that many are not held.
+
+        for i_dict in self.get_item(name):
+            if i_dict["quant"] and int(i_dict["quant"]) >= quant:
+                remaining = int(i_dict["quant"]) - quant
+                if remaining:
+                    i_dict["quant"] = str(remaining)
+                else:
+                    self.inventory.remove(i_dict)
+                return True
+        return False
+
+    def apply_fight(self, end_message, potions_used):
+
+        # This method updates the inventory with the effects of a fight: the
+        # potions used during it, and the items found at the end. It returns
+        # false if any change could not be applied, in which case the list no
+        # longer matches the game and must be reloaded.
+
+        self.fights += 1
+        applied = True
+        for potion_name in potions_used:
+            applied = self.remove_item(potion_name) and applied
+        for (name, quant) in get_loot(end_message):
+            applied = self.add_item(name, quant) and applied
+        return applied
+
+    def needs_reload(self):
+
+        # This method returns true once enough fights have been applied that
+        # the list should be checked against the inventory page.
+
+        check = (self.fights >= inventory_settings["reload_interval"])
+        return check
+
+def get_loot(end_message):
+
+    # This function returns the (name, quantity) of each item found
+    # in the passed fight end message, leaving out the gold.
+
+    loot = [
+        (name, int(quant)) for (quant, name) in loot_pattern.findall(end_message)
+        if name != "gold pieces"
+    ]
+    return loot
+
+if __name__ == "__main__":
+    message = "You won the fight! You found 106 gold pieces! You found 1 Potion of Regeneration!"
+    print(get_loot(message))
@@ -1,7 +1,257 @@
+import queue
+import sqlite3
+import threading
+import time
 
 # This module contains functions which interface with the SQLite
 # database used to store game data. All functions must be passed
-# an active SQLite connection to operate.
+# an active SQLite connection to operate. The logging functions
+# also accept a LogBatch in place of a connection, in which case
+# their rows are held back and written in a single transaction,
+# either directly or through a background LogWriter thread.
+
+class LogBatch():
+
+    # This class collects the statements of the logging functions so that a
+    # whole game step (including any fight) is written at once. It offers the
+    # 'execute', 'executemany' and 'commit' methods of a connection, but
+    # nothing reaches the database until 'flush' is called, which writes every
+    # statement with 'executemany' inside one transaction. A step is therefore
+    # either fully logged or not logged at all. The 'target' can be either a
+    # connection or a LogWriter, in which case flushing only queues the batch.
+
+    def __init__(self, target):
+        self.target = target
+        self.statements = []
+
+    def execute(self, sql, params = ()):
+        self.executemany(sql, [params])
+
+    def executemany(self, sql, rows):
+
+        # Consecutive statements with the same SQL are merged into one
+        # 'executemany' call.
+
+        rows = list(rows)
+        if not rows:
+            return
+        if self.statements and self.statements[-1][0] == sql:
+            self.statements[-1][1].extend(rows)
+        else:
+            self.statements.append((sql, rows))
+
+    def commit(self):
+        pass # Writes are deferred until 'flush'
+
+    def flush(self):
+
+        # This method writes all collected statements in a single
+        # transaction, or hands them to the LogWriter to do so.
+
+        if isinstance(self.target, LogWriter):
+            self.target.submit(self.statements)
+        else:
+            write_statements(self.target, [self.statements])
+        self.statements = []
+
+class LogWriteError(Exception):
+
+    # This exception is raised in the game thread when the LogWriter could not
+    # write some batches, or has stopped, and lists every error since the last
+    # one was raised.
+
+    pass
+
+class LogWriter(threading.Thread):
+
+    # This class writes log batches to the database from its own thread, so that
+    # the game loop never waits on disk I/O. Batches are passed in through a
+    # bounded queue: if the writer falls behind by 'max_batches', 'submit' blocks
+    # until there is room again, which stops memory from growing without limit.
+    # Queued batches are committed together every 'flush_interval' seconds, when
+    # 'sync' is called, and when the writer is closed. If that transaction fails,
+    # the batches are written one at a time instead, so that only the batches
+    # that still fail after 'attempts' tries are dropped. The errors are raised
+    # in the game thread by the next 'submit' or 'sync', and the calls that wait
+    # on the writer stop waiting if its thread has died.
+
+    def __init__(self, db_path, max_batches = 256, flush_interval = 1, attempts = 2):
+        super().__init__(daemon = True)
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize = max_batches)
+        self.flush_interval = flush_interval
+        self.attempts = attempts
+        self.written = 0
+        self.dropped = 0
+        self.oldest_pending = None # Submission time of the oldest unwritten batch
+        self.errors = queue.Queue() # Errors not yet raised in the game thread
+        self.start()
+
+    def submit(self, statements):
+
+        # This method queues the statements of one batch for writing,
+        # blocking while the queue is full.
+
+        self._raise_errors()
+        if self.oldest_pending is None:
+            self.oldest_pending = time.perf_counter()
+        if not self._put(statements):
+            self._raise_errors(stopped = True)
+
+    def sync(self):
+
+        # This method blocks until every batch submitted so far
+        # has been written or dropped.
+
+        done = threading.Event()
+        if self._put(done):
+            while not done.wait(timeout = 0.1) and self.is_alive():
+                pass
+        self._raise_errors(stopped = not done.is_set())
+
+    def close(self):
+
+        # This method writes any remaining batches and stops the thread.
+        # Since it is called while the game loop is stopping, errors that
+        # were not raised yet are printed rather than raised.
+
+        if self._put("close"):
+            self.join()
+        errors = self._get_errors()
+        if errors:
+            print(f"Logging failed: {'; '.join(errors)}")
+
+    def get_stats(self):
+
+        # This method returns the number of queued batches, the number of
+        # batches written and dropped so far, and the time in seconds that
+        # the oldest unwritten batch has been waiting.
+
+        lag = (time.perf_counter() - self.oldest_pending if self.oldest_pending is not None else 0)
+        stats = {"queued": self.queue.qsize(), "written": self.written, "dropped": self.dropped, "lag": lag}
+        return stats
+
+    def run(self):
+
+        # The writer opens its own connection, since SQLite connections can
+        # only be used from the thread that created them. A sync request is
+        # an Event, which is set once the batches queued before it are written.
+
+        try:
+            conn = connect(self.db_path)
+        except sqlite3.Error as error:
+            self.errors.put(f"could not open {self.db_path}: {error!r}")
+            return
+        pending = []
+        deadline = time.perf_counter() + self.flush_interval
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout = max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                item = None
+            is_signal = (item is None or item == "close" or isinstance(item, threading.Event))
+            if not is_signal:
+                pending.append(item)
+            if is_signal or len(pending) >= self.queue.maxsize:
+                self._write(conn, pending)
+                pending = []
+                deadline = time.perf_counter() + self.flush_interval
+            if isinstance(item, threading.Event):
+                item.set()
+            running = (item != "close")
+        conn.close()
+
+    def _write(self, conn, pending):
+
+        # This internal method commits the pending batches in one transaction,
+        # falling back to one transaction per batch if that fails (see
+        # '_write_batch'), so that one bad batch does not lose the others.
+
+        if pending:
+            try:
+                write_statements(conn, pending)
+                self.written += len(pending)
+            except sqlite3.Error:
+                for statements in pending:
+                    self._write_batch(conn, statements)
+        self.oldest_pending = (time.perf_counter() if not self.queue.empty() else None)
+
+    def _write_batch(self, conn, statements):
+
+        # This internal method writes a single batch, trying again up to the
+        # number of attempts, and records the error if it is dropped.
+
+        for attempt in range(1, self.attempts + 1):
+            try:
+                write_statements(conn, [statements])
+                self.written += 1
+                break
+            except sqlite3.Error as error:
+                if attempt == self.attempts:
+                    self.dropped += 1
+                    self.errors.put(f"dropped a batch after {attempt} attempts: {error!r}")
+
+    def _put(self, item):
+
+        # This internal method queues an item, returning false instead if the
+        # writer thread has stopped, so that a dead writer cannot leave the
+        # game thread waiting on a full queue forever.
+
+        queued = False
+        while not queued and self.is_alive():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                queued = True
+            except queue.Full:
+                pass
+        return queued
+
+    def _get_errors(self):
+
+        # This internal method returns and clears the errors not yet raised.
+
+        errors = []
+        while not self.errors.empty():
+            errors.append(self.errors.get())
+        return errors
+
+    def _raise_errors(self, stopped = False):
+
+        # This internal method raises every error not yet raised at once. If
+        # 'stopped' is true, the writer thread has died, so an error is raised
+        # even if its cause was already reported.
+
+        errors = self._get_errors()
+        if stopped:
+            errors.append("the log writer has stopped")
+        if errors:
+            raise LogWriteError(f"Logging failed: {'; '.join(errors)}")
+
+def write_statements(conn, batches):
+
+    # This function writes the statements of each passed batch, as collected
+    # by a LogBatch, in a single transaction that is rolled back on failure.
+
+    with conn:
+        for statements in batches:
+            for (sql, rows) in statements:
+                conn.executemany(sql, rows)
+
+def connect(db_path, timeout = 30, check_same_thread = True):
+
+    # This function opens the SQLite database in write-ahead-log mode, which
+    # makes commits cheaper and lets other programs read the database while
+    # the auto-player writes to it. With WAL, 'synchronous = NORMAL' is still
+    # safe against corruption, only skipping the fsync on each commit. The
+    # 'timeout' is how long to wait for other writers sharing the database,
+    # and 'check_same_thread' can be cleared for a connection that is handed
+    # between threads (each call on it is still serialized by SQLite).
+
+    conn = sqlite3.connect(db_path, timeout = timeout, check_same_thread = check_same_thread)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    return conn
 
 def clear_logs(game_id, conn):
 
@@ -28,21 +278,32 @@ def log_all(game_state, conn):
     log_item_info(game_state, conn)
     log_skill_info(game_state, conn)
 
+def log_loaded(game_state, conn):
+
+    # This function logs the exploration and party status information from the
+    # passed GameState instance, along with the inventory and skills only if they
+    # are up-to-date, so that logging never triggers a load of those pages.
+
+    log_explore_info(game_state, conn)
+    log_status_info(game_state, conn)
+    if game_state.is_loaded("inventory"):
+        log_item_info(game_state, conn)
+    if game_state.is_loaded("skills"):
+        log_skill_info(game_state, conn)
+
 def log_explore_info(game_state, conn):
 
     # This functions logs all data related to map exploration from 
     # the passed GameState instance.
 
     (x_pos, y_pos) = game_state.explore.coords
-    cursor = conn.cursor()
-    cursor.execute(
+    conn.execute(
         """
         INSERT INTO explore (game_id, move_id, area, x_pos, y_pos, travel_mode, gold)
         VALUES (?, ?, ?, ?, ?, ?, ?);
         """, (game_state.game_id, game_state.move_id, game_state.explore.area, x_pos, y_pos, 
               game_state.explore.travel_mode, game_state.explore.gold)
     )
-    cursor.close()
     conn.commit()
 
 def log_status_info(game_state, conn):
@@ -50,16 +311,17 @@ def log_status_info(game_state, conn):
     # This functions logs all data related to party status from 
     # the passed GameState instance. 
 
-    cursor = conn.cursor()
-    for (name, info_dict) in game_state.characters.get_iter():
-        cursor.execute(
-            """
-            INSERT INTO status (game_id, move_id, name, level, exp, curr_health, max_health)
-            VALUES (?, ?, ?, ?, ?, ?, ?);
-            """, (game_state.game_id, game_state.move_id, name, info_dict["level"], 
-                  info_dict["exp"], info_dict["curr_health"], info_dict["max_health"])
-        )
-    cursor.close()
+    rows = [
+        (game_state.game_id, game_state.move_id, name, info_dict["level"], 
+         info_dict["exp"], info_dict["curr_health"], info_dict["max_health"])
+        for (name, info_dict) in game_state.characters.get_iter()
+    ]
+    conn.executemany(
+        """
+        INSERT INTO status (game_id, move_id, name, level, exp, curr_health, max_health)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+        """, rows
+    )
     conn.commit()
 
 def log_item_info(game_state, conn):
@@ -67,23 +329,25 @@ def log_item_info(game_state, conn):
     # This functions logs all data related to inventory items from 
     # the passed GameState instance.
 
-    cursor = conn.cursor()
-    cursor.execute( # Delete out-of-date info
-            """
-            DELETE FROM inventory
-            WHERE game_id = ? AND move_id = ?;
-            """, (game_state.game_id, game_state.move_id)
-        )
+    conn.execute( # Delete out-of-date info
+        """
+        DELETE FROM inventory
+        WHERE game_id = ? AND move_id = ?;
+        """, (game_state.game_id, game_state.move_id)
+    )
+    rows = []
     for item_dict in game_state.inventory.get_all():
         buff_string = ",".join([" ".join(tupl) for tupl in item_dict["buffs"]])
-        cursor.execute(
-            """
-            INSERT INTO inventory (game_id, move_id, type, name, buffs, quant, equipped)
-            VALUEs (?, ?, ?, ?, ?, ?, ?)
-            """, (game_state.game_id, game_state.move_id, item_dict["type"], item_dict["name"], 
-                  buff_string, item_dict["quant"], item_dict["equipped"])
+        rows.append(
+            (game_state.game_id, game_state.move_id, item_dict["type"], item_dict["name"], 
+             buff_string, item_dict["quant"], item_dict["equipped"])
         )
-    cursor.close()
+    conn.executemany(
+        """
+        INSERT INTO inventory (game_id, move_id, type, name, buffs, quant, equipped)
+        VALUEs (?, ?, ?, ?, ?, ?, ?)
+        """, rows
+    )
     conn.commit()
 
 def log_fight(fight_state, game_id, move_id, turn_id, conn):
@@ -91,46 +355,41 @@ def log_fight(fight_state, game_id, move_id, turn_id, conn):
     # This functions logs all data related to combat from 
     # the passed FightState instance.
 
-    cursor = conn.cursor()
-    cursor.execute(
+    conn.execute(
         """
         INSERT INTO fight_turns (game_id, move_id, turn_id, elapsed_time, message)
         VALUES (?, ?, ?, ?, ?);
         """, (game_id, move_id, turn_id, fight_state.time, fight_state.messages)
     )
-    for (i, player_dict) in enumerate(fight_state.players.values(), 1):
-        cursor.execute(
-            """
-            INSERT INTO fight_status (game_id, move_id, turn_id, type, char_id, name, curr_health,
-                                        max_health, turn_time)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
-            """, (game_id, move_id, turn_id, "player", i, player_dict["name"],
-                  player_dict["curr_health"], player_dict["max_health"], player_dict["time"])
-        )
-    for (j, enemy_dict) in fight_state.enemies.items():
-        cursor.execute(
-            """
-            INSERT INTO fight_status (game_id, move_id, turn_id, type, char_id, name, curr_health,
-                                        max_health, turn_time)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
-            """, (game_id, move_id, turn_id, "enemy", j, enemy_dict["name"],
-                  enemy_dict["curr_health"], enemy_dict["max_health"], enemy_dict["time"])
-        )
-    cursor.close()
+    rows = [
+        (game_id, move_id, turn_id, "player", i, player_dict["name"],
+         player_dict["curr_health"], player_dict["max_health"], player_dict["time"])
+        for (i, player_dict) in enumerate(fight_state.players.values(), 1)
+    ]
+    rows += [
+        (game_id, move_id, turn_id, "enemy", j, enemy_dict["name"],
+         enemy_dict["curr_health"], enemy_dict["max_health"], enemy_dict["time"])
+        for (j, enemy_dict) in fight_state.enemies.items()
+    ]
+    conn.executemany(
+        """
+        INSERT INTO fight_status (game_id, move_id, turn_id, type, char_id, name, curr_health,
+                                    max_health, turn_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """, rows
+    )
     conn.commit()
 
 def log_fight_end(game_id, move_id, end_message, conn):
 
     # This functions logs the passed fight end message.
 
-    cursor = conn.cursor()
-    cursor.execute(
+    conn.execute(
         """
         INSERT INTO fight_end (game_id, move_id, message)
         VALUES (?, ?, ?);
         """, (game_id, move_id, end_message)
     )
-    cursor.close()
     conn.commit()
 
 def log_skill_info(game_state, conn):
@@ -138,31 +397,28 @@ def log_skill_info(game_state, conn):
     # This functions logs all data related to skill points from 
     # the passed GameState instance.
 
-    cursor = conn.cursor()
-    for (char_name, skills_dict) in game_state.skills.get_iter():
-        for (skill, skill_dict) in skills_dict.items():
-            cursor.execute(
-                """
-                INSERT INTO skills (game_id, move_id, char_name, skill, level_name, points, buff)
-                VALUES (?, ?, ?, ?, ?, ?, ?);
-                """, (game_state.game_id, game_state.move_id, char_name, skill, 
-                      skill_dict["level_name"], skill_dict["points"], skill_dict["buff"])
-            )
-    cursor.close()
+    rows = [
+        (game_state.game_id, game_state.move_id, char_name, skill, 
+         skill_dict["level_name"], skill_dict["points"], skill_dict["buff"])
+        for (char_name, skills_dict) in game_state.skills.get_iter()
+        for (skill, skill_dict) in skills_dict.items()
+    ]
+    conn.executemany(
+        """
+        INSERT INTO skills (game_id, move_id, char_name, skill, level_name, points, buff)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+        """, rows
+    )
     conn.commit()
 
 def get_next_game_id(conn):
 
-    # This function retrieves the next available game ID, 
-    # incrementing by 1 each time.
+    # This function allocates a new game ID from the 'games' table (see
+    # 'migrations.py'). The ID comes from a single autoincrementing insert,
+    # so it never has to scan the logs, and auto-players sharing a database
+    # can never be handed the same ID.
 
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT DISTINCT(game_id)
-        FROM explore;
-        """
-    )
-    game_ids = [int(tupl[0]) for tupl in cursor.fetchall()]
-    next_game_id = max(game_ids) + 1
+    with conn:
+        cursor = conn.execute("INSERT INTO games DEFAULT VALUES;")
+    next_game_id = cursor.lastrowid
     return next_game_id
\ No newline at end of file
@@ -0,0 +1,118 @@
+import sqlite3
+import sys
+
+# This module keeps the schema of the SQLite database up-to-date. Each entry in
+# 'migrations' is a list of statements that brings the schema from one version
+# to the next, and the version of a database is stored in its 'user_version'
+# pragma. New changes must always be appended to the end of the list, since the
+# position of each entry is its version number.
+
+migrations = [ # Schema changes, in order (entry i upgrades version i to i + 1)
+    [ # Log tables, matching those of databases created before this module existed
+        """
+        CREATE TABLE IF NOT EXISTS explore (
+            game_id INTEGER, move_id INTEGER, area TEXT, x_pos INTEGER, y_pos INTEGER,
+            travel_mode TEXT, gold TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS status (
+            game_id INTEGER, move_id INTEGER, name TEXT, level INTEGER, exp TEXT,
+            curr_health INTEGER, max_health INTEGER
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS inventory (
+            game_id INTEGER, move_id INTEGER, type TEXT, name TEXT, buffs TEXT,
+            quant TEXT, equipped INTEGER
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS skills (
+            game_id INTEGER, move_id INTEGER, char_name TEXT, skill TEXT,
+            level_name TEXT, points INTEGER, buff TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS fight_turns (
+            game_id INTEGER, move_id INTEGER, turn_id INTEGER, elapsed_time TEXT, message TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS fight_status (
+            game_id INTEGER, move_id INTEGER, turn_id INTEGER, type TEXT, char_id INTEGER,
+            name TEXT, curr_health INTEGER, max_health INTEGER, turn_time TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS fight_end (
+            game_id INTEGER, move_id INTEGER, message TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS map (
+            area TEXT, x_pos INTEGER, y_pos INTEGER, image TEXT,
+            UNIQUE (area, x_pos, y_pos, image)
+        );
+        """
+    ],
+    [ # Indexes for the per-game and per-move lookups and deletes
+        "CREATE INDEX IF NOT EXISTS explore_game_move ON explore (game_id, move_id);",
+        "CREATE INDEX IF NOT EXISTS status_game_move ON status (game_id, move_id);",
+        "CREATE INDEX IF NOT EXISTS inventory_game_move ON inventory (game_id, move_id);",
+        "CREATE INDEX IF NOT EXISTS skills_game_move ON skills (game_id, move_id);",
+        "CREATE INDEX IF NOT EXISTS fight_turns_game_move ON fight_turns (game_id, move_id, turn_id);",
+        "CREATE INDEX IF NOT EXISTS fight_status_game_move ON fight_status (game_id, move_id, turn_id);",
+        "CREATE INDEX IF NOT EXISTS fight_end_game_move ON fight_end (game_id, move_id);"
+    ],
+    [ # Game ID allocation, continuing from the highest ID already logged
+        """
+        CREATE TABLE IF NOT EXISTS games (
+            game_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        INSERT INTO games (game_id)
+        SELECT MAX(game_id) FROM explore
+        HAVING MAX(game_id) IS NOT NULL;
+        """
+    ]
+]
+
+def get_version(conn):
+
+    # This function returns the schema version of the database.
+
+    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    return version
+
+def migrate(conn):
+
+    # This function applies every migration that the database has not yet
+    # seen. Each one runs in its own immediate transaction, which holds the
+    # database's write lock from the start, and the version is checked again
+    # once the lock is held. This makes it safe for several auto-players to
+    # start against the same database at once: only one applies each change.
+
+    for (version, statements) in enumerate(migrations, 1):
+        if get_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            if get_version(conn) < version:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version};")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    version = get_version(conn)
+    return version
+
+if __name__ == "__main__":
+    for db_path in (sys.argv[1:] or ["data.db"]):
+        conn = sqlite3.connect(db_path)
+        print(f"{db_path}: schema version {migrate(conn)}")
+        conn.close()
@@ -0,0 +1,458 @@
+import asyncio
+import time
+from http.cookies import SimpleCookie
+
+import aiohttp
+
+from . import explore_parser, fight_parser, inventory_parser
+from .http_driver import get_move_fields, get_fight_fields, get_return_form
+from .neo_driver import Driver, DriverFailure, game_url, extract_game_div, is_restarted, recovery_settings
+
+# This module contains an asyncio version of the HTTP driver in 'http_driver.py'.
+# Every method that loads a page is a coroutine, so a single process can run many
+# game sessions at once, each waiting on its own requests without tying up a
+# thread. The parsing, page caching and bookkeeping are inherited from Driver,
+# along with its helpers for building URLs and updating the saved skills, and
+# the forms are filled in by the same functions as in HttpDriver. Only the
+# navigation around those helpers is repeated here, since it must be awaited.
+# It requires the optional 'aiohttp' package.
+
+class AsyncDriver(Driver):
+
+    # This class has the same public methods as Driver, except that the ones
+    # that can load a page must be awaited. The methods that only read the
+    # current page ('is_fighting', 'get_fight_end_message' and 'choose_target')
+    # are still ordinary methods.
+
+    def __init__(self, flag, cookies = None, game_url = game_url, user_agent = None, connector = None, timeout = 20):
+
+        # The arguments match those of HttpDriver. If a shared aiohttp
+        # 'connector' is passed, its connection pool is used by every
+        # driver that shares it, while each driver keeps its own cookies.
+
+        super().__init__(None, flag, game_url = game_url)
+        self.cookies = (cookies or [])
+        self.user_agent = user_agent
+        self.connector = connector
+        self.default_timeout = timeout
+        self.session = None
+        self.target = None
+
+    async def get_state_data(self):
+
+        # This method retrieves all of the game state in the same order as
+        # Driver's, so that the fewest pages are loaded.
+
+        characters_dict = await self.get_characters_dict()
+        inventory_list = await self.get_inventory_list()
+        skills_dict = await self.get_skills_dict()
+        explore_dict = await self.get_explore_dict()
+        return (explore_dict, characters_dict, inventory_list, skills_dict)
+
+    async def get_explore_dict(self):
+
+        # This method navigates to the main exploration page and then extracts
+        # relevant travel and gold information.
+
+        if not self.is_fighting():
+            while self.source != "explore":
+                await self._return_to_map()
+            explore_dict = self._read_explore_dict()
+            return explore_dict
+
+    async def get_characters_dict(self):
+
+        # This method reads the party status from the current or prefetched
+        # page if it shows it, and otherwise from the navigation page.
+
+        if not self.is_fighting():
+            page = self._find_page("explore", "inventory")
+            if page is None:
+                while self.source != "explore":
+                    await self._return_to_map()
+                page = self.page
+            characters_dict = self._read_characters_dict(page)
+            return characters_dict
+
+    async def get_inventory_list(self):
+
+        # This method extracts the inventory items, navigating to the
+        # inventory page unless it is current or prefetched.
+
+        if not self.is_fighting():
+            page = self._find_page("inventory")
+            if page is None:
+                while self.source != "inventory":
+                    await self._open_inventory()
+                page = self.page
+            inventory_list = page.get("items")
+            return inventory_list
+
+    async def get_skills_dict(self):
+
+        # This method returns the saved skills, reading the skills pages
+        # again only when Driver's helpers find that they are out-of-date.
+
+        if not self.is_fighting():
+            if self._skills_need_update():
+                unspent_points = await self._get_unspent_points()
+                char_skills = {}
+                for char_name in self._get_unread_chars(unspent_points):
+                    char_skills[char_name] = await self._get_char_skills(char_name)
+                self._store_skills(unspent_points, char_skills)
+            return self.skills_dict
+
+    async def get_fight_dict(self):
+
+        # This method extracts the status of a fight, beginning the
+        # fight if it has not yet been started.
+
+        while self.source == "fight_start":
+            await self.begin_fight()
+        fight_dict = self.page.get("fight")
+        return fight_dict
+
+    async def action(self, action):
+
+        # This method toggles the travel mode and returns the result in
+        # the same format as 'move'.
+
+        if action in {"normal", "hunting"}:
+            await self._set_travel_mode(action)
+        move_dict = await self._get_move_dict()
+        return move_dict
+
+    async def move(self, direction):
+
+        # This method makes a move in the specified direction and returns
+        # the outcome as read from the page that the move loaded.
+
+        direction_id = explore_parser.get_direction_id(direction)
+        if not self.is_fighting():
+            while self.source != "explore":
+                await self._return_to_map()
+            await self._submit_move(direction_id)
+        move_dict = await self._get_move_dict()
+        return move_dict
+
+    def choose_target(self, target_id):
+
+        # This method stores the specified target, which is sent along
+        # with the next combat form.
+
+        id_mapping = self._get_enemy_id_map()
+        self.target = id_mapping[target_id]
+
+    async def wait(self, time):
+
+        # This method performs a wait action for the specified time
+        # during combat.
+
+        await self._submit_fight_action(6, parm = time)
+
+    async def melee_attack(self):
+
+        # This method performs a melee attack.
+
+        await self._submit_fight_action(3)
+
+    async def use_ability(self, ability_name):
+
+        # This method uses the specified ability.
+
+        ability_id = fight_parser.get_ability_id(ability_name)
+        await self._submit_fight_action(ability_id)
+
+    async def flee(self):
+
+        # This method attempts to flee a fight.
+
+        await self._submit_fight_action(4)
+
+    async def take_enemy_turn(self):
+
+        # This method allows the enemy to take its turn.
+
+        await self._submit_fight_action(1)
+
+    async def begin_fight(self):
+
+        # This method starts a fight from the initial encounter screen.
+
+        while self.source == "fight_start":
+            await self._load(f"{self.game_url}?start=1", self.game_url)
+
+    async def end_fight(self):
+
+        # This method ends a fight after the final turn.
+
+        while self.source == "fight":
+            await self._submit_fight_action(2)
+
+    async def return_from_fight(self):
+
+        # This method returns to the main navigation page from the
+        # loot screen.
+
+        while self.source == "fight_end":
+            await self._do_action(self._fight_return, [], self.game_url)
+
+    async def use_fight_potion(self, potion_name):
+
+        # This method uses a potion during combat.
+
+        potion_id = inventory_parser.get_potion_id(potion_name)
+        await self._submit_fight_action(5, item = potion_id)
+
+    async def drink_inventory_potion(self, potion_name, char_id):
+
+        # This method uses a potion outside of combat.
+
+        url = self._get_potion_url(potion_name, char_id)
+        await self._load(url, self._get_inventory_url())
+
+    async def upgrade_skill(self, char_name, skill, points):
+
+        # This method spends skill points on the selected skill, and then
+        # saves the skills and unspent points shown afterwards.
+
+        url = self._get_upgrade_url(char_name, skill, points)
+        await self._load(url, f"{self.game_url}?act=skills")
+        skills = await self._get_char_skills(char_name)
+        self._store_upgrade(char_name, skills, await self._get_unspent_points())
+
+    async def reset_game(self):
+
+        # This method resets the game.
+
+        self._forget_skills()
+        while self.source != "intro":
+            await self._load(f"{self.game_url}?restart=1", self.game_url)
+        while not is_restarted(self.soup):
+            await self._load(f"{self.game_url}?startgame=1", self.game_url)
+
+    async def quit(self):
+
+        # This method closes the session (but not a shared connector).
+
+        if self.session is not None:
+            await self.session.close()
+
+    async def prefetch_state(self, inventory = True):
+
+        # This method mirrors Driver's, fetching the pages concurrently.
+
+        if self.is_fighting():
+            return
+        urls = self._get_prefetch_urls(inventory)
+        htmls = await asyncio.gather(*[self._fetch_text(url) for url in urls])
+        self._store_prefetched(htmls, urls)
+
+    async def _get_move_dict(self):
+
+        # This internal method summarizes the current page after a move or
+        # action, in the format described in Driver's '_get_move_dict'.
+
+        fighting = bool(self.is_fighting())
+        move_dict = {
+            "fighting": fighting,
+            "explore": (None if fighting else await self.get_explore_dict())
+        }
+        return move_dict
+
+    async def _fetch_text(self, url):
+
+        # This internal method returns the text of a page, or None on failure.
+
+        try:
+            text = await self._get(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            text = None
+        return text
+
+    async def _get_unspent_points(self):
+
+        # This internal method extracts the number of unspent skill points
+        # from either the inventory or skill screens.
+
+        if not self.is_fighting():
+            page = self._find_page("inventory", *[f"skills_{name}" for name in explore_parser.char_ids])
+            if page is None:
+                while "skills" not in self.source:
+                    await self._open_skills()
+                page = self.page
+            unspent_points = page.get("unspent_points")
+            return unspent_points
+
+    async def _get_char_skills(self, char_name):
+
+        # This internal method extracts the skills and spent skill points
+        # for a specified character.
+
+        if not self.is_fighting():
+            page = self._find_page(f"skills_{char_name}")
+            if page is None:
+                while self.source != f"skills_{char_name}":
+                    await self._open_skills(char_name)
+                page = self.page
+            skills = page.get("skills")
+            return skills
+
+    async def _set_travel_mode(self, mode):
+
+        # This internal method sets the specified travel mode.
+
+        await self._load(self._get_travel_url(mode), self.game_url)
+
+    async def _return_to_map(self):
+
+        # This internal method navigates back to the main game page.
+
+        await self._load(self.game_url, self.game_url)
+
+    async def _open_inventory(self):
+
+        # This internal method navigates to the inventory page.
+
+        url = self._get_inventory_url()
+        await self._load(url, url)
+
+    async def _open_skills(self, char_name = None):
+
+        # This internal method navigates to the skills page.
+
+        url = self._get_skills_url(char_name)
+        await self._load(url, url)
+
+    async def _log_local_map(self, conn):
+
+        # This internal method navigates back to the map if needed, and then
+        # logs new map tiles exactly as Driver does.
+
+        if not self.is_fighting():
+            while self.source != "explore":
+                await self._return_to_map()
+            Driver._log_local_map(self, conn)
+
+    async def _load(self, url, safe_url):
+
+        # This internal method performs a GET request for the passed URL.
+
+        await self._do_action(self._get, [url], safe_url)
+
+    async def _submit_move(self, direction_id):
+
+        # This internal method posts the movement form from the navigation page.
+
+        await self._do_action(self._post, [self.game_url, get_move_fields(direction_id)], self.game_url)
+
+    async def _submit_fight_action(self, action_id, parm = None, item = None):
+
+        # This internal method posts the combat form (see 'get_fight_fields').
+
+        fields = get_fight_fields(self.page.get("form"), self.target, action_id, parm, item)
+        await self._do_action(self._post, [self.game_url, fields], self.game_url)
+
+    async def _fight_return(self):
+
+        # This internal method finishes a fight either in victory or defeat,
+        # submitting the defeat form directly if there is one.
+
+        form = get_return_form(self.soup, self.game_url)
+        if form is not None:
+            (method, url, fields) = form
+            if method == "post":
+                text = await self._post(url, fields)
+            else:
+                text = await self._request("GET", url, params = fields)
+        else:
+            text = await self._get(f"{self.game_url}?finish=1")
+        return text
+
+    async def _get(self, url):
+
+        # This internal method sends a GET request and returns the page text.
+
+        text = await self._request("GET", url)
+        return text
+
+    async def _post(self, url, fields):
+
+        # This internal method sends a form POST and returns the page text.
+
+        text = await self._request("POST", url, data = {key: str(value) for (key, value) in fields.items()})
+        return text
+
+    async def _request(self, method, url, **kwargs):
+
+        # This internal method sends a request and returns the response text,
+        # creating the session on first use (it must be created inside the
+        # event loop).
+
+        if self.session is None:
+            self.session = make_client_session(self.cookies, self.user_agent, self.game_url, self.connector)
+        timeout = aiohttp.ClientTimeout(total = self.get_timeout())
+        async with self.session.request(method, url, timeout = timeout, **kwargs) as response:
+            response.raise_for_status()
+            text = await response.text()
+        return text
+
+    async def _do_action(self, func, args, safe_url):
+
+        # This internal method mirrors HttpDriver's: the request is repeated,
+        # with the 'safe_url' reloaded in between, until it returns a game div.
+
+        start = time.perf_counter()
+        failures = 0
+        while True:
+            try:
+                attempt_start = time.perf_counter()
+                html = extract_game_div(await func(*args))
+                if html is not None:
+                    self.latencies.append(time.perf_counter() - attempt_start)
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            print("Action failed.")
+            failures = await self._hard_refresh(safe_url, failures)
+        self.wait_times.append(time.perf_counter() - start)
+        self.target = None
+        self._set_page(html, (func, args))
+
+    async def _hard_refresh(self, return_url, failures = 0):
+
+        # This internal method mirrors HttpDriver's, but sleeps
+        # without blocking the other sessions.
+
+        while True:
+            failures += 1
+            if failures > recovery_settings["failure_budget"]:
+                raise DriverFailure(f"Gave up after {failures - 1} failed attempts.")
+            await asyncio.sleep(self._get_backoff(failures))
+            try:
+                if extract_game_div(await self._get(return_url)) is not None:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        return failures
+
+def make_client_session(cookies, user_agent, game_url, connector = None):
+
+    # This function creates an aiohttp session that loads the passed browser
+    # cookies with their domain and path, as 'http_driver.make_session' does,
+    # so that each cookie is only sent to the site that set it. If a shared
+    # 'connector' is passed, the session uses it without taking ownership.
+
+    headers = {"Referer": game_url}
+    if user_agent is not None:
+        headers["User-Agent"] = user_agent
+    session = aiohttp.ClientSession(
+        connector = connector, connector_owner = (connector is None), headers = headers
+    )
+    for cookie in cookies:
+        morsels = SimpleCookie()
+        morsels[cookie["name"]] = cookie["value"]
+        morsels[cookie["name"]]["domain"] = cookie.get("domain", "")
+        morsels[cookie["name"]]["path"] = cookie.get("path", "/")
+        session.cookie_jar.update_cookies(morsels)
+    return session
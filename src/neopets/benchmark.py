@@ -0,0 +1,341 @@
+import argparse
+import json
+import multiprocessing
+import re
+import statistics
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from . import page, fixtures, explore_parser, fight_parser, inventory_parser, skills_parser
+
+# This module holds performance benchmarks for the parsing code on the driver's
+# critical path, run over the captured pages in 'html/'. They need no network
+# access, and can be run with 'python -m src.neopets.benchmark'. Passing '--save'
+# stores the parser timings as a baseline, which later runs are compared against
+# to report regressions. Each function is timed in several runs, taken in rounds
+# through every function so that a slow spell on the machine is spread across
+# all of them, and in several fresh processes, since the speed of a function
+# also shifts between interpreters (with hash seeds and memory layout). A fixed
+# reference workload, which uses none of the parsing code, is timed in the same
+# rounds, and the median runs are compared after scaling the baseline by the
+# change in its speed, which removes any change in the speed of the machine
+# itself between the two runs. A slowdown is then only reported if it is larger
+# than both the tolerance and the uncertainty that the spread between the runs
+# leaves in the medians.
+
+benchmark_settings = {
+    "run_time": 0.03, # Seconds that each timing run lasts, roughly
+    "processes": 3, # Processes that the timing runs are split between, run one after another
+    "repeats": 10, # Timing runs per function in each process, of which the median of all is kept
+    "tolerance": 0.2, # Fractional slowdown against the baseline reported as a regression
+    "noise_factor": 3, # A regression must also be this many standard errors of the difference in medians
+    "baseline": fixtures.html_dir.parent / "benchmark_baseline.json" # Written by '--save', ignored by git
+}
+
+lookup_calls = [ # ID lookups with fixed arguments, which do not depend on a page
+    (explore_parser.get_character_id, ("Rohane",)),
+    (explore_parser.get_direction_id, ("ne",)),
+    (fight_parser.get_ability_id, ("Combat Focus",)),
+    (inventory_parser.get_potion_id, ("Healing Flask",)),
+    (skills_parser.get_skill_id, ("Rohane", "Innate Melee Haste"))
+]
+
+reference_label = "(reference workload)" # Key of the reference workload in the baseline
+reference_text = "".join( # Markup-like text for the reference workload, built once
+    f'<td class="c{i % 7}" id="cell{i}">{i * 37 % 1000}</td>' for i in range(300)
+)
+
+def legacy_get_source(soup):
+
+    # This function is the original tree-searching page classifier, kept as a
+    # reference for 'page.get_source'. It runs one full search of the
+    # parsed tree per page type, and is kept verbatim (including its
+    # spelling of "Mispy") so that the comparison is against the original.
+
+    source = None
+    if soup.select("map"):
+        source = "explore"
+    elif soup.find_all(string = "- Inventory and Party Info -"):
+        source = "inventory"
+    elif soup.find_all(string = "- Character Skills -"):
+        for char_name in ["Rohane", "Mispy", "Talinia", "Velm", "Invalid"]:
+            if soup.find_all(string = f"- {char_name}'s Skills -"):
+                break
+        source = f"skills_{char_name}"
+    elif soup.find_all(string = re.compile("You are attacked by.*")):
+        source = "fight_start"
+    elif soup.select('input[name="target"]'):
+        source = "fight"
+    elif soup.select(
+        'a[href="nq2.phtml?finish=1"], input[value="Return to your last rest spot..."]'):
+        source = "fight_end"
+    elif soup.find_all(string = re.compile("nearing the end of his reign")):
+        source = "intro"
+    return source
+
+def run_reference():
+
+    # This function is the reference workload, which measures the speed of the
+    # machine itself. It does the same kind of string and dictionary work as
+    # the parsers, but in plain Python on a fixed string, so that no change to
+    # the parsing code (or to the legacy functions) can change its speed.
+
+    totals = {}
+    for cell in reference_text.split("</td>")[:-1]:
+        (attrs, _, value) = cell.partition(">")
+        key = attrs.split('"')[1]
+        totals[key] = totals.get(key, 0) + int(value)
+    totals = sorted(totals.items())
+    return totals
+
+def time_call(func, arg, number):
+
+    # This function returns the mean time in seconds of a single call.
+
+    seconds = timeit.timeit(lambda: func(arg), number = number) / number
+    return seconds
+
+def benchmark_classifier(number = 200):
+
+    # This function times the page classifier against the legacy version on
+    # every fixture, checks that both agree, and returns a list of result rows.
+
+    rows = []
+    for name in fixtures.fixture_functions:
+        html = fixtures.load_fixture(name)
+        soup = page.get_game_soup(html)
+        legacy_source = legacy_get_source(soup)
+        source = page.get_source(html)
+        rows.append({
+            "fixture": name, "source": source, "agrees": (source == legacy_source),
+            "legacy": time_call(legacy_get_source, soup, number),
+            "current": time_call(page.get_source, html, number)
+        })
+    return rows
+
+def print_classifier_results(rows):
+
+    # This function prints the results of 'benchmark_classifier' as a table.
+
+    print(f"{'fixture':<26}{'source':<16}{'agrees':<8}{'legacy (us)':>12}{'current (us)':>14}{'speedup':>9}")
+    for row in rows:
+        speedup = row["legacy"] / row["current"]
+        print(
+            f"{row['fixture']:<26}{str(row['source']):<16}{str(row['agrees']):<8}"
+            f"{row['legacy'] * 1e6:>12.1f}{row['current'] * 1e6:>14.1f}{speedup:>8.1f}x"
+        )
+
+def get_parser_cases():
+
+    # This function returns a (label, function, arguments) case for every public
+    # function of the four parser modules, along with 'page.get_source' (which
+    # replaced the driver's 'get_source'). Page parsers are run on each fixture
+    # that they apply to, and the helpers that take part of a page are passed
+    # the part that their callers would pass.
+
+    cases = []
+    for name in fixtures.fixture_functions:
+        html = fixtures.load_fixture(name)
+        soup = page.get_game_soup(html)
+        cases.append((f"page.get_source [{name}]", page.get_source, (html,)))
+        functions = list(fixtures.fixture_functions[name])
+        if fixtures.fixture_functions[name] is fixtures.fight_functions:
+            functions += [fight_parser.get_fight_info, fight_parser.get_combat_tables]
+        for func in functions:
+            module_name = func.__module__.split(".")[-1]
+            cases.append((f"{module_name}.{func.__name__} [{name}]", func, (soup,)))
+        if fixtures.fixture_functions[name] is fixtures.fight_functions:
+            tables = fight_parser.get_combat_tables(soup)
+            enemy_rows = tables[0].tbody.find_all("tr", recursive = False)
+            player_rows = tables[-1].tbody.find_all("tr", recursive = False)
+            action_table = soup.select('table[width="100%"]')[0]
+            cases += [
+                (f"fight_parser.parse_enemy_id_row [{name}]", fight_parser.parse_enemy_id_row, (enemy_rows[0],)),
+                (f"fight_parser.parse_enemy_rows [{name}]", fight_parser.parse_enemy_rows, (enemy_rows,)),
+                (f"fight_parser.parse_player_rows [{name}]", fight_parser.parse_player_rows, (player_rows,)),
+                (f"fight_parser.parse_potion_table [{name}]", fight_parser.parse_potion_table, (action_table,)),
+                (f"fight_parser.parse_ability_table [{name}]", fight_parser.parse_ability_table, (action_table,))
+            ]
+        if explore_parser.get_local_map in functions:
+            td_tag = soup.select('td:has(> div > img[src^="//images.neopets.com/nq2/t/"])')[0]
+            cases.append((f"explore_parser.parse_coord_attrs [{name}]", explore_parser.parse_coord_attrs, (td_tag,)))
+    for (func, args) in lookup_calls:
+        module_name = func.__module__.split(".")[-1]
+        cases.append((f"{module_name}.{func.__name__}", func, args))
+    return cases
+
+def make_timer(func, args):
+
+    # This function returns a timer for 'func(*args)' along with the number
+    # of calls that takes about the length of a timing run, found by
+    # timing ten times as many calls until they take a tenth of it.
+
+    timer = timeit.Timer(lambda: func(*args))
+    (number, seconds) = (1, timer.timeit(1))
+    while seconds < benchmark_settings["run_time"] / 10:
+        number *= 10
+        seconds = timer.timeit(number)
+    number = max(1, round(number * benchmark_settings["run_time"] / seconds))
+    return (timer, number)
+
+def measure_peak(func, args):
+
+    # This function returns the peak memory allocated during a single call
+    # of 'func(*args)', in bytes (from tracemalloc).
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func(*args)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def get_noise(samples):
+
+    # This function returns the standard error of the median of several timing
+    # runs, as a fraction of the median. The spread is measured with the median
+    # absolute deviation, so that a single disturbed run does not dominate it,
+    # and scaled to a standard deviation as if the runs were normal.
+
+    median = statistics.median(samples)
+    deviation = 1.4826 * statistics.median([abs(sample - median) for sample in samples])
+    noise = 1.2533 * deviation / (median * len(samples) ** 0.5)
+    return noise
+
+def is_regression(ops, noise, base_ops, base_noise):
+
+    # This function returns true if the median calls per second have dropped
+    # by more than the tolerance, and by more than the noise factor times the
+    # combined standard error of the current and baseline medians.
+
+    slowdown = 1 - ops / base_ops
+    threshold = max(
+        benchmark_settings["tolerance"],
+        benchmark_settings["noise_factor"] * (noise ** 2 + base_noise ** 2) ** 0.5
+    )
+    check = (slowdown > threshold)
+    return check
+
+def time_parser_cases(run_time, repeats):
+
+    # This function is the body of a timing process. It returns the calls per
+    # second of every parser case and of the reference workload in each of
+    # 'repeats' timing runs, timing each case once per round rather than all
+    # of its runs in a row. The settings are passed in, since the process
+    # imports this module afresh.
+
+    benchmark_settings["run_time"] = run_time
+    cases = get_parser_cases() + [(reference_label, run_reference, ())]
+    timers = [make_timer(func, args) for (_, func, args) in cases]
+    samples = {label: [] for (label, _, _) in cases}
+    for _ in range(repeats):
+        for ((label, _, _), (timer, number)) in zip(cases, timers):
+            samples[label].append(number / timer.timeit(number))
+    return samples
+
+def benchmark_parsers(baseline = None):
+
+    # This function measures every parser case and returns a list of result
+    # rows, holding the median calls per second over the timing runs of every
+    # process and its standard error (see 'get_noise'). If a baseline (as saved
+    # by 'save_baseline') is passed, each row also holds the baseline's calls
+    # per second, the change against it once the machine's change in speed
+    # is removed, and whether the case regressed. The machine's speed is that
+    # of the reference workload, as a fraction of its speed for the baseline,
+    # and is returned along with the rows and a row for the reference itself.
+
+    cases = get_parser_cases()
+    samples = {label: [] for label in [label for (label, _, _) in cases] + [reference_label]}
+    context = multiprocessing.get_context("spawn")
+    for _ in range(benchmark_settings["processes"]):
+        with ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+            process_samples = executor.submit(
+                time_parser_cases, benchmark_settings["run_time"], benchmark_settings["repeats"]
+            ).result()
+        for (label, case_samples) in process_samples.items():
+            samples[label].extend(case_samples)
+    rows = []
+    for (label, func, args) in cases + [(reference_label, run_reference, ())]:
+        base = ((baseline or {}).get(label) or {})
+        rows.append({
+            "case": label, "ops": statistics.median(samples[label]), "noise": get_noise(samples[label]),
+            "peak": measure_peak(func, args), "baseline": base.get("ops"), "base_noise": base.get("noise", 0),
+            "change": None, "regressed": False
+        })
+    reference = rows.pop()
+    if reference["baseline"] is not None:
+        speed = reference["ops"] / reference["baseline"]
+        reference["change"] = speed - 1
+    else:
+        speed = 1
+    for row in rows:
+        if row["baseline"] is not None:
+            row["change"] = row["ops"] / (row["baseline"] * speed) - 1
+            row["regressed"] = is_regression( # The reference's noise carries into the scaled baseline
+                row["ops"] / speed, row["noise"], row["baseline"],
+                (row["base_noise"] ** 2 + reference["noise"] ** 2 + reference["base_noise"] ** 2) ** 0.5
+            )
+    return (rows, reference, speed)
+
+def print_parser_results(rows):
+
+    # This function prints the results of 'benchmark_parsers' as a table.
+
+    width = max(len(row["case"]) for row in rows) + 2
+    print(f"{'case':<{width}}{'ops/sec':>12}{'noise':>8}{'peak (KiB)':>12}{'baseline':>12}{'change':>9}")
+    for row in rows:
+        if row["baseline"] is None:
+            (baseline, change) = ("", "")
+        else:
+            baseline = f"{row['baseline']:.0f}"
+            change = f"{row['change']:+.0%}" + (" !" if row["regressed"] else "")
+        print(
+            f"{row['case']:<{width}}{row['ops']:>12.0f}{row['noise']:>8.1%}"
+            f"{row['peak'] / 1024:>12.1f}{baseline:>12}{change:>9}"
+        )
+
+def load_baseline(path):
+
+    # This function returns the saved baseline, or None if there is none.
+
+    try:
+        with open(path, "r", encoding = "utf-8") as target:
+            baseline = json.load(target)
+    except FileNotFoundError:
+        baseline = None
+    return baseline
+
+def save_baseline(rows, reference, path):
+
+    # This function writes the parser timings to 'path' as a JSON object that
+    # maps each case label (and the reference label, for the reference
+    # workload) to an object holding its median calls per second ("ops"), the
+    # standard error of that median as a fraction of it ("noise") and the
+    # peak memory of a call in bytes ("peak").
+
+    baseline = {row["case"]: {"ops": row["ops"], "noise": row["noise"], "peak": row["peak"]} for row in rows + [reference]}
+    with open(path, "w", encoding = "utf-8") as target:
+        json.dump(baseline, target, indent = 2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the page classifier and parsers on the fixtures")
+    parser.add_argument("--baseline", default = str(benchmark_settings["baseline"]))
+    parser.add_argument("--save", action = "store_true", help = "Store these parser timings as the baseline")
+    parser.add_argument("--tolerance", type = float, default = benchmark_settings["tolerance"])
+    args = parser.parse_args()
+    benchmark_settings["tolerance"] = args.tolerance
+    print_classifier_results(benchmark_classifier())
+    print()
+    (rows, reference, speed) = benchmark_parsers(None if args.save else load_baseline(args.baseline))
+    print_parser_results(rows + [reference])
+    if reference["baseline"] is not None:
+        print(f"The machine ran at {speed:.0%} of its baseline speed, which the changes are corrected for.")
+    elif any(row["baseline"] is not None for row in rows):
+        print("The baseline has no reference timing, so the changes are not corrected for the machine's speed.")
+    if args.save:
+        save_baseline(rows, reference, args.baseline)
+        print(f"Saved the baseline to {args.baseline}")
+    regressions = [row["case"] for row in rows if row["regressed"]]
+    if regressions:
+        raise SystemExit(f"{len(regressions)} parser cases are slower than the baseline.")
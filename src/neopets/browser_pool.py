@@ -0,0 +1,256 @@
+import queue
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.support.wait import WebDriverWait
+
+from . import http_driver
+from .neo_driver import game_url, extract_game_div
+
+# This module keeps logged-in Firefox instances ready for use. A persistent
+# "template" profile holds the installed extensions, and a cookie file saved
+# after one manual login restores the Neopets session, so new browsers can be
+# started without any user input. The BrowserPool starts several of them ahead
+# of time, hands them out to runners, and replaces any that stop responding.
+# 'main.py' runs the game on a pool when the 'browsers' config key is set.
+
+addon_marker = ".nq2_addons" # File written in a profile once its extensions are installed
+
+def make_firefox(game_url = game_url, profile_dir = None, headless = True, addon_path = None):
+
+    # This function starts Firefox with the same options as 'main.get_firefox'. If
+    # 'profile_dir' is passed, a private copy of that profile is used, since Firefox
+    # cannot share one profile between instances. The extension at 'addon_path' is
+    # only installed if the profile does not already have it, and the result is
+    # written back to the template profile so later instances skip the install.
+
+    options = Options()
+    options.page_load_strategy = "none"
+    if headless:
+        options.add_argument("-headless")
+    copy_dir = None
+    if profile_dir is not None:
+        Path(profile_dir).mkdir(parents = True, exist_ok = True)
+        copy_dir = tempfile.mkdtemp(prefix = "nq2_profile_")
+        shutil.copytree(
+            profile_dir, copy_dir, dirs_exist_ok = True,
+            ignore = shutil.ignore_patterns("lock", ".parentlock", "parent.lock")
+        )
+        options.add_argument("-profile")
+        options.add_argument(copy_dir)
+    driver = webdriver.Firefox(options = options)
+    driver.profile_copy = copy_dir
+    if addon_path is not None and not (copy_dir and (Path(copy_dir) / addon_marker).exists()):
+        try:
+            driver.install_addon(addon_path)
+            if profile_dir is not None:
+                save_profile(driver, profile_dir)
+        except WebDriverException:
+            pass
+    driver.get(game_url)
+    return driver
+
+def save_profile(selenium_driver, profile_dir):
+
+    # This function copies the extensions of a running instance's profile back
+    # to the template profile and marks it as having its extensions installed.
+
+    copy_dir = getattr(selenium_driver, "profile_copy", None)
+    if copy_dir is not None and (Path(copy_dir) / "extensions").exists():
+        shutil.copytree(Path(copy_dir) / "extensions", Path(profile_dir) / "extensions", dirs_exist_ok = True)
+        for name in ["extensions.json", "addonStartup.json.lz4", "prefs.js"]:
+            if (Path(copy_dir) / name).exists():
+                shutil.copy(Path(copy_dir) / name, Path(profile_dir) / name)
+    (Path(profile_dir) / addon_marker).touch()
+
+def restore_session(selenium_driver, cookie_path, game_url = game_url, timeout = 20):
+
+    # This function loads saved cookies (see 'http_driver.save_cookies') into the
+    # browser and reloads the game page, returning true if the game appears within
+    # 'timeout' seconds. Cookies can only be set for the domain of the current page,
+    # so the game page must be loaded first. Since the browser does not wait for
+    # page loads (see 'make_firefox'), the cookies are only added once the browser
+    # is on the game's site, and cookies saved for other sites are skipped.
+
+    if cookie_path is None or not Path(cookie_path).exists():
+        return False
+    (cookies, _) = http_driver.load_cookies(cookie_path)
+    selenium_driver.get(game_url)
+    wait = WebDriverWait(selenium_driver, timeout, poll_frequency = 0.1)
+    try:
+        wait.until(lambda driver: is_same_site(driver.current_url, game_url))
+    except TimeoutException:
+        return False
+    for cookie in cookies:
+        if is_cookie_for(cookie, game_url):
+            selenium_driver.add_cookie({key: value for (key, value) in cookie.items() if key != "sameSite"})
+    selenium_driver.get(game_url)
+    try:
+        restored = wait.until(is_logged_in)
+    except TimeoutException:
+        restored = False
+    return restored
+
+def is_same_site(url, game_url):
+
+    # This function returns true if 'url' has the scheme and host of 'game_url'.
+
+    (parts, game_parts) = (urlsplit(url), urlsplit(game_url))
+    check = (parts.scheme, parts.netloc) == (game_parts.scheme, game_parts.netloc)
+    return check
+
+def is_cookie_for(cookie, game_url):
+
+    # This function returns true if the browser will accept the cookie on
+    # the game page, which is when its domain is the game's host or one of
+    # the host's parent domains.
+
+    host = urlsplit(game_url).hostname
+    domain = cookie.get("domain", host).lstrip(".")
+    check = (host == domain or host.endswith(f".{domain}"))
+    return check
+
+def save_session(selenium_driver, cookie_path):
+
+    # This function saves the cookies of a logged-in browser, so that later
+    # browsers (and HttpDrivers) can restore the session.
+
+    (cookies, user_agent) = http_driver.get_browser_cookies(selenium_driver)
+    http_driver.save_cookies(cookies, user_agent, cookie_path)
+
+def is_logged_in(selenium_driver):
+
+    # This function returns true if the current page shows the game, which
+    # only happens when the session is logged in.
+
+    try:
+        logged_in = extract_game_div(selenium_driver.page_source) is not None
+    except WebDriverException:
+        logged_in = False
+    return logged_in
+
+def is_responsive(selenium_driver):
+
+    # This function returns true if the browser still answers commands.
+
+    try:
+        selenium_driver.execute_script("return 1;")
+        responsive = True
+    except WebDriverException:
+        responsive = False
+    return responsive
+
+def close_firefox(selenium_driver):
+
+    # This function quits a browser and deletes its private profile copy.
+
+    try:
+        selenium_driver.quit()
+    except WebDriverException:
+        pass
+    copy_dir = getattr(selenium_driver, "profile_copy", None)
+    if copy_dir is not None:
+        shutil.rmtree(copy_dir, ignore_errors = True)
+
+class BrowserPool():
+
+    # This class holds a set of pre-started, logged-in browsers. Runners take one
+    # with 'acquire' and give it back with 'release'. A browser that has stopped
+    # responding is not handed out again: it is closed and a replacement is started
+    # in the background, so the pool stays at its full size without restarting
+    # the process.
+
+    def __init__(self, size, profile_dir, cookie_path, game_url = game_url, headless = True, addon_path = None):
+        self.size = size
+        self.options = {
+            "game_url": game_url, "profile_dir": profile_dir,
+            "headless": headless, "addon_path": addon_path
+        }
+        self.cookie_path = cookie_path
+        self.game_url = game_url
+        self.idle = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers = size)
+        self.closed = False
+
+    def start(self):
+
+        # This method starts every browser in parallel and waits for them.
+
+        futures = [self.executor.submit(self._add_browser) for _ in range(self.size)]
+        for future in futures:
+            future.result()
+
+    def acquire(self, timeout = None):
+
+        # This method returns a healthy, logged-in browser, waiting for one to
+        # become available if they are all in use or still starting. Browsers
+        # that have crashed are recycled, while a RuntimeError is raised if the
+        # saved session itself has expired or a browser could not be started,
+        # since no new browser would fix that.
+
+        while True:
+            browser = self.idle.get(timeout = timeout)
+            if isinstance(browser, Exception):
+                raise RuntimeError("A browser for the pool could not be started.") from browser
+            if not is_responsive(browser):
+                self.recycle(browser)
+            elif is_logged_in(browser) or restore_session(browser, self.cookie_path, self.game_url):
+                return browser
+            else:
+                self.release(browser)
+                raise RuntimeError("The saved Neopets session has expired.")
+
+    def release(self, browser):
+
+        # This method returns a browser to the pool.
+
+        if self.closed:
+            close_firefox(browser)
+        else:
+            self.idle.put(browser)
+
+    def recycle(self, browser):
+
+        # This method closes a broken browser and starts a replacement.
+
+        close_firefox(browser)
+        if not self.closed:
+            self.executor.submit(self._add_browser)
+
+    def close(self):
+
+        # This method closes every idle browser and stops the pool. Browsers
+        # still in use are closed when they are released.
+
+        self.closed = True
+        self.executor.shutdown(wait = True)
+        while not self.idle.empty():
+            browser = self.idle.get()
+            if not isinstance(browser, Exception):
+                close_firefox(browser)
+
+    def _add_browser(self):
+
+        # This internal method starts a browser, restores the saved session
+        # and adds it to the idle queue. If the browser cannot be started or the
+        # cookies are refused, the error is queued in its place, so that 'acquire'
+        # raises it rather than waiting on a browser that will never arrive.
+
+        try:
+            browser = make_firefox(**self.options)
+        except WebDriverException as error:
+            self.idle.put(error)
+            return
+        try:
+            restore_session(browser, self.cookie_path, self.game_url)
+        except WebDriverException as error:
+            close_firefox(browser)
+            self.idle.put(error)
+            return
+        self.release(browser)
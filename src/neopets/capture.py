@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import struct
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+import zstandard
+
+from . import page as page_module
+from .neo_driver import Driver, DriverFailure, game_url
+
+# This module archives the raw game pages loaded by a driver, and plays them back.
+# When a CaptureWriter is set as a driver's 'capture' attribute, every game div
+# that the driver loads (and every page it prefetches) is appended to the archive
+# along with the action that produced it and when it arrived. Since the pages are
+# highly repetitive, each record is compressed on its own with zstd using a
+# dictionary trained on the first pages of the archive, which keeps the file
+# append-only while compressing nearly as well as one large stream. The
+# ReplayDriver feeds an archive back through the Page class and the parsers, for
+# parser regression checks and benchmarks on real sessions. It requires the
+# optional 'zstandard' package.
+
+capture_settings = {
+    "training_records": 500, # Pages recorded before the dictionary of a new archive is trained
+    "dict_size": 112640, # Maximum size of the trained dictionary in bytes
+    "level": 10 # zstd compression level
+}
+
+archive_magic = b"NQ2CAPTURE2\n" # First bytes of every archive
+
+frame_header = struct.Struct(">cI") # Type and length prefix of each frame in the archive
+
+frame_types = {"dictionary": b"D", "record": b"R"} # Frame type bytes
+
+class CaptureWriter():
+
+    # This class appends records to an archive, which consists of the magic
+    # bytes followed by a sequence of frames. Each record frame is compressed
+    # with the dictionary in the last dictionary frame before it, or without
+    # one if there is none. Every record is written as soon as it is added:
+    # the first records of a new archive are compressed without a dictionary,
+    # and are also kept in memory until there are enough to train one, after
+    # which a dictionary frame is written and used for the rest of the archive.
+    # An existing archive is appended to with its last dictionary, after
+    # cutting off any frame that a crash left unfinished at its end.
+
+    def __init__(self, path):
+        self.path = path
+        self.samples = []
+        dict_data = None
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            end = len(archive_magic)
+            for (frame_type, data, end) in read_frames(path):
+                if frame_type == frame_types["dictionary"]:
+                    dict_data = data
+            if end < os.path.getsize(path):
+                with open(path, "r+b") as target:
+                    target.truncate(end)
+        else:
+            with open(path, "wb") as target:
+                target.write(archive_magic)
+        self.trained = (dict_data is not None)
+        self.target = open(path, "ab")
+        self._set_dictionary(dict_data)
+
+    def add(self, html, action = None, wait = None):
+
+        # This method records a page. The 'action' is the (function, arguments)
+        # pair that loaded it, or ("prefetch", [url]) for a prefetched page,
+        # and 'wait' is the number of seconds spent waiting on it.
+
+        (func, args) = (action if action is not None else (None, []))
+        record = {
+            "time": time.time(), "wait": wait,
+            "call": (func if isinstance(func, str) or func is None else getattr(func, "__name__", str(func))),
+            "args": list(args), "html": html
+        }
+        data = json.dumps(record, default = str).encode("utf-8")
+        self._write(frame_types["record"], self.compressor.compress(data))
+        if not self.trained:
+            self.samples.append(data)
+            if len(self.samples) >= capture_settings["training_records"]:
+                self._train()
+
+    def close(self):
+        self.target.close()
+
+    def _train(self):
+
+        # This internal method trains the dictionary on the records seen so far
+        # and writes it to the archive. Records that are too uniform cannot be
+        # trained on, in which case the archive continues without a dictionary.
+
+        self.trained = True
+        try:
+            dict_data = zstandard.train_dictionary(capture_settings["dict_size"], self.samples).as_bytes()
+        except zstandard.ZstdError:
+            dict_data = None
+        self.samples = []
+        if dict_data:
+            self._write(frame_types["dictionary"], dict_data)
+            self._set_dictionary(dict_data)
+
+    def _set_dictionary(self, dict_data):
+        dictionary = (zstandard.ZstdCompressionDict(dict_data) if dict_data else None)
+        self.compressor = zstandard.ZstdCompressor(level = capture_settings["level"], dict_data = dictionary)
+
+    def _write(self, frame_type, data):
+        self.target.write(frame_header.pack(frame_type, len(data)) + data)
+        self.target.flush() # A crash loses at most the frame being written, which is cut off on reopening
+
+class ReplayDriver(Driver):
+
+    # This class has the same public methods as Driver, but every page load
+    # returns the next page of an archive instead of contacting the site, so
+    # the parsers, the Page cache and the driver's bookkeeping all run on the
+    # captured session. Each load is checked against the action recorded with
+    # the page (see 'is_match'), and a DriverFailure is raised as soon as they
+    # differ, so that a replay stops rather than running out of step with the
+    # archive. URLs are compared by their query string only, so the archive
+    # can be replayed with any 'game_url'. The record behind the current page
+    # is kept in 'record'.
+
+    def __init__(self, path, flag = None, game_url = game_url):
+        super().__init__(None, flag, game_url = game_url)
+        self.records = read_archive(path)
+        self.record = None
+        self.pending = None # Record read ahead of the current one
+
+    def choose_target(self, target_id):
+        pass
+
+    def quit(self):
+        pass
+
+    def _load(self, url, safe_url):
+        self._do_action("load", [url], safe_url)
+
+    def _submit_move(self, direction_id):
+        self._do_action("move", [direction_id], self.game_url)
+
+    def _submit_fight_action(self, action_id, parm = None, item = None):
+        self._do_action("fight", [action_id], self.game_url)
+
+    def _fight_return(self):
+        pass
+
+    def _fetch_pages(self, urls):
+
+        # This internal method returns the prefetched pages that were captured
+        # after the current one, matched to the passed URLs by query string.
+
+        htmls = {}
+        while True:
+            record = self._peek()
+            if record is None or record["call"] != "prefetch":
+                break
+            htmls[get_query(record["args"][0])] = record["html"]
+            self.pending = None
+        htmls = [htmls.get(get_query(url)) for url in urls]
+        return htmls
+
+    def _do_action(self, func, args, safe_url):
+
+        # This internal method makes the next captured page (skipping any
+        # prefetched pages that were not asked for) the current one, after
+        # checking that it was loaded by the same action. The 'func' is one
+        # of the action kinds of 'is_match', or the driver method it names.
+
+        while True:
+            record = self._peek()
+            if record is None:
+                raise DriverFailure("The capture has no more pages.")
+            self.pending = None
+            if record["call"] != "prefetch":
+                break
+        kind = (func if isinstance(func, str) else func.__name__)
+        value = (args[0] if args else None)
+        if not is_match(record, kind, value):
+            raise DriverFailure(
+                f"The replay left the capture: expected {kind} {value!r}, "
+                f"found {record['call']} {record['args']!r}."
+            )
+        self.record = record
+        self._set_page(record["html"])
+
+    def _peek(self):
+        if self.pending is None:
+            self.pending = next(self.records, None)
+        return self.pending
+
+def is_match(record, kind, value):
+
+    # This function returns true if the passed record was loaded by the
+    # requested action, whichever driver captured it. The kinds are "load"
+    # (a GET of the URL 'value'), "move" and "fight" (a form submission with
+    # the direction or action ID 'value'), or the name of a driver method
+    # that was passed to '_do_action' directly.
+
+    (call, args) = (record["call"], record["args"])
+    if kind == "load":
+        check = (call in {"get", "_get"} and get_query(args[0]) == get_query(value))
+    elif kind in {"move", "fight"}:
+        (field, script) = (("dir", "dosub({})") if kind == "move" else ("fact", "setaction({})"))
+        if call == "_post":
+            check = (str(args[1].get(field)) == str(value))
+        else:
+            check = (call == "execute_script" and script.format(value) in args[0])
+    else:
+        check = (call == kind)
+    return check
+
+def get_query(url):
+    query = urlsplit(url).query
+    return query
+
+def read_frames(path):
+
+    # This function yields the (type, data, end) frames of an archive in order,
+    # where 'end' is the offset just past the frame, stopping at a frame that
+    # was cut short (such as by a crash while writing).
+
+    with open(path, "rb") as source:
+        if source.read(len(archive_magic)) != archive_magic:
+            raise ValueError("Not a page capture archive.")
+        while True:
+            header = source.read(frame_header.size)
+            if len(header) < frame_header.size:
+                break
+            (frame_type, size) = frame_header.unpack(header)
+            data = source.read(size)
+            if len(data) < size:
+                break
+            yield (frame_type, data, source.tell())
+
+def read_archive(path):
+
+    # This function yields the records of an archive in order, decompressing
+    # each with the dictionary in effect where it was written.
+
+    decompressor = zstandard.ZstdDecompressor()
+    for (frame_type, data, _) in read_frames(path):
+        if frame_type == frame_types["dictionary"]:
+            decompressor = zstandard.ZstdDecompressor(dict_data = zstandard.ZstdCompressionDict(data))
+        else:
+            record = json.loads(decompressor.decompress(data))
+            yield record
+
+def parse_record(record):
+
+    # This function runs every parser that applies to the record's page,
+    # returning its type and a dictionary of the extracted fields.
+
+    page = page_module.Page(record["html"])
+    fields = {field: page.get(field) for field in page_module.field_extractors.get(page.kind, {})}
+    return (page.source, fields)
+
+def check_archive(path, reference = None):
+
+    # This function parses every page in an archive and returns the results
+    # as a list of [source, fields] pairs (made JSON-compatible), along with
+    # the indices of the records whose results differ from the passed
+    # reference list, such as one saved from an earlier version of the parsers.
+
+    results = []
+    for record in read_archive(path):
+        (source, fields) = parse_record(record)
+        results.append([source, to_json(fields)])
+    differences = [
+        i for (i, result) in enumerate(results)
+        if reference is not None and (i >= len(reference) or reference[i] != result)
+    ]
+    return (results, differences)
+
+def check_crash_recovery(cut = 5):
+
+    # This function checks that an archive survives a crash while a frame was
+    # being written: records are added, 'cut' bytes are removed from the end
+    # of the archive, and more records are added after reopening it. It returns
+    # true if every record but the damaged one reads back in order.
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "crash.nq2")
+        writer = CaptureWriter(path)
+        for i in range(3):
+            writer.add(f"<div>page {i}</div>", ("get", [f"{game_url}?page={i}"]))
+        writer.close()
+        with open(path, "r+b") as target:
+            target.truncate(os.path.getsize(path) - cut)
+        writer = CaptureWriter(path)
+        for i in range(3, 6):
+            writer.add(f"<div>page {i}</div>", ("get", [f"{game_url}?page={i}"]))
+        writer.close()
+        htmls = [record["html"] for record in read_archive(path)]
+    check = (htmls == [f"<div>page {i}</div>" for i in [0, 1, 3, 4, 5]])
+    return check
+
+def to_json(value):
+
+    # This function converts parser output into the values it would have after
+    # a round trip through JSON, so that results can be compared with saved ones.
+
+    if isinstance(value, dict):
+        value = {(str(key) if not isinstance(key, tuple) else "|".join(map(str, key))): to_json(item) for (key, item) in value.items()}
+    elif isinstance(value, (list, tuple)):
+        value = [to_json(item) for item in value]
+    elif isinstance(value, set):
+        value = sorted((to_json(item) for item in value), key = str)
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Summarize and check a page capture archive")
+    parser.add_argument("archive", nargs = "?")
+    parser.add_argument("--save", help = "Write the parser results to this JSON file")
+    parser.add_argument("--check", help = "Compare the parser results with this JSON file")
+    parser.add_argument("--check-recovery", action = "store_true", help = "Check appending to an archive cut off by a crash")
+    args = parser.parse_args()
+    if args.check_recovery:
+        print(f"Crash recovery {'works' if check_crash_recovery() else 'FAILED'}.")
+    if args.archive is None:
+        raise SystemExit()
+    counts = {}
+    raw_size = 0
+    for record in read_archive(args.archive):
+        kind = ("prefetch" if record["call"] == "prefetch" else "action")
+        counts[kind] = counts.get(kind, 0) + 1
+        raw_size += len(record["html"].encode("utf-8"))
+    print(f"{sum(counts.values())} pages ({counts}), {raw_size} bytes of HTML in {os.path.getsize(args.archive)} bytes")
+    reference = None
+    if args.check:
+        with open(args.check, "r", encoding = "utf-8") as target:
+            reference = json.load(target)
+    start = time.perf_counter()
+    (results, differences) = check_archive(args.archive, reference)
+    seconds = time.perf_counter() - start
+    print(f"Parsed {len(results)} pages in {seconds:.2f}s ({len(results) / max(seconds, 1e-9):.0f} pages/s)")
+    if reference is not None:
+        print(f"{len(differences)} pages differ from {args.check}: {differences[:20]}")
+    if args.save:
+        with open(args.save, "w", encoding = "utf-8") as target:
+            json.dump(results, target)
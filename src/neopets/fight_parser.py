@@ -7,6 +7,51 @@ ability_ids = { # IDs for JavaScript ability commands
     "Battle Taunt": 9105
 }
 
+def get_fight_info(soup):
+
+    # This function extracts everything the auto-player needs from a fight page
+    # in a single walk of the combat table. The nested tables are located once by
+    # stepping through the rows of the outer table, and each of them is then read
+    # exactly once. The returned dictionary contains the players, enemies, enemy 
+    # IDs, potions, abilities, messages, elapsed time and whether the fight ended.
+
+    tables = get_combat_tables(soup)
+    enemy_rows = tables[0].tbody.find_all("tr", recursive = False)
+    player_rows = tables[-1].tbody.find_all("tr", recursive = False)
+    action_table = None
+    message_cell = None
+    for table_tag in tables:
+        if action_table is None and table_tag.get("width") == "100%":
+            action_table = table_tag
+        if message_cell is None:
+            message_cell = table_tag.find("td", width = "*")
+    fight_dict = {
+        "players": parse_player_rows(player_rows),
+        "enemies": parse_enemy_rows(enemy_rows),
+        "enemy_ids": parse_enemy_id_row(enemy_rows[0]),
+        "elapsed_time": list(player_rows[-1].stripped_strings)[-1],
+        "potions": parse_potion_table(action_table),
+        "abilities": parse_ability_table(action_table),
+        "messages": " ".join(message_cell.stripped_strings),
+        "ended": is_ended(soup)
+    }
+    return fight_dict
+
+def get_combat_tables(soup):
+
+    # This function returns the tables nested directly inside the rows of the
+    # outer combat table, in page order. The first holds the enemies and the
+    # last holds the party members.
+
+    outer_table = soup.find("center").find("table", recursive = False)
+    tables = []
+    for row in outer_table.tbody.find_all("tr", recursive = False):
+        cell = row.find("td", recursive = False)
+        table_tag = (cell.find("table", recursive = False) if cell else None)
+        if table_tag is not None and table_tag.tbody is not None:
+            tables.append(table_tag)
+    return tables
+
 def get_elapsed_time(soup):
 
     # This function extracts the amount of time that has elepased in
@@ -22,9 +67,7 @@ def get_enemy_ids(soup):
 
     table_tag = soup.select("center > table > tbody > tr > td > table > tbody")[0]
     img_row = table_tag.find("tr", recursive = False)
-    enemy_profiles = img_row.select("div")
-    enemy_ids = [([""] + [tag["name"][-1] for tag in pr.select("img[name]")])[-1]
-                 for pr in enemy_profiles]
+    enemy_ids = parse_enemy_id_row(img_row)
     return enemy_ids
 
 def get_enemy_stats(soup):
@@ -34,8 +77,34 @@ def get_enemy_stats(soup):
 
     table_tag = soup.select("center > table > tbody > tr > td > table > tbody")[0]
     rows = table_tag.find_all("tr", recursive = False)
+    enemy_dict = parse_enemy_rows(rows)
+    return enemy_dict
+
+def get_player_stats(soup):
+
+    # This function extracts the name, hitpoints, buffs, and time until next move 
+    # for each party member.
+
+    table_tag = soup.select("center > table > tbody > tr > td > table > tbody")[-1]
+    rows = table_tag.find_all("tr", recursive = False)
+    player_dict = parse_player_rows(rows)
+    return player_dict
+
+def parse_enemy_id_row(img_row):
+
+    # This function extracts the enemy IDs from the row of enemy images.
+
+    enemy_profiles = img_row.find_all("div")
+    enemy_ids = [([""] + [tag["name"][-1] for tag in pr.find_all("img", attrs = {"name": True})])[-1]
+                 for pr in enemy_profiles]
+    return enemy_ids
+
+def parse_enemy_rows(rows):
+
+    # This function extracts the enemy stats from the rows of the enemy table.
+
     enemy_names = list(rows[2].stripped_strings)
-    enemy_cells = rows[4].select('td[valign="top"][align="center"]')
+    enemy_cells = rows[4].find_all("td", attrs = {"valign": "top", "align": "center"})
     stat_strings = [list(tag.stripped_strings) for tag in enemy_cells]
     curr_hitpoints = [strings[0].split("/")[0] for strings in stat_strings]
     max_hitpoints = [strings[0].split("/")[1] for strings in stat_strings]
@@ -53,18 +122,16 @@ def get_enemy_stats(soup):
         }
     return enemy_dict
 
-def get_player_stats(soup):
+def parse_player_rows(rows):
 
-    # This function extracts the name, hitpoints, buffs, and time until next move 
-    # for each party member.
+    # This function extracts the party member stats from the rows of the
+    # party table.
 
-    table_tag = soup.select("center > table > tbody > tr > td > table > tbody")[-1]
-    rows = table_tag.find_all("tr", recursive = False)
     name_health_strings = list(rows[0].stripped_strings)
     player_names = name_health_strings[::2]
     curr_health = [string.split("/")[0] for string in name_health_strings[1::2]]
     max_health = [string.split("/")[1] for string in name_health_strings[1::2]]
-    time_status_tags = rows[3].select('td[valign="top"][align="center"]')
+    time_status_tags = rows[3].find_all("td", attrs = {"valign": "top", "align": "center"})
     time_status_strings = [list(tag.stripped_strings) for tag in time_status_tags]
     time_strings_raw = [([""] + [time for time in strings[:2] if " sec" in time or time == "now"])[-1]
                         for strings in time_status_strings]
@@ -85,11 +152,8 @@ def get_potions(soup):
     # This function extracts the type and quantity of potions available 
     # during combat.
 
-    potion_dict = {}
     potion_table = soup.select('table[width="100%"]')[0]
-    potion_strings = list(potion_table.tbody.tr.td.stripped_strings)
-    for (quant, name) in zip(potion_strings[::5], potion_strings[1::5]):
-        potion_dict[name] = quant
+    potion_dict = parse_potion_table(potion_table)
     return potion_dict
 
 def get_abilities(soup):
@@ -97,10 +161,27 @@ def get_abilities(soup):
     # This function extracts the abilities available to a character during
     # their turn.
 
-    abilities_list = []
     ability_table = soup.select('table[width="100%"]')[0]
+    abilities_list = parse_ability_table(ability_table)
+    return abilities_list
+
+def parse_potion_table(potion_table):
+
+    # This function extracts the potions from the combat action table.
+
+    potion_dict = {}
+    potion_strings = list(potion_table.tbody.tr.td.stripped_strings)
+    for (quant, name) in zip(potion_strings[::5], potion_strings[1::5]):
+        potion_dict[name] = quant
+    return potion_dict
+
+def parse_ability_table(ability_table):
+
+    # This function extracts the abilities from the combat action table.
+
+    abilities_list = []
     ability_cell = ability_table.tbody.tr.find_all("td", recursive = False)[1]
-    for link_tag in ability_cell.select("a"):
+    for link_tag in ability_cell.find_all("a"):
         abilities_list.append(str(link_tag.string).strip())
     return abilities_list
 
@@ -113,6 +194,17 @@ def get_messages(soup):
     message_string = " ".join(message_cell.stripped_strings)
     return message_string
 
+def get_form_fields(soup):
+
+    # This function extracts the names and values of the hidden inputs
+    # that make up the combat form. The inputs are not always nested 
+    # inside the form tag, so every hidden input on the page is used.
+
+    fields = {}
+    for input_tag in soup.select('input[type="hidden"][name]'):
+        fields[input_tag["name"]] = input_tag.get("value", "")
+    return fields
+
 def get_end_message(soup):
 
     # This function extracts the message displayed at the end of the fight.
@@ -125,7 +217,7 @@ def is_ended(soup):
 
     # This function returns true if the fight has ended.
 
-    ended = bool(soup.select('img[src$="com_end.gif"]'))
+    ended = any(img_tag.get("src", "").endswith("com_end.gif") for img_tag in soup.find_all("img"))
     return ended
 
 def get_ability_id(ability_string):
@@ -0,0 +1,153 @@
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from . import explore_parser, fight_parser, inventory_parser, skills_parser, page as page_module
+
+# This module pairs the captured game pages in 'html/' with the parser functions
+# that apply to them. Running it as a script ('python -m src.neopets.fixtures')
+# performs a differential check of the driver's parsing pipeline: every parser is
+# run on the output of the original full-page 'html.parser' approach and on the
+# output of 'page.get_game_soup', and any difference in results is reported. The
+# pages in 'html/' were saved from a browser, so a few are also kept as the server
+# sends them (see 'raw_fixtures'), and must parse the same as their browser versions.
+
+html_dir = Path(__file__).resolve().parents[2] / "html"
+
+fight_functions = [
+    fight_parser.get_player_stats, fight_parser.get_enemy_stats, fight_parser.get_enemy_ids,
+    fight_parser.get_potions, fight_parser.get_abilities, fight_parser.get_messages,
+    fight_parser.get_elapsed_time, fight_parser.is_ended, fight_parser.get_form_fields
+]
+
+fixture_functions = { # Parser functions that apply to each captured page
+    "explore_source.html": [
+        explore_parser.get_area_name, explore_parser.get_location, explore_parser.get_travel_mode,
+        explore_parser.get_gold, explore_parser.get_character_info, explore_parser.get_local_map
+    ],
+    "fight_start_source.html": [],
+    "fight_source.html": fight_functions,
+    "enemy_status.html": fight_functions,
+    "player_status.html": fight_functions,
+    "fight_end_source.html": [fight_parser.get_end_message],
+    "inventory_source.html": [
+        inventory_parser.get_items, inventory_parser.get_character_info,
+        inventory_parser.get_unspent_points
+    ],
+    "skills_source.html": [skills_parser.get_unspent_points, skills_parser.get_skills]
+}
+
+raw_fixtures = { # Pages as the server sends them, without the browser's 'tbody' tags, and their browser captures
+    "fight_raw_source.html": "fight_source.html",
+    "explore_raw_source.html": "explore_source.html",
+    "inventory_raw_source.html": "inventory_source.html"
+}
+
+page_shell = """<html><head><title>Neopets</title></head><body>
+<div class="ad"><div>Advertisement</div></div>
+<div id="content">{}</div>
+<div class="footer"><div>Footer</div></div>
+</body></html>"""
+
+def load_fixture(name):
+
+    # This function returns the raw HTML of a captured game page.
+
+    html = (html_dir / name).read_text(encoding = "utf-8")
+    return html
+
+def load_page(name):
+
+    # This function returns a captured game div wrapped in a minimal
+    # Neopets page, as it would be served by the site.
+
+    page = page_shell.format(load_fixture(name))
+    return page
+
+def reference_soup(page):
+
+    # This function parses a full page the way the driver originally did,
+    # using 'html.parser' on the whole document.
+
+    soup = BeautifulSoup(page, "html.parser")
+    game_elements = soup.select(".contentModule.phpGamesNonPortalView")[0]
+    return game_elements
+
+def run_functions(functions, soup):
+
+    # This function runs each parser function on the passed soup, and
+    # records either its result or the exception it raised.
+
+    results = {}
+    for func in functions:
+        try:
+            results[func.__name__] = func(soup)
+        except Exception as error:
+            results[func.__name__] = repr(error)
+    return results
+
+def compare_parsers():
+
+    # This function runs the differential check over every fixture and
+    # returns a list of (fixture, function, reference, result) tuples for
+    # each output that differs from the reference pipeline.
+
+    differences = []
+    for (name, functions) in fixture_functions.items():
+        page = load_page(name)
+        reference = run_functions(functions, reference_soup(page))
+        candidate = run_functions(functions, page_module.get_game_soup(page))
+        for (func_name, ref_result) in reference.items():
+            if candidate[func_name] != ref_result:
+                differences.append((name, func_name, ref_result, candidate[func_name]))
+    return differences
+
+def compare_fight_info():
+
+    # This function checks that the one-pass fight extractor agrees with the
+    # individual fight parser functions on every fight fixture, returning
+    # differences in the same format as 'compare_parsers'.
+
+    fields = {
+        "players": fight_parser.get_player_stats, "enemies": fight_parser.get_enemy_stats,
+        "enemy_ids": fight_parser.get_enemy_ids, "elapsed_time": fight_parser.get_elapsed_time,
+        "potions": fight_parser.get_potions, "abilities": fight_parser.get_abilities,
+        "messages": fight_parser.get_messages, "ended": fight_parser.is_ended
+    }
+    differences = []
+    for (name, functions) in fixture_functions.items():
+        if functions is not fight_functions:
+            continue
+        soup = page_module.get_game_soup(load_page(name))
+        fight_dict = fight_parser.get_fight_info(soup)
+        for (field, func) in fields.items():
+            if fight_dict[field] != func(soup):
+                differences.append((name, f"get_fight_info[{field}]", func(soup), fight_dict[field]))
+    return differences
+
+def compare_raw_pages():
+
+    # This function checks that every parser gives the same results on the
+    # server's HTML of a page as on the browser's version of it, returning
+    # differences in the same format as 'compare_parsers'.
+
+    differences = []
+    for (name, browser_name) in raw_fixtures.items():
+        functions = fixture_functions[browser_name]
+        if functions is fight_functions:
+            functions = functions + [fight_parser.get_fight_info]
+        reference = run_functions(functions, page_module.get_game_soup(load_page(browser_name)))
+        candidate = run_functions(functions, page_module.get_game_soup(load_page(name)))
+        for (func_name, ref_result) in reference.items():
+            if candidate[func_name] != ref_result:
+                differences.append((name, func_name, ref_result, candidate[func_name]))
+    return differences
+
+if __name__ == "__main__":
+    differences = compare_parsers() + compare_fight_info() + compare_raw_pages()
+    print(f"Parser backend: {page_module.html_parser}")
+    for (name, func_name, ref_result, result) in differences:
+        print(f"{name} {func_name}:\n    expected {ref_result!r}\n    got      {result!r}")
+    if differences:
+        raise SystemExit(f"{len(differences)} parser differences found.")
+    print(f"No differences across {len(fixture_functions) + len(raw_fixtures)} fixtures.")
@@ -0,0 +1,249 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .neo_driver import Driver, game_url, extract_game_div
+
+# This module contains a browser-free alternative to the Selenium driver in
+# 'neo_driver.py'. Every game action boils down to a GET or a form post against
+# the main game page, so the HttpDriver sends those requests directly over a
+# pooled keep-alive HTTP session that reuses the cookies of a logged-in browser.
+
+class HttpDriver(Driver):
+
+    # This class has the same public methods as Driver, and keeps the same
+    # 'source' and 'soup' attributes, so it can be handed to a GameThread in
+    # its place. Only the transport layer is overridden: navigation becomes
+    # a GET request and the JavaScript form submissions become POST requests.
+
+    def __init__(self, flag, cookies = None, game_url = game_url, user_agent = None, pool_size = 4, timeout = 20):
+
+        # 'cookies' is a list of cookie dictionaries in the format returned by
+        # Selenium's 'get_cookies' (see 'get_browser_cookies'), 'user_agent'
+        # should match the browser that the cookies were taken from, and
+        # 'timeout' is the number of seconds to wait for any single request
+        # until enough requests have been timed to adapt it (see 'get_timeout').
+
+        super().__init__(None, flag, game_url = game_url)
+        self.session = make_session(cookies, user_agent, pool_size)
+        self.session.headers["Referer"] = game_url
+        self.default_timeout = timeout
+        self.target = None
+
+    def choose_target(self, target_id):
+
+        # This method chooses the specified target during combat. Since there
+        # is no page script to run, the target is stored and sent along with
+        # the next combat form.
+
+        id_mapping = self._get_enemy_id_map()
+        true_id = id_mapping[target_id]
+        self.target = true_id
+
+    def quit(self):
+
+        # This method closes all pooled connections.
+
+        self.session.close()
+
+    def _load(self, url, safe_url):
+
+        # This internal method performs a GET request for the passed URL.
+
+        self._do_action(self._get, [url], safe_url)
+
+    def _submit_move(self, direction_id):
+
+        # This internal method posts the movement form from the navigation page.
+
+        fields = get_move_fields(direction_id)
+        self._do_action(self._post, [self.game_url, fields], self.game_url)
+
+    def _submit_fight_action(self, action_id, parm = None, item = None):
+
+        # This internal method posts the combat form (see 'get_fight_fields').
+
+        fields = get_fight_fields(self.page.get("form"), self.target, action_id, parm, item)
+        self._do_action(self._post, [self.game_url, fields], self.game_url)
+
+    def _fight_return(self):
+
+        # This internal method finishes a fight either in victory or defeat. After
+        # a defeat, the form containing the return button is submitted directly.
+
+        form = get_return_form(self.soup, self.game_url)
+        if form is not None:
+            (method, url, fields) = form
+            if method == "post":
+                response = self._post(url, fields)
+            else:
+                response = self.session.get(url, params = fields, timeout = self.get_timeout())
+        else:
+            response = self._get(f"{self.game_url}?finish=1")
+        return response
+
+    def _fetch_pages(self, urls):
+
+        # This internal method fetches several pages in parallel over the
+        # pooled session, without changing the current page.
+
+        with ThreadPoolExecutor(max_workers = len(urls)) as executor:
+            htmls = list(executor.map(self._fetch_text, urls))
+        return htmls
+
+    def _fetch_text(self, url):
+
+        # This internal method returns the text of a page, or None on failure.
+
+        try:
+            response = self._get(url)
+            response.raise_for_status()
+            text = response.text
+        except requests.RequestException:
+            text = None
+        return text
+
+    def _get(self, url):
+
+        # This internal method sends a GET request over the shared session.
+
+        response = self.session.get(url, timeout = self.get_timeout())
+        return response
+
+    def _post(self, url, fields):
+
+        # This internal method sends a form POST over the shared session.
+
+        response = self.session.post(url, data = fields, timeout = self.get_timeout())
+        return response
+
+    def _do_action(self, func, args, safe_url):
+
+        # This internal method performs the request specified by 'func', which
+        # must return a response object. If the request fails or the response does
+        # not contain the game div, the 'safe_url' is requested until a valid game
+        # page is returned and the action is tried again, with the same backoff and
+        # failure budget as Driver. The new page is then saved, and the time spent
+        # waiting on the server is recorded.
+
+        start = time.perf_counter()
+        failures = 0
+        while True:
+            try:
+                attempt_start = time.perf_counter()
+                response = func(*args)
+                response.raise_for_status()
+                html = extract_game_div(response.text)
+                if html is not None:
+                    self.latencies.append(time.perf_counter() - attempt_start)
+                    break
+            except requests.RequestException:
+                pass
+            print("Action failed.")
+            failures = self._hard_refresh(safe_url, failures)
+        self.wait_times.append(time.perf_counter() - start)
+        self.target = None
+        self._set_page(html, (func, args))
+
+    def _hard_refresh(self, return_url, failures = 0):
+
+        # This internal method requests the specified URL until it returns
+        # a valid game page, counting each attempt against the failure
+        # budget, and returns the updated number of failures.
+
+        while True:
+            failures = self._record_failure(failures)
+            try:
+                response = self._get(return_url)
+                response.raise_for_status()
+                if extract_game_div(response.text) is not None:
+                    break
+            except requests.RequestException:
+                pass
+        return failures
+
+def get_move_fields(direction_id):
+
+    # This function returns the fields of the movement form.
+
+    fields = {"act": "move", "dir": direction_id}
+    return fields
+
+def get_fight_fields(form_fields, target, action_id, parm = None, item = None):
+
+    # This function fills in the combat form, whose hidden fields are passed
+    # as 'form_fields', mirroring the page's 'settarget', 'setaction', 'setparm'
+    # and 'setitem' JavaScript functions.
+
+    fields = dict(form_fields)
+    if target is not None:
+        fields["target"] = target
+    fields["fact"] = action_id
+    if parm is not None:
+        fields["parm"] = parm
+    if item is not None:
+        fields["use_id"] = item
+    return fields
+
+def get_return_form(soup, game_url):
+
+    # This function returns the (method, URL, fields) of the form holding the
+    # return button shown after a defeat, or None if the page has none, as it
+    # does after a victory.
+
+    defeated_button = soup.select_one('input[value="Return to your last rest spot..."]')
+    form_tag = (defeated_button.find_parent("form") if defeated_button else None)
+    if form_tag is not None:
+        fields = {tag["name"]: tag.get("value", "") for tag in form_tag.select("input[name]")}
+        url = urljoin(game_url, form_tag.get("action", ""))
+        form = (form_tag.get("method", "get").lower(), url, fields)
+    else:
+        form = None
+    return form
+
+def make_session(cookies = None, user_agent = None, pool_size = 4):
+
+    # This function creates a requests session with a connection pool of
+    # the specified size, and loads in the passed browser cookies.
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if user_agent is not None:
+        session.headers["User-Agent"] = user_agent
+    for cookie in (cookies or []):
+        session.cookies.set(
+            cookie["name"], cookie["value"],
+            domain = cookie.get("domain", ""), path = cookie.get("path", "/")
+        )
+    return session
+
+def get_browser_cookies(selenium_driver):
+
+    # This function copies the cookies and user agent from a logged-in
+    # Selenium browser, so that they can be passed to an HttpDriver.
+
+    cookies = selenium_driver.get_cookies()
+    user_agent = selenium_driver.execute_script("return navigator.userAgent;")
+    return (cookies, user_agent)
+
+def save_cookies(cookies, user_agent, file_path):
+
+    # This function saves browser cookies and the user agent to a JSON file,
+    # allowing later runs to skip the browser entirely.
+
+    with open(file_path, "w", encoding = "utf-8") as target:
+        json.dump({"cookies": cookies, "user_agent": user_agent}, target)
+
+def load_cookies(file_path):
+
+    # This function loads cookies and a user agent saved by 'save_cookies'.
+
+    with open(file_path, "r", encoding = "utf-8") as target:
+        saved = json.load(target)
+    return (saved["cookies"], saved["user_agent"])
@@ -0,0 +1,343 @@
+import argparse
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+# This module contains a small local stand-in for the NeoQuest II server, built
+# from the pages captured in 'html/'. It answers the same 'nq2.phtml' query shapes
+# and form posts as the real game and keeps a simple state machine, so that the
+# auto-player can be run end-to-end offline (for example to measure throughput).
+# Run it with 'python -m src.neopets.local_server' and point a driver at the
+# printed URL.
+
+html_dir = Path(__file__).resolve().parents[2] / "html"
+
+direction_steps = { # Coordinate changes for the movement form's direction IDs
+    1: (-1, 0), 2: (1, 0), 3: (0, -1), 4: (0, 1),
+    5: (-1, -1), 6: (1, -1), 7: (-1, 1), 8: (1, 1)
+}
+
+char_names = {"1": "Rohane", "2": "Mipsy", "3": "Talinia", "4": "Velm"}
+
+intro_page = """<div class="contentModule phpGamesNonPortalView">
+	<div class="frame">
+		<div class="contentModuleHeader">NeoQuest II</div>
+		<center>
+			King Skarl of Meridell is nearing the end of his reign...
+			<br>
+			<a href="nq2.phtml?startgame=1">Begin your adventure</a>
+		</center>
+	</div>
+</div>"""
+
+page_shell = """<html>
+<head><title>NeoQuest II</title></head>
+<body>
+<div id="content">
+{}
+</div>
+</body>
+</html>"""
+
+class LocalGame():
+
+    # This class holds the state of a single local game. Its 'page' attribute follows
+    # the transitions of the real game (explore -> fight_start -> fight -> fight_end
+    # -> explore, plus the intro page after a restart), and its 'handle' method maps
+    # the query and form fields of a request onto the game div that should be served.
+
+    def __init__(self, encounter_rate = 0.1, hunting_rate = 0.3, fight_turns = 6, path = None, seed = None):
+
+        # 'encounter_rate' and 'hunting_rate' are the chances of a fight after each
+        # move in the normal and hunting travel modes, and 'fight_turns' is the number
+        # of combat actions before the enemies are defeated. If a path file from 'paths/'
+        # is given, the player starts at its first tile and moves along the path exactly
+        # as the path describes it, which allows area transitions to be reproduced.
+
+        self.templates = {
+            name: (html_dir / f"{name}_source.html").read_text(encoding = "utf-8")
+            for name in ["explore", "fight_start", "fight", "fight_end", "inventory", "skills"]
+        }
+        self.encounter_rate = encounter_rate
+        self.hunting_rate = hunting_rate
+        self.fight_turns = fight_turns
+        self.rng = random.Random(seed)
+        self.path = (load_path(path) if path is not None else {})
+        if self.path:
+            (self.area, x, y) = next(iter(self.path))
+            self.coords = (int(x), int(y))
+        else:
+            (self.area, self.coords) = ("Terror Mountain (southern pass)", (95, 7))
+        self.page = "explore"
+        self.travel_mode = "normal"
+        self.turns_left = 0
+        self.injured = True
+        self.unspent = 0
+        self.restarted = False
+        self.lock = threading.Lock()
+
+    def handle(self, fields):
+
+        # This method advances the game state according to the passed request fields
+        # (query string and form data merged into a single dictionary), and returns
+        # the HTML of the resulting game div.
+
+        with self.lock:
+            act = fields.get("act")
+            if act == "inv" and self.page == "explore":
+                if fields.get("iact") == "use":
+                    self.injured = False
+                html = self._render_inventory()
+            elif act == "skills" and self.page == "explore":
+                char_id = fields.get("buy_char", fields.get("show_char", "1"))
+                if "buy_char" in fields:
+                    points = sum(int(v) for (k, v) in fields.items() if k.startswith("skopt_"))
+                    self.unspent = max(0, self.unspent - points)
+                html = self._render_skills(char_names.get(char_id, "Rohane"))
+            elif act == "travel" and self.page == "explore":
+                self.travel_mode = ("hunting" if fields.get("mode") == "2" else "normal")
+                html = self._render_explore()
+            elif act == "move" and self.page == "explore":
+                self._move(int(fields.get("dir") or 0))
+                html = self._render()
+            elif "restart" in fields:
+                self.page = "intro"
+                html = self._render()
+            elif "startgame" in fields and self.page == "intro":
+                self._restart()
+                html = self._render()
+            elif "start" in fields and self.page == "fight_start":
+                self.page = "fight"
+                self.turns_left = self.fight_turns
+                html = self._render()
+            elif "finish" in fields and self.page == "fight_end":
+                self.page = "explore"
+                html = self._render()
+            elif "fact" in fields and self.page == "fight":
+                self._fight_action(fields["fact"])
+                html = self._render()
+            else:
+                html = self._render()
+            self.restarted = False
+            return html
+
+    def _move(self, direction_id):
+
+        # This internal method moves the player, either along the loaded path or in
+        # a straight line within the current area, and then rolls for an encounter.
+
+        (x, y) = self.coords
+        path_entry = self.path.get((self.area, str(x), str(y)))
+        (dx, dy) = direction_steps.get(direction_id, (0, 0))
+        keys = list(self.path)
+        if path_entry is not None and direction_id and path_entry == direction_key(dx, dy):
+            next_index = keys.index((self.area, str(x), str(y))) + 1
+            if next_index < len(keys):
+                (self.area, new_x, new_y) = keys[next_index]
+                self.coords = (int(new_x), int(new_y))
+        else:
+            self.coords = (x + dx, y + dy)
+        rate = (self.hunting_rate if self.travel_mode == "hunting" else self.encounter_rate)
+        if self.rng.random() < rate:
+            self.page = "fight_start"
+
+    def _fight_action(self, action_id):
+
+        # This internal method processes a combat action. Every action other than
+        # ending the fight counts down the remaining turns, and ending the fight
+        # is only allowed after the enemies have been defeated.
+
+        if str(action_id) == "2":
+            if self.turns_left <= 0:
+                self.page = "fight_end"
+                self.injured = True
+                self.unspent += 1
+        elif str(action_id) == "4" and self.rng.random() < 0.5:
+            self.turns_left = 0
+        else:
+            self.turns_left -= 1
+
+    def _restart(self):
+
+        # This internal method resets the player's position and status
+        # after a game restart.
+
+        if self.path:
+            (self.area, x, y) = next(iter(self.path))
+            self.coords = (int(x), int(y))
+        self.page = "explore"
+        self.travel_mode = "normal"
+        self.injured = False
+        self.unspent = 0
+        self.restarted = True
+
+    def _render(self):
+
+        # This internal method returns the game div for the current page.
+
+        if self.page == "explore":
+            html = self._render_explore()
+        elif self.page == "fight":
+            html = self.templates["fight"]
+            if self.turns_left <= 0:
+                html = html.replace(
+                    '<div class="contentModuleHeader">',
+                    '<img src="//images.neopets.com/nq2/x/com_end.gif"><div class="contentModuleHeader">', 1
+                )
+        elif self.page == "intro":
+            html = intro_page
+        else:
+            html = self.templates[self.page]
+        return html
+
+    def _render_explore(self):
+
+        # This internal method fills the captured navigation page with the current
+        # area, coordinates (the map window is shifted so the player stays centered),
+        # travel mode and party health.
+
+        html = self.templates["explore"]
+        (dx, dy) = (self.coords[0] - 95, self.coords[1] - 7)
+        html = re.sub(
+            r'coords\((\d+),="" (\d+)\)=""',
+            lambda m: f'coords({int(m[1]) + dx},="" {int(m[2]) + dy})=""', html
+        )
+        html = html.replace("You are on Terror Mountain (southern pass).", f"You are on {self.area}.")
+        if self.travel_mode == "hunting":
+            html = html.replace(
+                'Travel: <b>Normal</b> | <a href="nq2.phtml?act=travel&amp;mode=2">Hunting</a>',
+                'Travel: <a href="nq2.phtml?act=travel&amp;mode=1">Normal</a> | <b>Hunting</b>'
+            )
+        if self.restarted:
+            html = html.replace(f"You are on {self.area}.", f"You are on {self.area}. Now be careful out there!")
+        html = self._render_health(html)
+        return html
+
+    def _render_inventory(self):
+
+        # This internal method fills the captured inventory page with the
+        # current party health and unspent skill points.
+
+        html = self.templates["inventory"]
+        plural = ("" if self.unspent == 1 else "s")
+        html = re.sub(r"<b>\d+ skill points?</b>", f"<b>{self.unspent} skill point{plural}</b>", html, count = 1)
+        html = self._render_health(html)
+        return html
+
+    def _render_skills(self, char_name):
+
+        # This internal method fills the captured skills page with the selected
+        # character and the current number of unspent skill points.
+
+        html = self.templates["skills"]
+        html = html.replace("- Rohane's Skills -", f"- {char_name}'s Skills -")
+        html = html.replace("<b>0</b> points to spend", f"<b>{self.unspent}</b> points to spend", 1)
+        return html
+
+    def _render_health(self, html):
+
+        # This internal method sets every party member to full health
+        # if the party has healed since the last fight.
+
+        if not self.injured:
+            html = re.sub(r"(?m)^(\s*)(\d+)/(\d+)(\s*)$", r"\1\3/\3\4", html)
+        return html
+
+class GameRequestHandler(BaseHTTPRequestHandler):
+
+    # This class answers GET and POST requests for 'nq2.phtml' using
+    # the LocalGame instance attached to the server.
+
+    def do_GET(self):
+        (path, query) = (urlsplit(self.path).path, urlsplit(self.path).query)
+        self._respond(path, parse_fields(query))
+
+    def do_POST(self):
+        (path, query) = (urlsplit(self.path).path, urlsplit(self.path).query)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        self._respond(path, parse_fields(query) | parse_fields(body))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, path, fields):
+
+        # This internal method serves the game page, waiting for the
+        # server's artificial latency first.
+
+        if not path.endswith("nq2.phtml"):
+            self.send_error(404)
+            return
+        time.sleep(self.server.latency)
+        html = page_shell.format(self.server.game.handle(fields))
+        body = html.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_server(game = None, port = 0, latency = 0):
+
+    # This function starts a local game server in a background thread and
+    # returns the server along with the URL of its game page. Passing port 0
+    # picks a free port. 'latency' adds a fixed delay (in seconds) to every
+    # response to approximate the real site.
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), GameRequestHandler)
+    server.game = (game if game is not None else LocalGame())
+    server.latency = latency
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/games/nq2/nq2.phtml"
+    return (server, url)
+
+def parse_fields(string):
+
+    # This function parses a query string or urlencoded form body into a
+    # dictionary, keeping blank values and the last value of repeated keys.
+
+    fields = {key: values[-1] for (key, values) in parse_qs(string, keep_blank_values = True).items()}
+    return fields
+
+def load_path(file_path):
+
+    # This function loads a path file in the format used by PathFollow.
+
+    with open(file_path, "r", encoding = "utf-8") as target:
+        path = [tuple(string.strip().split("|")) for string in target.readlines()]
+    moves = {tupl[:3]: tupl[3] for tupl in path}
+    return moves
+
+def direction_key(dx, dy):
+
+    # This function converts a coordinate change into a direction string.
+
+    direction = {-1: "n", 1: "s", 0: ""}[dx] + {-1: "w", 1: "e", 0: ""}[dy]
+    return direction
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Local NeoQuest II stand-in server")
+    parser.add_argument("--port", type = int, default = 8000)
+    parser.add_argument("--path", default = None)
+    parser.add_argument("--encounter-rate", type = float, default = 0.1)
+    parser.add_argument("--fight-turns", type = int, default = 6)
+    parser.add_argument("--latency", type = float, default = 0)
+    parser.add_argument("--seed", type = int, default = None)
+    args = parser.parse_args()
+    game = LocalGame(
+        encounter_rate = args.encounter_rate, fight_turns = args.fight_turns,
+        path = args.path, seed = args.seed
+    )
+    (server, url) = start_server(game, args.port, args.latency)
+    print(f"Serving NeoQuest II at {url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
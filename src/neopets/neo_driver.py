@@ -1,19 +1,78 @@
 import time
 import re
+from collections import deque, OrderedDict
 
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support.expected_conditions import staleness_of
-from selenium.common.exceptions import TimeoutException
-from bs4 import BeautifulSoup
+from selenium.common.exceptions import (
+    TimeoutException, JavascriptException, StaleElementReferenceException, WebDriverException
+)
 
 from . import explore_parser, fight_parser, inventory_parser, skills_parser
+from .page import Page, get_digest, extract_game_div
 
 # This module contains the Selenium-based driver which is used by the auto-driver 
 # to run NeoQuest II, along with a few helper functions. The purpose of this code
 # is to interface with Neopets.com, and translate abstracted game actions into 
 # specific browser commands and web requests. 
 
+game_url = "https://www.neopets.com/games/nq2/nq2.phtml" # Main NeoQuest II page
+
+recovery_settings = { # Timeouts (in seconds) and retry limits used when pages fail to load
+    "default_timeout": 20,  # Used until enough page loads have been timed
+    "min_samples": 20,      # Number of timed page loads needed to adapt the timeout
+    "percentile": 0.95,     # Percentile of recent load times that the timeout is based on
+    "multiplier": 4,        # Timeout as a multiple of that percentile
+    "min_timeout": 3,
+    "max_timeout": 60,
+    "backoff_base": 1,      # Wait before the first retry, doubled for each later one
+    "backoff_cap": 30,
+    "failure_budget": 8     # Consecutive failures of one action before giving up
+}
+
+# This script is run asynchronously after each action, and calls back with true once the
+# page that replaced the tagged one contains a game div that has been completely parsed
+# (either the document has finished loading or some node follows the div). While the old 
+# page is still showing it calls back with false, and otherwise it waits on DOM mutations.
+page_ready_script = """
+var token = arguments[0];
+var done = arguments[arguments.length - 1];
+var finished = false;
+function finish(value) {
+    if (!finished) { finished = true; done(value); }
+}
+function ready() {
+    if (window.nqActionToken === token) { return false; }
+    var div = document.querySelector(".contentModule.phpGamesNonPortalView");
+    if (!div) { return false; }
+    if (document.readyState !== "loading") { return true; }
+    for (var node = div; node; node = node.parentNode) {
+        if (node.nextSibling) { return true; }
+    }
+    return false;
+}
+if (window.nqActionToken === token) {
+    setTimeout(function () { finish(false); }, 10);
+} else if (ready()) {
+    finish(true);
+} else {
+    var observer = new MutationObserver(function () {
+        if (ready()) { observer.disconnect(); finish(true); }
+    });
+    observer.observe(document, {childList: true, subtree: true});
+    document.addEventListener("readystatechange", function () {
+        if (ready()) { observer.disconnect(); finish(true); }
+    });
+}
+"""
+
+class DriverFailure(Exception):
+
+    # This exception is raised when an action keeps failing after every
+    # retry in the failure budget, so that the game loop can stop cleanly.
+
+    pass
+
 class Driver():
 
     # This class serves as an intermediate between the game logic in 'game.py' and
@@ -21,19 +80,47 @@ class Driver():
     # Most of its methods are dedicated to performing specific game actions or updating
     # game state information. 
 
-    def __init__(self, selenium_driver, flag):
+    def __init__(self, selenium_driver, flag, game_url = game_url):
 
         # The core of a Driver instance is the selenium webdriver, which is 
         # initialized seperately in 'main.py'. The 'flag' argument allows for
         # the outer control loop to interact directly with the driver, although
-        # this has not been implemented yet.
+        # this has not been implemented yet. The 'game_url' argument is the
+        # address of the main game page, which every other URL is built from.
 
         self.driver = selenium_driver
-        self.source = None
-        self.soup = None
+        self.game_url = game_url
+        self.page = None
+        self.recent_pages = OrderedDict()
         self.skills_dict = None
+        self.skills_stale = True # Set by the events that can change the skills or unspent points
+        self.party_levels = None # Levels of the party when they were last seen
         self.flag = flag
+        self.action_count = 0
+        self.wait_times = deque(maxlen = 1000)
+        self.latencies = deque(maxlen = 200) # Durations of recent successful page loads
+        self.default_timeout = recovery_settings["default_timeout"]
+        self.prefetched = {} # Read-only pages loaded alongside the current page, by type
+        self.seen_tiles = {} # Logged map tiles of each area, see 'load_seen_tiles'
+        self.visited = set() # Positions whose surrounding tiles have been logged
+        self.capture = None # Archive that every loaded page is added to, see 'capture.py'
     
+    @property
+    def source(self):
+
+        # The type of the current page, or None if no page is loaded.
+
+        source = (self.page.source if self.page else None)
+        return source
+
+    @property
+    def soup(self):
+
+        # The parsed game div of the current page, or None if no page is loaded.
+
+        soup = (self.page.soup if self.page else None)
+        return soup
+
     def get_state_data(self):
 
         # This method retrieves all relevant game state information by calling
@@ -54,12 +141,7 @@ class Driver():
         if not self.is_fighting():
             while self.source != "explore":
                 self._return_to_map()
-            explore_dict = {
-                "area": explore_parser.get_area_name(self.soup),
-                "coords": explore_parser.get_location(self.soup),
-                "travel_mode": explore_parser.get_travel_mode(self.soup),
-                "gold": explore_parser.get_gold(self.soup),
-            }
+            explore_dict = self._read_explore_dict()
             return explore_dict
 
     def get_characters_dict(self):
@@ -69,12 +151,12 @@ class Driver():
         # require the fewest page loads.
 
         if not self.is_fighting():
-            if self.source == "inventory":
-                characters_dict = inventory_parser.get_character_info(self.soup)
-            else:
+            page = self._find_page("explore", "inventory")
+            if page is None:
                 while self.source != "explore":
                     self._return_to_map()
-                characters_dict = explore_parser.get_character_info(self.soup)
+                page = self.page
+            characters_dict = self._read_characters_dict(page)
             return characters_dict
     
     def get_inventory_list(self):
@@ -83,26 +165,29 @@ class Driver():
         # about the player's inventory items.
 
         if not self.is_fighting():
-            while self.source != "inventory":
-                self._open_inventory()
-            inventory_list = inventory_parser.get_items(self.soup)
+            page = self._find_page("inventory")
+            if page is None:
+                while self.source != "inventory":
+                    self._open_inventory()
+                page = self.page
+            inventory_list = page.get("items")
             return inventory_list
         
     def get_skills_dict(self):
 
         # This method extracts information about the number of unspent
-        # skill points and the skill distributions of each character. It
-        # tries to be efficient and use prior saved information about skills
-        # to avoid loading the skills page unless a skill point was awarded.
+        # skill points and the skill distributions of each character. Both only
+        # change when a character gains a level or points are spent, so the saved
+        # information is returned without loading any page unless one of those
+        # events has been seen since it was read (see '_check_levels').
 
         if not self.is_fighting():
-            unspent_points = self._get_unspent_points()
-            if self.skills_dict is None:
-                self.skills_dict = {"skills": {}, "unspent_points": {}}
-                for char_name in unspent_points.keys():
-                    skills = self._get_char_skills(char_name)
-                    self.skills_dict["skills"][char_name] = skills
-            self.skills_dict["unspent_points"] = unspent_points
+            if self._skills_need_update():
+                unspent_points = self._get_unspent_points()
+                char_skills = {}
+                for char_name in self._get_unread_chars(unspent_points):
+                    char_skills[char_name] = self._get_char_skills(char_name)
+                self._store_skills(unspent_points, char_skills)
             return self.skills_dict
 
     def get_fight_dict(self):
@@ -112,46 +197,41 @@ class Driver():
 
         while self.source == "fight_start":
             self.begin_fight()
-        fight_dict = {
-            "players": fight_parser.get_player_stats(self.soup),
-            "enemies": fight_parser.get_enemy_stats(self.soup),
-            "elapsed_time": fight_parser.get_elapsed_time(self.soup),
-            "potions": fight_parser.get_potions(self.soup),
-            "abilities": fight_parser.get_abilities(self.soup),
-            "messages": fight_parser.get_messages(self.soup),
-            "ended": fight_parser.is_ended(self.soup)
-        }
+        fight_dict = self.page.get("fight")
         return fight_dict
 
     def get_fight_end_message(self):
 
         # This method extracts the ending fight message.
 
-        message = fight_parser.get_end_message(self.soup)
+        message = self.page.get("end_message")
         return message
 
     def action(self, action):
 
         # This method executes non-movement actions performed
         # on the main navigation page. The only supported action
-        # now is to toggle the travel mode.
+        # now is to toggle the travel mode. The result is returned
+        # in the same format as 'move'.
 
         if action in {"normal", "hunting"}:
             self._set_travel_mode(action)
+        move_dict = self._get_move_dict()
+        return move_dict
 
     def move(self, direction):
 
-        # This method makes a move in the specified direction.
+        # This method makes a move in the specified direction, and returns
+        # the outcome as read from the page that the move loaded (see
+        # '_get_move_dict'), so no further navigation is needed to check it.
 
         direction_id = explore_parser.get_direction_id(direction)
         if not self.is_fighting():
             while self.source != "explore":
                 self._return_to_map()
-            self._do_action(
-                self.driver.execute_script,
-                [f"dosub({direction_id});"],
-                "https://www.neopets.com/games/nq2/nq2.phtml"
-            )
+            self._submit_move(direction_id)
+        move_dict = self._get_move_dict()
+        return move_dict
 
     def choose_target(self, target_id):
 
@@ -166,74 +246,46 @@ class Driver():
         # This method performs a wait action for the specified time 
         # during combat.
 
-        self._do_action(
-            self.driver.execute_script,
-            [f"setaction(6); setparm({time}); document.ff.submit();"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._submit_fight_action(6, parm = time)
     
     def melee_attack(self):
 
         # This method performs a melee attack.
 
-        self._do_action(
-            self.driver.execute_script,
-            ["setaction(3); document.ff.submit();"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._submit_fight_action(3)
     
     def use_ability(self, ability_name):
 
         # This method uses the specified ability.
 
         ability_id = fight_parser.get_ability_id(ability_name)
-        self._do_action(
-            self.driver.execute_script,
-            [f"setaction({ability_id}); document.ff.submit();"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._submit_fight_action(ability_id)
 
     def flee(self):
 
         # This method attempts to flee a fight.
 
-        self._do_action(
-            self.driver.execute_script,
-            ["setaction(4); document.ff.submit();"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._submit_fight_action(4)
     
     def take_enemy_turn(self):
 
         # This method allows the enemy to take its turn.
 
-        self._do_action(
-            self.driver.execute_script,
-            ["setaction(1); document.ff.submit();"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._submit_fight_action(1)
     
     def begin_fight(self):
 
         # This method starts a fight from the initial encounter screen.
 
         while self.source == "fight_start":
-            self._do_action(
-                self.driver.get,
-                ["https://www.neopets.com/games/nq2/nq2.phtml?start=1"],
-                "https://www.neopets.com/games/nq2/nq2.phtml"
-            )
+            self._load(f"{self.game_url}?start=1", self.game_url)
 
     def end_fight(self):
 
         # This method ends a fight after the final turn.
 
         while self.source == "fight":
-            self._do_action(
-                self.driver.execute_script,
-                ["setaction(2); document.ff.submit();"],
-                "https://www.neopets.com/games/nq2/nq2.phtml"
-            )
+            self._submit_fight_action(2)
 
     def return_from_fight(self):
 
@@ -241,67 +293,47 @@ class Driver():
         # loot screen.
 
         while self.source == "fight_end":
-            self._do_action(
-                self._fight_return,
-                [],
-                "https://www.neopets.com/games/nq2/nq2.phtml"
-            )
+            self._do_action(self._fight_return, [], self.game_url)
 
     def use_fight_potion(self, potion_name):
 
         # This method uses a potion during combat.
 
         potion_id = inventory_parser.get_potion_id(potion_name)
-        self._do_action(
-            self.driver.execute_script,
-            [f"setaction(5); setitem({potion_id}); document.ff.submit();"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._submit_fight_action(5, item = potion_id)
 
     def drink_inventory_potion(self, potion_name, char_id):
 
         # This method uses a potion outside of combat.
 
-        potion_id = inventory_parser.get_potion_id(potion_name)
-        url = f"https://www.neopets.com/games/nq2/nq2.phtml?act=inv&iact=use&targ_item={potion_id}&targ_char={char_id}"
-        self._do_action(
-            self.driver.get,
-            [url],
-            "https://www.neopets.com/games/nq2/nq2.phtml?act=inv"
-        )
+        url = self._get_potion_url(potion_name, char_id)
+        self._load(url, self._get_inventory_url())
 
     def upgrade_skill(self, char_name, skill, points):
 
         # This method spends a specfied number of skill points on the
         # selected skill.
 
-        skill_id = skills_parser.get_skill_id(char_name, skill)
-        char_id = explore_parser.get_character_id(char_name)
-        url = f"https://www.neopets.com/games/nq2/nq2.phtml?act=skills&buy_char={char_id}&confirm=1&skopt_{skill_id}={points}"
-        self._do_action(
-            self.driver.get,
-            [url],
-            "https://www.neopets.com/games/nq2/nq2.phtml?act=skills"
-        )
+        url = self._get_upgrade_url(char_name, skill, points)
+        self._load(url, f"{self.game_url}?act=skills")
         skills = self._get_char_skills(char_name)
-        self.skills_dict["skills"][char_name] = skills
+        self._store_upgrade(char_name, skills, self._get_unspent_points())
 
     def reset_game(self):
 
         # This method resets the game.
 
+        self._forget_skills()
         while self.source != "intro":
-            self._do_action(
-                self.driver.get,
-                ["https://www.neopets.com/games/nq2/nq2.phtml?restart=1"],
-                "https://www.neopets.com/games/nq2/nq2.phtml"
-            )
+            self._load(f"{self.game_url}?restart=1", self.game_url)
         while not is_restarted(self.soup):
-            self._do_action(
-                self.driver.get,
-                ["https://www.neopets.com/games/nq2/nq2.phtml?startgame=1"],
-                "https://www.neopets.com/games/nq2/nq2.phtml"
-            )
+            self._load(f"{self.game_url}?startgame=1", self.game_url)
+
+    def quit(self):
+
+        # This method closes the underlying browser.
+
+        self.driver.quit()
 
     def is_fighting(self):
 
@@ -310,62 +342,270 @@ class Driver():
         check = self.source and ("fight" in self.source)
         return check
 
+    def prefetch_state(self, inventory = True):
+
+        # This method loads the inventory page (unless 'inventory' is false) and
+        # the skills pages that 'get_skills_dict' will need, all at once and without
+        # leaving the current page. The pages are used by the getters in place of
+        # navigating to them, until the next page load makes them stale.
+
+        if self.is_fighting():
+            return
+        urls = self._get_prefetch_urls(inventory)
+        if not urls:
+            return
+        htmls = self._fetch_pages(urls)
+        self._store_prefetched(htmls, urls)
+
+    def _get_prefetch_urls(self, inventory = True):
+
+        # This internal method lists the read-only pages to prefetch. Only
+        # Rohane's skills page is needed for the unspent points once every
+        # character's skills have been read, and none at all while the saved
+        # skills are still valid. The party is only known if the current page
+        # shows it, and otherwise only Rohane's skills are fetched.
+
+        page = self._find_page("explore", "inventory")
+        if page is not None:
+            self._check_levels(page.get("party"))
+        if self.skills_dict is None:
+            char_names = (list(page.get("party")) if page is not None else ["Rohane"])
+        else:
+            char_names = (["Rohane"] if self.skills_stale else [])
+        urls = ([self._get_inventory_url()] if inventory else []) + [
+            self._get_skills_url(name) for name in char_names if name in explore_parser.char_ids
+        ]
+        return urls
+
+    def _store_prefetched(self, htmls, urls):
+
+        # This internal method wraps each fetched game div in a Page,
+        # skipping any request that failed.
+
+        for (html, url) in zip(htmls, urls):
+            html = (extract_game_div(html) if html else None)
+            if html is not None:
+                page = Page(html)
+                self.prefetched[page.source] = page
+                if self.capture is not None:
+                    self.capture.add(html, ("prefetch", [url]))
+
+    def _check_levels(self, characters_dict):
+
+        # This internal method compares the levels in the passed party status
+        # with those seen last, and marks the saved skills as out-of-date if a
+        # character has gained a level (or joined the party), since only then
+        # can new skill points appear.
+
+        levels = {name: char_dict["level"] for (name, char_dict) in characters_dict.items()}
+        if self.party_levels is not None and levels != self.party_levels:
+            self.skills_stale = True
+        self.party_levels = levels
+
+    def _read_characters_dict(self, page):
+
+        # This internal method reads the party status from the passed page,
+        # which must be the navigation or inventory page, and checks it for
+        # level-ups.
+
+        characters_dict = page.get("party")
+        self._check_levels(characters_dict)
+        return characters_dict
+
+    def _skills_need_update(self):
+
+        # This internal method returns true if the skills pages must be read
+        # again, after checking the party on the current or prefetched page
+        # for level-ups.
+
+        page = self._find_page("explore", "inventory")
+        if page is not None:
+            self._check_levels(page.get("party"))
+        check = (self.skills_dict is None or self.skills_stale)
+        return check
+
+    def _get_unread_chars(self, unspent_points):
+
+        # This internal method lists the characters in the passed unspent
+        # points whose skills have not been saved, including characters who
+        # joined the party after the skills were first read.
+
+        saved_skills = (self.skills_dict["skills"] if self.skills_dict is not None else {})
+        char_names = [char_name for char_name in unspent_points.keys() if char_name not in saved_skills]
+        return char_names
+
+    def _store_skills(self, unspent_points, char_skills):
+
+        # This internal method saves a fresh read of the skills pages, where
+        # 'char_skills' maps the characters from '_get_unread_chars' to their
+        # skills, and marks the saved skills as up-to-date.
+
+        if self.skills_dict is None:
+            self.skills_dict = {"skills": {}, "unspent_points": {}}
+        self.skills_dict["skills"].update(char_skills)
+        self.skills_dict["unspent_points"] = unspent_points
+        self.skills_stale = False
+
+    def _store_upgrade(self, char_name, skills, unspent_points):
+
+        # This internal method saves the skills and unspent points read
+        # back from the skills page after spending points.
+
+        if self.skills_dict is None:
+            self.skills_dict = {"skills": {}, "unspent_points": {}}
+            self.skills_stale = True # The other characters have not been read
+        self.skills_dict["skills"][char_name] = skills
+        self.skills_dict["unspent_points"] = unspent_points
+
+    def _forget_skills(self):
+
+        # This internal method discards everything saved about the skills,
+        # such as when the game is reset.
+
+        self.skills_dict = None
+        self.skills_stale = True
+        self.party_levels = None
+
+    def _find_page(self, *sources):
+
+        # This internal method returns the current page if it has one of the
+        # passed types, or else a prefetched page of one of those types. None
+        # is returned if the data must be loaded by navigating.
+
+        if self.source in sources:
+            return self.page
+        for source in sources:
+            if source in self.prefetched:
+                return self.prefetched[source]
+        return None
+
+    def _fetch_pages(self, urls):
+
+        # This internal method fetches several same-origin pages in parallel from
+        # within the browser, leaving the displayed page untouched, and returns
+        # their HTML (None for any that failed).
+
+        self.driver.set_script_timeout(self.get_timeout())
+        htmls = self.driver.execute_async_script(
+            "var done = arguments[arguments.length - 1];"
+            "Promise.all(arguments[0].map(function (url) {"
+            "    return fetch(url, {credentials: 'same-origin'})"
+            "        .then(function (r) { return r.ok ? r.text() : null; })"
+            "        .catch(function () { return null; });"
+            "})).then(done);", urls
+        )
+        return htmls
+
+    def _get_move_dict(self):
+
+        # This internal method summarizes the current page after a move or action.
+        # The 'fighting' key is true if an encounter has begun, and otherwise the
+        # 'explore' key holds the result of 'get_explore_dict', which only needs
+        # to navigate if the move somehow left the navigation page.
+
+        fighting = bool(self.is_fighting())
+        move_dict = {
+            "fighting": fighting,
+            "explore": (None if fighting else self.get_explore_dict())
+        }
+        return move_dict
+
+    def _read_explore_dict(self):
+
+        # This internal method extracts the travel and gold information
+        # from the current page, which must be the navigation page.
+
+        explore_dict = {
+            "area": self.page.get("area"),
+            "coords": self.page.get("coords"),
+            "travel_mode": self.page.get("travel_mode"),
+            "gold": self.page.get("gold"),
+        }
+        return explore_dict
+
     def _get_unspent_points(self):
 
         # This internal method extracts the number of unspent skill points
         # from either the inventory or skill screens.
 
         if not self.is_fighting():
-            if self.source == "inventory":
-                unspent_points = inventory_parser.get_unspent_points(self.soup)
-            else:
+            page = self._find_page("inventory", *[f"skills_{name}" for name in explore_parser.char_ids])
+            if page is None:
                 while "skills" not in self.source:
                     self._open_skills()
-                unspent_points = skills_parser.get_unspent_points(self.soup)
+                page = self.page
+            unspent_points = page.get("unspent_points")
             return unspent_points
 
     def _set_travel_mode(self, mode):
 
         # This internal method sets the specified travel mode.
 
-        mode_id = (2 if mode == "hunting" else 1)
-        self._do_action(
-            self.driver.get,
-            [f"https://www.neopets.com/games/nq2/nq2.phtml?act=travel&mode={mode_id}"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._load(self._get_travel_url(mode), self.game_url)
 
     def _return_to_map(self):
 
         # This internal method navigates back to the main game page.
 
-        self._do_action(
-            self.driver.get,
-            ["https://www.neopets.com/games/nq2/nq2.phtml"],
-            "https://www.neopets.com/games/nq2/nq2.phtml"
-        )
+        self._load(self.game_url, self.game_url)
 
     def _open_inventory(self):
 
         # This internal method navigates to the inventory page.
 
-        self._do_action(
-            self.driver.get,
-            ["https://www.neopets.com/games/nq2/nq2.phtml?act=inv"],
-            "https://www.neopets.com/games/nq2/nq2.phtml?act=inv"
-        )
+        url = self._get_inventory_url()
+        self._load(url, url)
 
     def _open_skills(self, char_name = None):
 
         # This internal method navigates to the skills page.
 
+        url = self._get_skills_url(char_name)
+        self._load(url, url)
+
+    def _get_inventory_url(self):
+
+        # This internal method returns the URL of the inventory page.
+
+        url = f"{self.game_url}?act=inv"
+        return url
+
+    def _get_skills_url(self, char_name = None):
+
+        # This internal method returns the URL of a character's skills
+        # page, which also shows the unspent points of the whole party.
+
         char_name = ("Rohane" if char_name is None else char_name)
         char_id = explore_parser.get_character_id(char_name)
-        self._do_action(
-            self.driver.get,
-            [f"https://www.neopets.com/games/nq2/nq2.phtml?act=skills&show_char={char_id}"],
-            f"https://www.neopets.com/games/nq2/nq2.phtml?act=skills&show_char={char_id}"
-        )
+        url = f"{self.game_url}?act=skills&show_char={char_id}"
+        return url
+
+    def _get_travel_url(self, mode):
+
+        # This internal method returns the URL that sets the travel mode.
+
+        mode_id = (2 if mode == "hunting" else 1)
+        url = f"{self.game_url}?act=travel&mode={mode_id}"
+        return url
+
+    def _get_potion_url(self, potion_name, char_id):
+
+        # This internal method returns the URL that has the specified
+        # character drink a potion outside of combat.
+
+        potion_id = inventory_parser.get_potion_id(potion_name)
+        url = f"{self.game_url}?act=inv&iact=use&targ_item={potion_id}&targ_char={char_id}"
+        return url
+
+    def _get_upgrade_url(self, char_name, skill, points):
+
+        # This internal method returns the URL that spends 'points' skill
+        # points on the passed skill.
+
+        skill_id = skills_parser.get_skill_id(char_name, skill)
+        char_id = explore_parser.get_character_id(char_name)
+        url = f"{self.game_url}?act=skills&buy_char={char_id}&confirm=1&skopt_{skill_id}={points}"
+        return url
 
     def _get_char_skills(self, char_name):
 
@@ -373,9 +613,12 @@ class Driver():
         # for a specified character.
 
         if not self.is_fighting():
-            while self.source != f"skills_{char_name}":
-                self._open_skills(char_name)
-            skills = skills_parser.get_skills(self.soup)
+            page = self._find_page(f"skills_{char_name}")
+            if page is None:
+                while self.source != f"skills_{char_name}":
+                    self._open_skills(char_name)
+                page = self.page
+            skills = page.get("skills")
             return skills
 
     def _get_enemy_id_map(self):
@@ -384,7 +627,7 @@ class Driver():
         # ID numbering starting from five, and the actual ID numbering on the server
         # (which sometimes differs from the expected pattern).
 
-        enemy_ids = fight_parser.get_enemy_ids(self.soup)
+        enemy_ids = self.page.get("fight")["enemy_ids"]
         id_map = {str(i):enemy_id for (i, enemy_id) in enumerate(enemy_ids, 1)}
         return id_map
 
@@ -398,114 +641,225 @@ class Driver():
         if defeated_button:
             defeated_button[0].click()
         else:
-            self.driver.get("https://www.neopets.com/games/nq2/nq2.phtml?finish=1")
+            self.driver.get(f"{self.game_url}?finish=1")
+
+    def _load(self, url, safe_url):
+
+        # This internal method navigates the browser to the passed URL. All
+        # GET-style game actions are funneled through here so that other
+        # backends only need to override this method to change transport.
+
+        self._do_action(self.driver.get, [url], safe_url)
+
+    def _submit_move(self, direction_id):
+
+        # This internal method submits the movement form on the navigation
+        # page using the page's own JavaScript.
+
+        self._do_action(
+            self.driver.execute_script,
+            [f"dosub({direction_id});"],
+            self.game_url
+        )
+
+    def _submit_fight_action(self, action_id, parm = None, item = None):
 
-    def _get_page_soup(self):
+        # This internal method submits the combat form with the passed action
+        # ID, along with an optional parameter (used for waiting) and item ID
+        # (used for potions).
 
-        # This internal method gets the page HTML from the Selenium driver and returns
-        # a BeautifulSoup object.
+        script = f"setaction({action_id}); "
+        if parm is not None:
+            script += f"setparm({parm}); "
+        if item is not None:
+            script += f"setitem({item}); "
+        script += "document.ff.submit();"
+        self._do_action(self.driver.execute_script, [script], self.game_url)
 
-        html = self.driver.page_source
-        soup = BeautifulSoup(html, "html.parser")
-        game_elements = soup.select(".contentModule.phpGamesNonPortalView")[0]
-        return game_elements
+    def _get_page_html(self):
+
+        # This internal method gets the HTML of the game div from the Selenium driver.
+        # Only the div itself is transferred from the browser, falling back to the 
+        # whole page if the div cannot be found.
+
+        html = self.driver.execute_script(
+            'var div = document.querySelector(".contentModule.phpGamesNonPortalView");'
+            'return div ? div.outerHTML : null;'
+        )
+        if html is None:
+            html = self.driver.page_source
+        return html
 
     def _do_action(self, func, args, safe_url):
 
         # This internal method performs the action specified by 'func' in a manner
-        # that can tolerate unresponsiveness from the Neopets servers. The method
-        # waits until the previous game div tag becomes stale and then reloads. If
-        # the page fails to reload, the browser will be directed off of and then onto
-        # Neopets.com, forcing a refresh of the page. After confirming that the page has
-        # been loaded, the new HTML and page type are both saved. The 'safe_url' is a URL
-        # that the browser can safely return to without breaking continuity in the game logic.
-
+        # that can tolerate unresponsiveness from the Neopets servers. Before the
+        # action, the current page is tagged with a token, and the method then waits
+        # until a page without that token contains a complete game div. If the page 
+        # fails to load within the adaptive timeout (see 'get_timeout'), the 'safe_url'
+        # is loaded in its place, which is a URL that the browser can safely return to
+        # without breaking continuity in the game logic, and the action is tried again.
+        # Retries are spaced by an exponential backoff, and a DriverFailure is raised
+        # once the failure budget is used up. After confirming that the page has been
+        # loaded, the new page is saved and the time spent waiting is recorded.
+
+        start = time.perf_counter()
+        failures = 0
         while True:
             try: # Try to reload page naturally
-                game_div = self.driver.find_element(
-                    By.CSS_SELECTOR, ".contentModule.phpGamesNonPortalView"
-                )
+                attempt_start = time.perf_counter()
+                self.action_count += 1
+                token = self.action_count
+                self.driver.execute_script("window.nqActionToken = arguments[0];", token)
                 func(*args)
-                WebDriverWait(self.driver, 20).until(staleness_of(game_div))
-                WebDriverWait(self.driver, 20).until(
-                    lambda d: d.find_element(By.CSS_SELECTOR, ".contentModule.phpGamesNonPortalView")
-                )
+                self._wait_for_page(token, self.get_timeout())
+                self.latencies.append(time.perf_counter() - attempt_start)
                 break
-            except TimeoutException:
+            except (TimeoutException, WebDriverException):
                 print("Action failed.")
-                while True: # Force a reload by navigating off of Neopets.com and then returning
+                while True: # Reload the safe URL until it works, then retry the action
+                    failures = self._record_failure(failures)
                     try:
                         self._hard_refresh(safe_url)
                         break
-                    except TimeoutException:
+                    except (TimeoutException, WebDriverException):
                         pass
-        self.soup = self._get_page_soup()
-        self.source = get_source(self.soup)
-        time.sleep(0.3)
+        self.wait_times.append(time.perf_counter() - start)
+        self._set_page(self._get_page_html(), (func, args))
+
+    def _set_page(self, html, action = None):
+
+        # This internal method makes the passed HTML the current page. If the
+        # same content was loaded recently (such as after a reload), the earlier
+        # Page instance is reused along with everything already parsed from it.
+        # The page is added to the capture archive (if any) along with the
+        # (function, arguments) 'action' that loaded it.
+
+        digest = get_digest(html)
+        page = self.recent_pages.pop(digest, None)
+        if page is None:
+            page = Page(html, digest)
+        self.recent_pages[digest] = page
+        if len(self.recent_pages) > 8:
+            self.recent_pages.popitem(last = False)
+        self.page = page
+        self.prefetched = {} # Any action may have changed what they show
+        if self.capture is not None:
+            self.capture.add(html, action, self.wait_times[-1] if self.wait_times else None)
+        if page.source == "fight_end" and is_level_up(page.get("end_message")):
+            self.skills_stale = True
+
+    def _wait_for_page(self, token, timeout):
+
+        # This internal method blocks until the page-ready script reports that a
+        # new page (one without the passed token) has a fully parsed game div. The
+        # script resolves from a DOM mutation observer, so the wait ends as soon 
+        # as the div is complete rather than at a fixed polling interval.
+
+        self.driver.set_script_timeout(timeout)
+        WebDriverWait(
+            self.driver, timeout, poll_frequency = 0.01, 
+            ignored_exceptions = (JavascriptException, StaleElementReferenceException)
+        ).until(lambda d: d.execute_async_script(page_ready_script, token))
+
+    def get_wait_summary(self):
+
+        # This method summarizes the recorded time spent waiting for
+        # pages to load after each action.
+
+        count = len(self.wait_times)
+        total = sum(self.wait_times)
+        summary = {"actions": count, "total": total, "mean": (total / count if count else 0)}
+        return summary
+
+    def get_timeout(self):
+
+        # This method returns the number of seconds to wait for a page. Once
+        # enough loads have been timed, it is a multiple of a high percentile
+        # of the recent load times, so that a stalled page is given up on
+        # quickly when the server is fast, and given longer when it is slow.
+
+        if len(self.latencies) < recovery_settings["min_samples"]:
+            return self.default_timeout
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(recovery_settings["percentile"] * len(ordered)))
+        timeout = ordered[index] * recovery_settings["multiplier"]
+        timeout = min(recovery_settings["max_timeout"], max(recovery_settings["min_timeout"], timeout))
+        return timeout
+
+    def _get_backoff(self, failures):
+
+        # This internal method returns the wait in seconds before the
+        # retry that follows the passed number of failures.
+
+        backoff = min(recovery_settings["backoff_cap"], recovery_settings["backoff_base"] * 2 ** (failures - 1))
+        return backoff
+
+    def _record_failure(self, failures):
+
+        # This internal method counts one more failure of the current action,
+        # raising a DriverFailure if the failure budget has been used up, and
+        # otherwise waiting out the backoff before the next attempt.
+
+        failures += 1
+        if failures > recovery_settings["failure_budget"]:
+            raise DriverFailure(f"Gave up after {failures - 1} failed attempts.")
+        time.sleep(self._get_backoff(failures))
+        return failures
 
     def _hard_refresh(self, return_url):
 
-        # This internal method will navigate to google.com and then
-        # return to the specified URL.
+        # This internal method stops any pending load and navigates to the
+        # specified URL on the game's own site, waiting for its game div.
 
-        self.driver.get("https://www.google.com/")
-        WebDriverWait(self.driver, 20).until(
-            lambda d: d.find_elements(By.CSS_SELECTOR, "img.lnXdpd")
-        )
+        self.action_count += 1
+        token = self.action_count
+        self.driver.execute_script("window.stop(); window.nqActionToken = arguments[0];", token)
         self.driver.get(return_url)
-        WebDriverWait(self.driver, 20).until(
-            lambda d: d.find_element(By.CSS_SELECTOR, ".contentModule.phpGamesNonPortalView")
-        )
+        self._wait_for_page(token, self.get_timeout())
     
+    def load_seen_tiles(self, conn):
+
+        # This method loads every map tile that has already been logged,
+        # so that '_log_local_map' only has to write tiles that are new.
+
+        self.seen_tiles = {}
+        for (area, x_pos, y_pos, image) in conn.execute("SELECT area, x_pos, y_pos, image FROM map;"):
+            self.seen_tiles.setdefault(area, set()).add((int(x_pos), int(y_pos), image))
+
     def _log_local_map(self, conn):
 
         # This internal method logs the images that are used in map display. This
         # information is not currently used by the auto-player, but it is still
-        # worthwhile to collect.
+        # worthwhile to collect. The map around a position never changes, so the
+        # tiles are only extracted at positions that have not been visited before,
+        # and only tiles missing from the 'seen_tiles' cache are written.
 
         if not self.is_fighting():
             while self.source != "explore":
                 self._return_to_map()
-            area = explore_parser.get_area_name(self.soup)
-            map_dict = explore_parser.get_local_map(self.soup)
-            cursor = conn.cursor()
-            for ((x_pos, y_pos), image) in map_dict.items():
-                cursor.execute(
+            area = self.page.get("area")
+            position = (area, self.page.get("coords"))
+            if position in self.visited:
+                return
+            self.visited.add(position)
+            seen = self.seen_tiles.setdefault(area, set())
+            new_tiles = set()
+            for ((x_pos, y_pos), image) in self.page.get("tiles").items():
+                tile = (int(x_pos), int(y_pos), ",".join(image))
+                if tile not in seen:
+                    new_tiles.add(tile)
+            if new_tiles:
+                conn.executemany(
                     """
                     INSERT INTO map (area, x_pos, y_pos, image)
                     VALUES (?, ?, ?, ?)
                     ON CONFLICT (area, x_pos, y_pos, image)
                         DO NOTHING;
-                    """, (area, x_pos, y_pos, ",".join(image))
+                    """, [(area,) + tile for tile in sorted(new_tiles)]
                 )
-            cursor.close()
-            conn.commit()
-
-def get_source(soup):
-
-    # This function takes the provided soup object and determines
-    # the type of game page that it corresponds to.
-
-    source = None
-    if soup.select("map"):
-        source = "explore"
-    elif soup.find_all(string = "- Inventory and Party Info -"):
-        source = "inventory"
-    elif soup.find_all(string = "- Character Skills -"):
-        for char_name in ["Rohane", "Mispy", "Talinia", "Velm", "Invalid"]:
-            if soup.find_all(string = f"- {char_name}'s Skills -"):
-                break
-        source = f"skills_{char_name}"
-    elif soup.find_all(string = re.compile("You are attacked by.*")):
-        source = "fight_start"
-    elif soup.select('input[name="target"]'):
-        source = "fight"
-    elif soup.select(
-        'a[href="nq2.phtml?finish=1"], input[value="Return to your last rest spot..."]'):
-        source = "fight_end"
-    elif soup.find_all(string = re.compile("nearing the end of his reign")):
-        source = "intro"
-    return source
+                conn.commit()
+                seen.update(new_tiles)
 
 def is_restarted(soup):
 
@@ -514,6 +868,14 @@ def is_restarted(soup):
     check = bool(soup.find_all(string = re.compile("be careful out there!")))
     return check
 
+def is_level_up(end_message):
+
+    # This function returns true if the passed fight end message
+    # reports that a party member gained a level.
+
+    check = ("gained a level" in end_message)
+    return check
+
 def are_unspent(unspent_points):
 
     # This function returns true if there are unspent skill points in the
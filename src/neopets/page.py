@@ -0,0 +1,188 @@
+import hashlib
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+from . import explore_parser, fight_parser, inventory_parser, skills_parser
+
+try: # Prefer the C-backed lxml parser when it is installed
+    import lxml
+    html_parser = "lxml"
+except ImportError:
+    html_parser = "html.parser"
+
+# This module contains the Page class, which wraps a single loaded game page,
+# along with the functions that work on raw page HTML. A Page is classified as
+# soon as it is created, but its HTML is only parsed, and each of its fields only
+# extracted, the first time they are needed.
+
+source_fingerprints = [ # Literal markers of each page type in the raw HTML, in order of priority
+    ("explore", ["<map"]),
+    ("inventory", ["- Inventory and Party Info -"]),
+    ("skills", ["- Character Skills -"]),
+    ("fight_start", ["You are attacked by"]),
+    ("fight", ['name="target"']),
+    ("fight_end", ['href="nq2.phtml?finish=1"', 'value="Return to your last rest spot..."']),
+    ("intro", ["nearing the end of his reign"])
+]
+
+skills_char_pattern = re.compile(r"- (\w+)(?:'|&#39;|&#039;)s Skills -")
+
+game_div_pattern = re.compile(r'<div[^>]*class="contentModule phpGamesNonPortalView"')
+div_tag_pattern = re.compile(r"<(/?)div\b", re.IGNORECASE)
+
+field_extractors = { # Parser functions for the fields available on each page type
+    "explore": {
+        "area": explore_parser.get_area_name,
+        "coords": explore_parser.get_location,
+        "travel_mode": explore_parser.get_travel_mode,
+        "gold": explore_parser.get_gold,
+        "party": explore_parser.get_character_info,
+        "tiles": explore_parser.get_local_map
+    },
+    "inventory": {
+        "items": inventory_parser.get_items,
+        "party": inventory_parser.get_character_info,
+        "unspent_points": inventory_parser.get_unspent_points
+    },
+    "skills": {
+        "unspent_points": skills_parser.get_unspent_points,
+        "skills": skills_parser.get_skills
+    },
+    "fight": {
+        "fight": fight_parser.get_fight_info,
+        "form": fight_parser.get_form_fields
+    },
+    "fight_end": {
+        "end_message": fight_parser.get_end_message
+    }
+}
+
+class Page():
+
+    # This class holds the HTML of one game page. Its type is determined from
+    # the raw HTML when the instance is created, while the BeautifulSoup tree
+    # and the individual fields are built lazily and memoized. The time spent
+    # on each of them is stored in 'parse_times'.
+
+    def __init__(self, html, digest = None):
+
+        # 'html' should contain the game div. The 'digest' identifies the
+        # page content, and is computed from the HTML if not passed.
+
+        self.html = html
+        self.digest = (digest if digest is not None else get_digest(html))
+        self.source = get_source(html)
+        self.kind = ("skills" if self.source and self.source.startswith("skills_") else self.source)
+        self.fields = {}
+        self.parse_times = {}
+        self._soup = None
+
+    @property
+    def soup(self):
+
+        # The BeautifulSoup tag of the game div, parsed on first access.
+
+        if self._soup is None:
+            start = time.perf_counter()
+            self._soup = get_game_soup(self.html)
+            self.parse_times["soup"] = time.perf_counter() - start
+        return self._soup
+
+    def get(self, field):
+
+        # This method returns the requested field, extracting it from the
+        # page on first access. A KeyError is raised if the field does not
+        # exist on this type of page.
+
+        if field not in self.fields:
+            extractor = field_extractors.get(self.kind, {})[field]
+            soup = self.soup
+            start = time.perf_counter()
+            self.fields[field] = extractor(soup)
+            self.parse_times[field] = time.perf_counter() - start
+        return self.fields[field]
+
+    def has(self, field):
+
+        # This method returns true if the field exists on this type of page.
+
+        check = field in field_extractors.get(self.kind, {})
+        return check
+
+def get_digest(html):
+
+    # This function returns a hash that identifies the content of a page.
+
+    digest = hashlib.sha1(html.encode("utf-8")).digest()
+    return digest
+
+def get_game_soup(html, parser = None):
+
+    # This function parses the passed page HTML and returns the BeautifulSoup
+    # tag for the game div. Only the game div is parsed, using lxml if it is 
+    # available, unless a specific 'parser' is requested. Tables are given the
+    # 'tbody' tags that a browser would add (see 'add_table_bodies').
+
+    game_html = extract_game_div(html) or html
+    soup = BeautifulSoup(game_html, parser or html_parser)
+    if game_html.count("<table") != game_html.count("<tbody"): # Only raw server HTML lacks them
+        add_table_bodies(soup)
+    game_elements = soup.select(".contentModule.phpGamesNonPortalView")[0]
+    return game_elements
+
+def add_table_bodies(soup):
+
+    # This function wraps the rows of every table that has no 'tbody' in one, as
+    # browsers do when building the page. The parsers were written against the
+    # browser's version of the page (as in 'html/'), while the HTTP drivers and
+    # the prefetched pages get the server's HTML, which has no 'tbody' tags and
+    # which neither lxml nor 'html.parser' adds them to.
+
+    for table_tag in soup.find_all("table"):
+        if table_tag.find("tbody", recursive = False) is None:
+            rows = table_tag.find_all("tr", recursive = False)
+            if rows:
+                body_tag = soup.new_tag("tbody")
+                rows[0].insert_before(body_tag)
+                for row in rows:
+                    body_tag.append(row)
+
+def extract_game_div(html):
+
+    # This function cuts the game div out of the raw page HTML by counting
+    # nested div tags, so that the rest of the Neopets page never has to be
+    # parsed. It returns None if the div is not present.
+
+    start_match = game_div_pattern.search(html)
+    if start_match is None:
+        return None
+    depth = 0
+    for tag_match in div_tag_pattern.finditer(html, start_match.start()):
+        depth += (-1 if tag_match[1] else 1)
+        if depth == 0:
+            end = html.find(">", tag_match.end()) + 1
+            return html[start_match.start():end]
+    return html[start_match.start():]
+
+def get_source(html):
+
+    # This function takes the raw HTML of a game page and determines the type
+    # of page that it corresponds to. Instead of searching a parsed tree once 
+    # per page type, it checks for a literal fingerprint of each page type in
+    # the unparsed HTML, which is far cheaper and allows the page type to be 
+    # known before any parsing is done.
+
+    source = None
+    for (page_type, markers) in source_fingerprints:
+        if any(marker in html for marker in markers):
+            source = page_type
+            break
+    if source == "skills":
+        match = skills_char_pattern.search(html)
+        char_name = (match[1] if match else None)
+        if char_name not in explore_parser.char_ids:
+            char_name = "Invalid"
+        source = f"skills_{char_name}"
+    return source
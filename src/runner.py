@@ -0,0 +1,134 @@
+import argparse
+import multiprocessing
+import queue
+
+import yaml
+
+from . import config, game, logs, migrations
+from .neopets import http_driver, neo_driver
+
+# This module runs the segments from 'config.yml' as a queue of jobs spread over
+# several Neopets accounts, with one worker process per account. Each worker plays
+# over plain HTTP using the saved cookies of its account (see 'http_driver.py'),
+# and takes one segment at a time from the shared queue. A job that fails is put
+# back on the queue to be retried, possibly by a different account. Every worker
+# logs to the same database, which is safe since it is opened in WAL mode and game
+# IDs are allocated by the database itself. Run it with 'python -m src.runner'.
+
+def run_worker(account, job_queue, result_queue, db_path):
+
+    # This function is the body of a worker process. It creates a driver for the
+    # passed account and then runs jobs from the queue until it receives None.
+    # Each job is a (job_id, segment, attempt) tuple, and is played by a GameThread
+    # (run in this process's main thread) with a single-segment Schedule. Taking a
+    # job is reported on the result queue as ("started", job_id, account name,
+    # attempt, None), and its outcome as ("finished", job_id, account name, attempt,
+    # error), where 'error' is None for a successful job.
+
+    if account.get("cookies"):
+        (cookies, user_agent) = http_driver.load_cookies(account["cookies"])
+    else:
+        (cookies, user_agent) = ([], None)
+    flag = [True]
+    driver = http_driver.HttpDriver(
+        flag, cookies, game_url = account.get("url", neo_driver.game_url), user_agent = user_agent
+    )
+    try:
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            (job_id, segment, attempt) = job
+            result_queue.put(("started", job_id, account["name"], attempt, None))
+            try:
+                schedule = config.Schedule({"cycle": False, "segments": [segment]})
+                game_thread = game.GameThread(flag, driver, schedule, logging = True, db_path = db_path)
+                game_thread.run()
+                error = (repr(game_thread.error) if game_thread.error is not None else None)
+            except Exception as exception:
+                error = repr(exception)
+            result_queue.put(("finished", job_id, account["name"], attempt, error))
+    finally:
+        driver.quit()
+
+def run_jobs(segments, accounts, db_path = "data.db", repeats = 1, retries = 2):
+
+    # This function plays every segment 'repeats' times, spread across one worker
+    # process per account, and returns a dictionary mapping each job ID to its
+    # final result tuple. Failed jobs are retried until they have been attempted
+    # 'retries' extra times. The job that each worker is playing is tracked, so
+    # that a job whose worker dies counts as a failed attempt. If every worker
+    # dies, the remaining jobs are left out of the results.
+
+    conn = logs.connect(db_path)
+    migrations.migrate(conn) # Done once here, rather than racing in every worker
+    conn.close()
+    context = multiprocessing.get_context("spawn")
+    (job_queue, result_queue) = (context.Queue(), context.Queue())
+    jobs = {}
+    for _ in range(repeats):
+        for segment in segments:
+            jobs[len(jobs)] = segment
+            job_queue.put((len(jobs) - 1, segment, 1))
+    workers = {
+        account["name"]: context.Process(target = run_worker, args = (account, job_queue, result_queue, db_path))
+        for account in accounts
+    }
+    for worker in workers.values():
+        worker.start()
+    results = {}
+    held = {} # Job ID and attempt that each worker is playing, by account name
+    try:
+        while len(results) < len(jobs):
+            try:
+                (kind, job_id, name, attempt, error) = result_queue.get(timeout = 1)
+            except queue.Empty:
+                for (name, (job_id, attempt)) in list(held.items()):
+                    if not workers[name].is_alive():
+                        del held[name]
+                        record_result(results, jobs, job_queue, retries, (job_id, name, attempt, "The worker stopped."))
+                if not any(worker.is_alive() for worker in workers.values()):
+                    print("All workers have stopped.")
+                    break
+                continue
+            if kind == "started":
+                held[name] = (job_id, attempt)
+            else:
+                held.pop(name, None)
+                record_result(results, jobs, job_queue, retries, (job_id, name, attempt, error))
+    finally:
+        for _ in workers:
+            job_queue.put(None)
+        for worker in workers.values():
+            worker.join()
+    return results
+
+def record_result(results, jobs, job_queue, retries, result):
+
+    # This function handles the outcome of one attempt at a job, putting the
+    # job back on the queue if it failed and has retries left, and otherwise
+    # storing the (job_id, account name, attempt, error) result.
+
+    (job_id, name, attempt, error) = result
+    if error is not None and attempt <= retries:
+        print(f"Job {job_id} failed on {name} (attempt {attempt}): {error}")
+        job_queue.put((job_id, jobs[job_id], attempt + 1))
+    else:
+        results[job_id] = result
+        print(f"Job {job_id} {'finished' if error is None else 'abandoned'} on {name} ({len(results)}/{len(jobs)})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run the config.yml segments across several accounts")
+    parser.add_argument("--config", default = "config.yml")
+    parser.add_argument("--db", default = "data.db")
+    parser.add_argument("--repeats", type = int, default = 1)
+    parser.add_argument("--retries", type = int, default = 2)
+    args = parser.parse_args()
+    with open(args.config, "r", encoding = "utf-8") as target:
+        config_dict = yaml.safe_load(target)
+    results = run_jobs(
+        config_dict["segments"], config_dict["accounts"], db_path = args.db,
+        repeats = args.repeats, retries = args.retries
+    )
+    failed = [result for result in results.values() if result[3] is not None]
+    print(f"{len(results) - len(failed)} jobs finished, {len(failed)} failed.")
@@ -0,0 +1,2 @@
+from src.simulation import combat
+from src.simulation import world
@@ -0,0 +1,246 @@
+import argparse
+import re
+import sqlite3
+
+import numpy as np
+
+from .. import inventory
+from .combat import defaults, fit_combat_model
+
+# This module estimates fight outcomes for many fights at once. Where the SimDriver
+# in 'combat.py' plays one fight at a time through the real game loop, here every
+# fight in a batch is a row of NumPy arrays (health and time until the next turn
+# of each party member and enemy), and each step of the loop advances all of the
+# unfinished fights by one turn. The party plays as the SimpleMelee fight handler:
+# every party member either attacks the leftmost enemy still standing or tries
+# to flee at the given rate. The fitted combat model and its conventions are
+# shared with 'combat.py'. It requires the optional 'numpy' package.
+
+batch_settings = {
+    "chunk_size": 200000, # Fights simulated together, which bounds the memory used
+    "max_turns": 500 # Turns after which an unfinished fight is counted as lost
+}
+
+outcomes = {"running": 0, "won": 1, "fled": 2, "lost": 3} # Codes stored in the outcome array
+
+gold_pattern = re.compile(r"You found (\d+) gold pieces") # Gold line in a victory message
+
+class SampleTable():
+
+    # This class holds the logged values of several distributions as one padded
+    # array, so that a value can be drawn from a different distribution for each
+    # fight in a single step. Distributions with no values use 'fallback'.
+
+    def __init__(self, value_lists, fallback):
+
+        # The 'value_lists' hold the values of each distribution, in the order
+        # of the rows that will be drawn from.
+
+        value_lists = [(values if len(values) else fallback) for values in value_lists]
+        self.counts = np.array([len(values) for values in value_lists])
+        self.values = np.zeros((len(value_lists), self.counts.max()))
+        for (i, values) in enumerate(value_lists):
+            self.values[i, :len(values)] = values
+
+    def draw(self, rows, rng):
+
+        # This method draws one value from the distribution of each of the
+        # passed rows.
+
+        columns = (rng.random(len(rows)) * self.counts[rows]).astype(int)
+        values = self.values[rows, columns]
+        return values
+
+class BatchModel():
+
+    # This class arranges the combat model as sample tables indexed by combatant
+    # type, where the first types are the party members (in the order of their
+    # columns in the fight arrays) and the rest are the enemies. The damage and
+    # speed of each party member are those logged at the skill points closest to
+    # theirs in 'skills' (as {name: {skill: points}}).
+
+    def __init__(self, model, skills = None, party = None):
+
+        # The 'model' is a dictionary returned by 'combat.fit_combat_model', and
+        # 'party' maps each member's name to their maximum health, defaulting
+        # to the most common values in the logs as in SimDriver.
+
+        skills = (skills or {})
+        self.party = (list(party) if party is not None else list(model["players"]))
+        self.party_health = np.array([
+            (party[name] if party is not None else most_common(model["players"][name]["max_health"]))
+            for name in self.party
+        ])
+        enemy_names = sorted({name for group in model["encounters"] for name in group} | set(model["enemies"]))
+        self.type_ids = {name: len(self.party) + i for (i, name) in enumerate(enemy_names)}
+        players = [model["players"].get(name, {}) for name in self.party]
+        enemies = [model["enemies"].get(name, {}) for name in enemy_names]
+        self.initial_time = SampleTable(
+            [player.get("initial_time", []) for player in players] + [enemy.get("initial_time", []) for enemy in enemies],
+            defaults["initial_time"]
+        )
+        self.damage = SampleTable(
+            [get_for_points(player.get("damage", {}), skills.get(name, {}).get("Damage Increase", 0))
+             for (name, player) in zip(self.party, players)] + [enemy.get("damage", []) for enemy in enemies],
+            defaults["damage"]
+        )
+        self.speed = SampleTable(
+            [get_for_points(player.get("speed", {}), skills.get(name, {}).get("Innate Melee Haste", 0))
+             for (name, player) in zip(self.party, players)] + [enemy.get("speed", []) for enemy in enemies],
+            defaults["speed"]
+        )
+        self.enemy_health = SampleTable(
+            [[]] * len(self.party) + [enemy.get("max_health", []) for enemy in enemies], defaults["max_health"]
+        )
+        loot = [get_loot_samples(model["victory_messages"].get(name, [])) for name in enemy_names]
+        self.gold = SampleTable([[]] * len(self.party) + [gold for (gold, _) in loot], [0])
+        self.items = SampleTable([[]] * len(self.party) + [items for (_, items) in loot], [0])
+        self.flee_speed = SampleTable([model["flee"]["speed"]], defaults["speed"])
+        flee = model["flee"]
+        self.flee_chance = (flee["escapes"] / flee["attempts"] if flee["attempts"] else defaults["flee_chance"])
+        groups = (model["encounters"] or [[]])
+        self.max_enemies = max(max(len(group) for group in groups), 1)
+        self.encounters = np.full((len(groups), self.max_enemies), -1)
+        for (i, group) in enumerate(groups):
+            self.encounters[i, :len(group)] = [self.type_ids[name] for name in group]
+
+def simulate_fights(batch_model, fights, flee_rate = 0, rng = None):
+
+    # This function simulates a batch of fights and returns the per-fight
+    # arrays of outcome codes (see 'outcomes'), turns taken, damage taken,
+    # and the gold and items found.
+
+    rng = (rng if rng is not None else np.random.default_rng())
+    party_size = len(batch_model.party)
+    width = party_size + batch_model.max_enemies
+    kinds = np.empty((fights, width), dtype = int)
+    kinds[:, :party_size] = np.arange(party_size)
+    kinds[:, party_size:] = batch_model.encounters[rng.integers(len(batch_model.encounters), size = fights)]
+    present = (kinds >= 0)
+    kinds = np.where(present, kinds, 0) # Empty enemy slots only ever hold a dead combatant
+    health = np.zeros((fights, width))
+    health[:, :party_size] = batch_model.party_health
+    enemy_slots = present[:, party_size:]
+    health[:, party_size:][enemy_slots] = batch_model.enemy_health.draw(kinds[:, party_size:][enemy_slots], rng)
+    timer = batch_model.initial_time.draw(kinds.ravel(), rng).reshape(fights, width)
+    timer[health <= 0] = np.inf
+    outcome = np.zeros(fights, dtype = np.int8)
+    turns = np.zeros(fights, dtype = int)
+    damage_taken = np.zeros(fights)
+    for _ in range(batch_settings["max_turns"]):
+        idx = np.flatnonzero(outcome == outcomes["running"])
+        if not len(idx):
+            break
+        actor = timer[idx].argmin(axis = 1)
+        timer[idx] -= timer[idx, actor][:, None]
+        turns[idx] += 1
+        is_player = (actor < party_size)
+        (p_idx, p_actor) = (idx[is_player], actor[is_player])
+        fleeing = (rng.random(len(p_idx)) < flee_rate)
+        escaped = fleeing & (rng.random(len(p_idx)) < batch_model.flee_chance)
+        outcome[p_idx[escaped]] = outcomes["fled"]
+        blocked = fleeing & ~escaped
+        timer[p_idx[blocked], p_actor[blocked]] = batch_model.flee_speed.draw(np.zeros(blocked.sum(), dtype = int), rng)
+        (a_idx, a_actor) = (p_idx[~fleeing], p_actor[~fleeing])
+        target = party_size + (health[a_idx, party_size:] > 0).argmax(axis = 1) # Leftmost enemy standing
+        health[a_idx, target] = np.maximum(health[a_idx, target] - batch_model.damage.draw(a_actor, rng), 0)
+        timer[a_idx, a_actor] = batch_model.speed.draw(a_actor, rng)
+        (e_idx, e_actor) = (idx[~is_player], actor[~is_player])
+        e_kinds = kinds[e_idx, e_actor]
+        standing = (health[e_idx, :party_size] > 0)
+        target = (rng.random(standing.shape) * standing).argmax(axis = 1) # Random party member standing
+        damage = np.minimum(batch_model.damage.draw(e_kinds, rng), health[e_idx, target])
+        health[e_idx, target] -= damage
+        damage_taken[e_idx] += damage
+        timer[e_idx, e_actor] = batch_model.speed.draw(e_kinds, rng)
+        timer[idx] = np.where(health[idx] > 0, timer[idx], np.inf)
+        running = (outcome[idx] == outcomes["running"])
+        won = running & (health[idx, party_size:] <= 0).all(axis = 1)
+        lost = running & ~won & (health[idx, :party_size] <= 0).all(axis = 1)
+        outcome[idx[won]] = outcomes["won"]
+        outcome[idx[lost]] = outcomes["lost"]
+    outcome[outcome == outcomes["running"]] = outcomes["lost"]
+    winners = (outcome == outcomes["won"])
+    first_enemy = kinds[:, party_size]
+    gold = np.zeros(fights)
+    items = np.zeros(fights)
+    gold[winners] = batch_model.gold.draw(first_enemy[winners], rng)
+    items[winners] = batch_model.items.draw(first_enemy[winners], rng)
+    return (outcome, turns, damage_taken, gold, items)
+
+def estimate(batch_model, fights, flee_rate = 0, seed = None):
+
+    # This function simulates the passed number of fights in chunks of
+    # 'batch_settings["chunk_size"]', and returns the fraction won, fled and
+    # lost, along with the mean turns, damage taken, gold and items per fight.
+
+    rng = np.random.default_rng(seed)
+    totals = {"won": 0, "fled": 0, "lost": 0, "turns": 0, "damage_taken": 0, "gold": 0, "items": 0}
+    remaining = fights
+    while remaining > 0:
+        size = min(remaining, batch_settings["chunk_size"])
+        (outcome, turns, damage_taken, gold, items) = simulate_fights(batch_model, size, flee_rate, rng)
+        for name in ["won", "fled", "lost"]:
+            totals[name] += int((outcome == outcomes[name]).sum())
+        totals["turns"] += int(turns.sum())
+        totals["damage_taken"] += float(damage_taken.sum())
+        totals["gold"] += float(gold.sum())
+        totals["items"] += float(items.sum())
+        remaining -= size
+    summary = {name: total / fights for (name, total) in totals.items()}
+    return summary
+
+def sweep(model, flee_rates, haste_levels, fights = 1000000, skills = None, seed = None):
+
+    # This function estimates the outcomes for every combination of SimpleMelee
+    # flee rate and Rohane's 'Innate Melee Haste' points, returning a list with
+    # one summary dictionary (see 'estimate') per combination.
+
+    results = []
+    for haste in haste_levels:
+        char_skills = {name: dict(points) for (name, points) in (skills or {}).items()}
+        char_skills.setdefault("Rohane", {})["Innate Melee Haste"] = haste
+        batch_model = BatchModel(model, char_skills)
+        for flee_rate in flee_rates:
+            summary = estimate(batch_model, fights, flee_rate, seed)
+            results.append({"flee_rate": flee_rate, "haste": haste} | summary)
+    return results
+
+def get_for_points(values_by_points, points):
+
+    # This function returns the values logged at the skill level
+    # closest to the passed number of points.
+
+    if not values_by_points:
+        return []
+    level = min(values_by_points, key = lambda level: abs(int(level) - points))
+    values = values_by_points[level]
+    return values
+
+def get_loot_samples(messages):
+
+    # This function returns the gold and the number of items found in
+    # each of the passed victory messages.
+
+    gold = [sum(int(amount) for amount in gold_pattern.findall(message)) for message in messages]
+    items = [sum(quant for (_, quant) in inventory.get_loot(message)) for message in messages]
+    return (gold, items)
+
+def most_common(values):
+
+    # This function returns the most common of the passed maximum health
+    # values, or the default maximum health if there are none.
+
+    value = (max(set(values), key = values.count) if values else defaults["max_health"][0])
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Estimate SimpleMelee outcomes over flee rates and haste levels")
+    parser.add_argument("--db", default = "data.db")
+    parser.add_argument("--fights", type = int, default = 1000000)
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    model = fit_combat_model(conn)
+    conn.close()
+    for result in sweep(model, [0, 0.05, 0.1, 0.2], [0, 5, 10, 15], fights = args.fights, seed = 0):
+        print(", ".join(f"{key} {value:.3f}" for (key, value) in result.items()))
@@ -0,0 +1,577 @@
+import argparse
+import bisect
+import json
+import random
+import re
+import sqlite3
+
+from .. import game, handling
+
+# This module contains an offline model of NeoQuest II combat. The model is fitted
+# from the logged 'fight_status', 'fight_turns' and 'fight_end' tables, classifying
+# each turn's message in the same way as 'analysis/transform/get_fight_moves.R'.
+# It is played by a SimDriver, which answers the fight methods of the auto-player
+# driver, so that 'game.fight_loop' and any fight handler can be run against
+# thousands of simulated fights per second. Every distribution is the empirical
+# one (outcomes are drawn from the logged values), so the model only knows the
+# enemies, party members and skill levels that appear in the logs.
+
+skill_buffs = { # Skills whose points change each part of a party member's model
+    "damage": "Damage Increase",
+    "speed": "Innate Melee Haste"
+}
+
+defaults = { # Values used when the logs hold nothing for a combatant
+    "max_health": [100],
+    "damage": [10],
+    "speed": [4.0],
+    "initial_time": [2.0],
+    "flee_chance": 0.5,
+    "won": "You won the fight!",
+    "fled": "You fled from the fight!",
+    "lost": "You have been defeated!"
+}
+
+action_patterns = { # Message patterns for each action type, checked in order
+    "flee": re.compile(r"\bflee\b"),
+    "critical": re.compile(r"critical"),
+    "stun": re.compile(r"stun"),
+    "melee": re.compile(r"\b(hits?|claws?|slash(es)?|bites?|zaps?|crush(es)?|bash(es)?)\b"),
+    "spell": re.compile(r"\bcasts?\b"),
+    "wait": re.compile(r"does nothing")
+}
+
+class SimDriver():
+
+    # This class stands in for the auto-player driver during fights. Each fight
+    # starts with an enemy group drawn from the logged encounters, and every
+    # attack, recovery time and escape is drawn from the fitted model. The skill
+    # points of the party in 'skills' (as {name: {skill: points}}) choose which
+    # of the logged damage and speed values are used. Abilities are not modelled,
+    # so none are ever offered (and using one is an error), and a combat potion
+    # only uses up the turn.
+
+    def __init__(self, model, skills = None, party = None, potions = None, full_heal = True, seed = None):
+
+        # The 'model' is a dictionary returned by 'fit_combat_model'. The 'party'
+        # maps each member's name to their maximum health, and defaults to the
+        # most common values in the logs. If 'full_heal' is false, damage is
+        # carried from one fight to the next until the party is defeated.
+
+        self.model = model
+        self.skills = (skills or {})
+        self.potions = dict(potions or {})
+        self.full_heal = full_heal
+        self.rng = random.Random(seed)
+        if party is None:
+            party = {
+                name: max(set(player["max_health"]), key = player["max_health"].count)
+                for (name, player) in model["players"].items()
+            }
+        self.party = {name: {"max_health": max_health, "curr_health": max_health} for (name, max_health) in party.items()}
+        self.source = "explore"
+        self.players = {}
+        self.enemies = {}
+        self.actor = None
+        self.target = None
+        self.messages = ""
+        self.elapsed = 0
+        self.outcome = None
+        self.turns = 0
+        self.damage_taken = 0
+
+    def is_fighting(self):
+
+        # This method returns true if a fight is underway.
+
+        check = ("fight" in self.source)
+        return check
+
+    def start_fight(self, enemy_names = None):
+
+        # This method sets up a new encounter with the named enemies, or with
+        # a group drawn from the logged encounters, ready for 'begin_fight'.
+
+        if enemy_names is None:
+            enemy_names = (self.rng.choice(self.model["encounters"]) if self.model["encounters"] else [])
+        self.players = {}
+        for (name, status) in self.party.items():
+            health = (status["max_health"] if self.full_heal else status["curr_health"])
+            timer = self._draw(self._get_player(name)["initial_time"], "initial_time")
+            self.players[name] = {"curr_health": health, "max_health": status["max_health"], "time": timer}
+        self.enemies = {}
+        for (i, name) in enumerate(enemy_names, 1):
+            enemy = self._get_enemy(name)
+            health = self._draw(enemy["max_health"], "max_health")
+            timer = self._draw(enemy["initial_time"], "initial_time")
+            self.enemies[i] = {"name": name, "curr_health": health, "max_health": health, "time": timer}
+        (self.actor, self.target, self.messages) = (None, None, "")
+        (self.elapsed, self.outcome, self.turns, self.damage_taken) = (0, None, 0, 0)
+        self.source = "fight_start"
+
+    def get_fight_dict(self):
+
+        # This method returns the fight in the format of 'fight_parser.get_fight_info'.
+
+        while self.source == "fight_start":
+            self.begin_fight()
+        fight_dict = {
+            "players": {
+                name: self._get_status(name, player, ("player", name))
+                for (name, player) in self.players.items()
+            },
+            "enemies": {
+                i: self._get_status(enemy["name"], enemy, ("enemy", i))
+                for (i, enemy) in self.enemies.items()
+            },
+            "enemy_ids": [str(i + 4) for i in self.enemies],
+            "elapsed_time": f"{self.elapsed:.1f} seconds",
+            "potions": {name: str(quant) for (name, quant) in self.potions.items() if quant > 0},
+            "abilities": [],
+            "messages": f"Messages {self.messages}",
+            "ended": self.outcome is not None
+        }
+        return fight_dict
+
+    def get_fight_end_message(self):
+
+        # This method returns a logged victory message for the first enemy
+        # of the fight if there is one, and a fixed message otherwise.
+
+        message = defaults[self.outcome]
+        if self.outcome == "won" and self.enemies:
+            logged = self.model["victory_messages"].get(self.enemies[1]["name"])
+            if logged:
+                message = self.rng.choice(logged)
+        return message
+
+    def choose_target(self, target_id):
+
+        # This method chooses the enemy that melee attacks are aimed at.
+
+        self.target = int(target_id)
+
+    def wait(self, time):
+
+        # This method ends the acting party member's turn without acting,
+        # with the chosen time until their next turn.
+
+        self._finish_turn(f"{self.actor[1]} does nothing.", float(time))
+
+    def melee_attack(self):
+
+        # This method makes the acting party member attack the chosen
+        # enemy, or the leftmost one still standing.
+
+        name = self.actor[1]
+        alive = [i for (i, enemy) in self.enemies.items() if enemy["curr_health"] > 0]
+        target = (self.target if self.target in alive else alive[0])
+        player = self._get_player(name)
+        damage = self._draw_for_points(player["damage"], name, "damage")
+        enemy = self.enemies[target]
+        enemy["curr_health"] = max(enemy["curr_health"] - damage, 0)
+        speed = self._draw_for_points(player["speed"], name, "speed")
+        self._finish_turn(f"{name} hits {enemy['name']} for {damage} damage!", speed)
+
+    def use_ability(self, ability_name):
+
+        # This method refuses to use an ability, since the logs do not hold
+        # enough about abilities to model them and none are ever offered.
+
+        raise NotImplementedError(
+            f'The combat model has no abilities, so "{ability_name}" cannot be used (see "abilities" in get_fight_dict).'
+        )
+
+    def use_fight_potion(self, potion_name):
+
+        # This method uses up one of the named potions, if any are left, and
+        # the turn, without any other effect.
+
+        if self.potions.get(potion_name, 0) > 0:
+            self.potions[potion_name] -= 1
+        name = self.actor[1]
+        speed = self._draw_for_points(self._get_player(name)["speed"], name, "speed")
+        self._finish_turn(f"{name} uses a {potion_name}!", speed)
+
+    def flee(self):
+
+        # This method attempts to escape, with the chance of success
+        # observed in the logs.
+
+        name = self.actor[1]
+        flee = self.model["flee"]
+        chance = (flee["escapes"] / flee["attempts"] if flee["attempts"] else defaults["flee_chance"])
+        if self.rng.random() < chance:
+            self.outcome = "fled"
+            self.messages = f"{name} tries to flee and gets away!"
+            self.turns += 1
+        else:
+            self._finish_turn(f"{name} tries to flee, but is blocked!", self._draw(flee["speed"], "speed"))
+
+    def take_enemy_turn(self):
+
+        # This method makes the acting enemy attack a random party
+        # member who is still standing.
+
+        enemy = self.enemies[self.actor[1]]
+        model = self._get_enemy(enemy["name"])
+        name = self.rng.choice([name for (name, player) in self.players.items() if player["curr_health"] > 0])
+        damage = self._draw(model["damage"], "damage")
+        player = self.players[name]
+        self.damage_taken += min(damage, player["curr_health"])
+        player["curr_health"] = max(player["curr_health"] - damage, 0)
+        self._finish_turn(f"{enemy['name']} hits {name} for {damage} damage!", self._draw(model["speed"], "speed"))
+
+    def begin_fight(self):
+
+        # This method starts the combat, drawing a new encounter first if
+        # none has been set up, and moves to the first turn.
+
+        if self.source != "fight_start":
+            self.start_fight()
+        self.source = "fight"
+        self._next_turn()
+
+    def end_fight(self):
+
+        # This method leaves the combat screen, keeping the party's
+        # health unless they were defeated.
+
+        for (name, player) in self.players.items():
+            status = self.party[name]
+            status["curr_health"] = (status["max_health"] if self.outcome == "lost" else player["curr_health"])
+        self.source = "fight_end"
+
+    def return_from_fight(self):
+
+        # This method returns to the exploration screen.
+
+        self.source = "explore"
+
+    def _finish_turn(self, message, recovery):
+
+        # This internal method ends the current turn, setting the time until
+        # the actor's next turn, and then checks whether the fight is over.
+
+        self.turns += 1
+        self.messages = message
+        if self.actor[0] == "player":
+            self.players[self.actor[1]]["time"] = recovery
+        else:
+            self.enemies[self.actor[1]]["time"] = recovery
+        if all(enemy["curr_health"] <= 0 for enemy in self.enemies.values()):
+            self.outcome = "won"
+        elif all(player["curr_health"] <= 0 for player in self.players.values()):
+            self.outcome = "lost"
+        else:
+            self._next_turn()
+
+    def _next_turn(self):
+
+        # This internal method advances the clock to the combatant whose
+        # turn comes next, counting down everyone else's time.
+
+        combatants = [(player, ("player", name)) for (name, player) in self.players.items()]
+        combatants += [(enemy, ("enemy", i)) for (i, enemy) in self.enemies.items()]
+        combatants = [(status, key) for (status, key) in combatants if status["curr_health"] > 0]
+        (status, self.actor) = min(combatants, key = lambda pair: pair[0]["time"])
+        step = status["time"]
+        for (status, _) in combatants:
+            status["time"] = status["time"] - step
+        self.elapsed += step
+
+    def _get_status(self, name, status, key):
+
+        # This internal method formats a combatant in the parser's format.
+
+        if status["curr_health"] <= 0:
+            time = ""
+        elif key == self.actor and self.outcome is None:
+            time = "now"
+        else:
+            time = f"{status['time']:.1f} sec"
+        status_dict = {
+            "name": name, "curr_health": str(status["curr_health"]),
+            "max_health": str(status["max_health"]), "time": time, "buff": ""
+        }
+        return status_dict
+
+    def _get_player(self, name):
+
+        # This internal method returns the model of a party member, which
+        # is empty (so that defaults are used) if they were never logged.
+
+        player = self.model["players"].get(name) or new_player()
+        return player
+
+    def _get_enemy(self, name):
+
+        # This internal method returns the model of an enemy, which is
+        # empty (so that defaults are used) if it was never logged.
+
+        enemy = self.model["enemies"].get(name) or new_enemy()
+        return enemy
+
+    def _draw(self, values, kind):
+
+        # This internal method draws one of the logged values, or one of
+        # the defaults for that kind of value if none were logged.
+
+        value = self.rng.choice(values or defaults[kind])
+        return value
+
+    def _draw_for_points(self, values_by_points, name, kind):
+
+        # This internal method draws from the values logged at the skill
+        # level closest to the party member's current one.
+
+        points = self.skills.get(name, {}).get(skill_buffs[kind], 0)
+        levels = [int(level) for level in values_by_points]
+        if levels:
+            level = min(levels, key = lambda level: abs(level - points))
+            value = self._draw(values_by_points[str(level)], kind)
+        else:
+            value = self._draw([], kind)
+        return value
+
+class DiscardLog():
+
+    # This class takes the place of a database connection when running
+    # the game loop against a SimDriver, throwing every log away.
+
+    def __enter__(self):
+
+        # This method lets the log be used as a transaction context, as a
+        # connection is.
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        # This method ends the context without suppressing any error.
+
+        return False
+
+    def execute(self, statement, parameters = ()):
+
+        # This method discards a single statement.
+
+        pass
+
+    def executemany(self, statement, rows):
+
+        # This method discards a statement run over several rows.
+
+        pass
+
+    def commit(self):
+
+        # This method does nothing, since nothing is kept.
+
+        pass
+
+def new_enemy():
+
+    # This function returns an empty model for an enemy.
+
+    enemy = {"max_health": [], "initial_time": [], "damage": [], "speed": []}
+    return enemy
+
+def new_player():
+
+    # This function returns an empty model for a party member, whose
+    # damage and speed are kept by their points in the buffing skills.
+
+    player = {"max_health": [], "initial_time": [], "damage": {}, "speed": {}}
+    return player
+
+def fit_combat_model(conn):
+
+    # This function fits the combat model from the fight logs in the passed
+    # database connection. The model is a dictionary of the values observed
+    # for each enemy and party member (health, starting time, damage and the
+    # time taken to recover from each attack), the flee attempts and escapes,
+    # the enemy group of every fight, and the victory messages for each first
+    # enemy. A party member's damage and speed are stored by their points in
+    # the 'skill_buffs' skills, taken from the last 'skills' rows logged before
+    # the fight.
+
+    model = {
+        "enemies": {}, "players": {}, "encounters": [], "victory_messages": {},
+        "flee": {"attempts": 0, "escapes": 0, "speed": []}
+    }
+    statuses = {}
+    for row in conn.execute(
+        "SELECT game_id, move_id, turn_id, type, char_id, name, curr_health, max_health, turn_time FROM fight_status;"
+    ):
+        statuses.setdefault(row[:3], []).append(row[3:])
+    fights = {}
+    for row in conn.execute(
+        "SELECT game_id, move_id, turn_id, elapsed_time, message FROM fight_turns ORDER BY game_id, move_id, turn_id;"
+    ):
+        fights.setdefault(row[:2], []).append(row[2:])
+    skill_history = get_skill_history(conn)
+    for ((game_id, move_id), turns) in fights.items():
+        points = {
+            (name, kind): get_points(skill_history, game_id, move_id, name, skill)
+            for (_, _, name, *_) in statuses.get((game_id, move_id, turns[0][0]), [])
+            for (kind, skill) in skill_buffs.items()
+        }
+        if turns[0][0] == 0:
+            add_start(model, statuses.get((game_id, move_id, 0), []))
+        for ((turn_id, start, _), (next_id, end, message)) in zip(turns, turns[1:]):
+            if next_id == turn_id + 1:
+                before = statuses.get((game_id, move_id, turn_id), [])
+                after = statuses.get((game_id, move_id, next_id), [])
+                add_action(model, before, after, parse_time(end) - parse_time(start), message, points)
+    for (game_id, move_id, message) in conn.execute("SELECT game_id, move_id, message FROM fight_end;"):
+        first_enemies = [
+            name for (kind, char_id, name, *_) in statuses.get((game_id, move_id, 0), [])
+            if kind == "enemy" and char_id == 1
+        ]
+        if "You won" in message and first_enemies:
+            model["victory_messages"].setdefault(first_enemies[0], []).append(message)
+    return model
+
+def add_start(model, status):
+
+    # This function records the enemy group, health and starting
+    # times of every combatant in the first turn of a fight.
+
+    enemies = sorted((char_id, name) for (kind, char_id, name, *_) in status if kind == "enemy")
+    model["encounters"].append([name for (_, name) in enemies])
+    for (kind, _, name, _, max_health, turn_time) in status:
+        if kind == "enemy":
+            combatant = model["enemies"].setdefault(name, new_enemy())
+        else:
+            combatant = model["players"].setdefault(name, new_player())
+        combatant["max_health"].append(int(max_health))
+        if turn_time:
+            combatant["initial_time"].append(parse_time(turn_time))
+
+def add_action(model, before, after, duration, message, points):
+
+    # This function records the action taken between two turns. The actor is
+    # whoever's turn it was before, and the time they take to recover is the
+    # elapsed time plus their time until the next turn afterwards, as in the
+    # R analysis. Unclassified actions are skipped.
+
+    actors = [row for row in before if row[5] == "now"]
+    if not actors:
+        return
+    (kind, char_id, name) = actors[0][:3]
+    next_times = [row[5] for row in after if row[:2] == (kind, char_id)]
+    speed = (duration + parse_time(next_times[0]) if next_times and next_times[0] else 0)
+    message = message.removeprefix("Messages ")
+    action = get_action_type(message)
+    if action in {"melee", "critical"}:
+        amount = re.search(r"\d+", message)
+        damage = (int(amount.group()) if amount else 0) # A miss has no number
+        if kind == "enemy":
+            combatant = model["enemies"].setdefault(name, new_enemy())
+            combatant["damage"].append(damage)
+            if speed > 0:
+                combatant["speed"].append(speed)
+        else:
+            combatant = model["players"].setdefault(name, new_player())
+            combatant["damage"].setdefault(str(points.get((name, "damage"), 0)), []).append(damage)
+            if speed > 0:
+                combatant["speed"].setdefault(str(points.get((name, "speed"), 0)), []).append(speed)
+    elif action == "flee" and kind == "player":
+        escaped = ("blocked" not in message)
+        model["flee"]["attempts"] += 1
+        model["flee"]["escapes"] += escaped
+        if not escaped and speed > 0:
+            model["flee"]["speed"].append(speed)
+
+def get_action_type(message):
+
+    # This function classifies a fight message using 'action_patterns',
+    # returning None if none of them match.
+
+    for (action, pattern) in action_patterns.items():
+        if pattern.search(message):
+            return action
+    return None
+
+def parse_time(time_string):
+
+    # This function converts a fight time such as "1.5 sec", "3.0 seconds"
+    # or "now" into a number of seconds.
+
+    match = re.match(r"\d*\.?\d+", time_string)
+    seconds = (float(match.group()) if match else 0)
+    return seconds
+
+def get_skill_history(conn):
+
+    # This function returns the logged skill points of each party member
+    # as {(game_id, name, skill): ([move_id, ...], [points, ...])}, sorted by
+    # move. The points include any buff, clamped to the range of 0 to 15.
+
+    history = {}
+    for (game_id, move_id, name, skill, points, buff) in conn.execute(
+        "SELECT game_id, move_id, char_name, skill, points, buff FROM skills WHERE skill IN (?, ?) ORDER BY game_id, move_id;",
+        tuple(skill_buffs.values())
+    ):
+        value = min(max(int(points) + int(buff or 0), 0), 15)
+        (move_ids, values) = history.setdefault((game_id, name, skill), ([], []))
+        move_ids.append(move_id)
+        values.append(value)
+    return history
+
+def get_points(history, game_id, move_id, name, skill):
+
+    # This function returns the points a party member had in the passed skill
+    # just before the given move, or 0 if none were logged.
+
+    (move_ids, values) = history.get((game_id, name, skill), ([], []))
+    i = bisect.bisect_left(move_ids, move_id)
+    points = (values[i - 1] if i > 0 else 0)
+    return points
+
+def save_model(model, path):
+
+    # This function writes a fitted model to a JSON file.
+
+    with open(path, "w", encoding = "utf-8") as target:
+        json.dump(model, target)
+
+def load_model(path):
+
+    # This function reads a model written by 'save_model'.
+
+    with open(path, "r", encoding = "utf-8") as target:
+        model = json.load(target)
+    return model
+
+def evaluate(fight_handler, model, fights = 1000, seed = None, **driver_args):
+
+    # This function plays the passed number of simulated fights with a fight
+    # handler through 'game.fight_loop', and returns the fraction of fights
+    # won, fled and lost, along with the mean number of turns and the mean
+    # damage taken. Any other arguments are passed on to the SimDriver.
+
+    driver = SimDriver(model, seed = seed, **driver_args)
+    handler = handling.Handler(None, fight_handler, None, None)
+    log = DiscardLog()
+    results = {"won": 0, "fled": 0, "lost": 0, "turns": 0, "damage_taken": 0}
+    for move_id in range(fights):
+        game.fight_loop(driver, handler, 0, move_id, log)
+        results[driver.outcome] += 1
+        results["turns"] += driver.turns
+        results["damage_taken"] += driver.damage_taken
+    summary = {key: value / fights for (key, value) in results.items()}
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Fit the combat model and compare SimpleMelee flee rates")
+    parser.add_argument("--db", default = "data.db")
+    parser.add_argument("--fights", type = int, default = 10000)
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    model = fit_combat_model(conn)
+    conn.close()
+    for flee_rate in [0, 0.05, 0.1, 0.2]:
+        summary = evaluate(handling.fight.SimpleMelee(flee_rate), model, fights = args.fights, seed = 0)
+        print(f"flee {flee_rate}: " + ", ".join(f"{key} {value:.3f}" for (key, value) in summary.items()))
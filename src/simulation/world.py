@@ -0,0 +1,476 @@
+import argparse
+import copy
+import glob
+import re
+import sqlite3
+import time
+
+import yaml
+
+from .. import config, explore, game, inventory
+from ..neopets import explore_parser
+from .combat import DiscardLog, SimDriver, fit_combat_model
+
+# This module extends the combat simulator in 'combat.py' to the rest of the game,
+# so that whole Schedules can be run offline. The world model is fitted from the
+# logged 'map' and 'explore' tables together with the path files in 'paths/': the
+# map tiles tell which moves are possible, the paths give the area transitions, and
+# the explore and 'fight_end' rows give the chance of an encounter on each tile.
+# A WorldDriver answers every method of the auto-player driver from these models,
+# so 'config.Schedule' and the move handlers run unchanged at CPU speed.
+
+world_settings = {
+    "prior_weight": 20, # Visits of the area's encounter rate blended into each tile's rate
+    "default_rates": {"normal": 0.1, "hunting": 0.3}, # Encounter rates when nothing was logged
+    "unknown_walkable": True # Whether tiles missing from the 'map' table can be entered
+}
+
+heal_pattern = re.compile(r"heal (\d+)") # Healing amount in an inventory item's type
+
+level_pattern = re.compile(r"(\w+) has gained a level") # Level-up line in a victory message
+
+gold_pattern = re.compile(r"You found ([\d,]+) gold pieces") # Gold line in a victory message
+
+class WorldDriver(SimDriver):
+
+    # This class stands in for the whole auto-player driver. Moves follow the map
+    # and the area transitions of the world model and can start a fight, fights
+    # are played by SimDriver, and victories add the gold, items and levels of
+    # their (logged) end messages. Damage is carried between fights, so healing
+    # handlers matter, and a defeat returns the party to the starting tile with
+    # full health. Nothing is ever logged by the driver itself.
+
+    def __init__(self, world, model, inventory_list = None, skills_dict = None, seed = None, **driver_args):
+
+        # The 'world' and 'model' are the dictionaries returned by 'fit_world_model'
+        # and 'combat.fit_combat_model'. The starting inventory and skills use the
+        # formats of the real driver's 'get_inventory_list' and 'get_skills_dict',
+        # default to those logged at the start of a game, and are restored
+        # whenever the game is reset.
+
+        super().__init__(model, full_heal = False, seed = seed, **driver_args)
+        self.world = world
+        skills_dict = copy.deepcopy(skills_dict or world["start_skills"])
+        for name in self.party:
+            skills_dict["skills"].setdefault(name, {})
+            skills_dict["unspent_points"].setdefault(name, "0")
+        self.start = {
+            "inventory": copy.deepcopy(inventory_list if inventory_list is not None else world["start_inventory"]),
+            "skills": skills_dict
+        }
+        self.stats = {"moves": 0, "fights": 0, "won": 0, "fled": 0, "lost": 0, "resets": 0}
+        self.end_message = ""
+        self._restart()
+
+    def get_state_data(self):
+
+        # This method returns every section of the game state, in the same
+        # order as the real driver's 'get_state_data'.
+
+        characters_dict = self.get_characters_dict()
+        inventory_list = self.get_inventory_list()
+        skills_dict = self.get_skills_dict()
+        explore_dict = self.get_explore_dict()
+        return (explore_dict, characters_dict, inventory_list, skills_dict)
+
+    def get_explore_dict(self):
+
+        # This method returns the party's area, tile, travel mode and gold,
+        # or None during a fight, when the real page would not show them.
+
+        if not self.is_fighting():
+            explore_dict = {
+                "area": self.area, "coords": self.coords,
+                "travel_mode": self.travel_mode, "gold": f"{self.gold:,}"
+            }
+            return explore_dict
+
+    def get_characters_dict(self):
+
+        # This method returns the level and health of each party member,
+        # or None during a fight.
+
+        if not self.is_fighting():
+            characters_dict = {
+                name: {
+                    "level": str(self.levels[name]), "curr_health": str(status["curr_health"]),
+                    "max_health": str(status["max_health"]), "exp": "0"
+                }
+                for (name, status) in self.party.items()
+            }
+            return characters_dict
+
+    def get_inventory_list(self):
+
+        # This method returns a copy of the inventory, or None during a
+        # fight.
+
+        if not self.is_fighting():
+            inventory_list = copy.deepcopy(self.inventory)
+            return inventory_list
+
+    def get_skills_dict(self):
+
+        # This method returns a copy of the skill points and unspent points
+        # of the party, or None during a fight.
+
+        if not self.is_fighting():
+            skills_dict = copy.deepcopy(self.skills_dict)
+            return skills_dict
+
+    def get_fight_end_message(self):
+
+        # This method returns the end message of the last fight, which is
+        # drawn once in 'end_fight' so that its loot can be applied.
+
+        return self.end_message
+
+    def action(self, action):
+
+        # This method performs a non-movement action. Only the changes of
+        # travel mode have an effect, and no action can start a fight.
+
+        if action in {"normal", "hunting"}:
+            self.travel_mode = action
+        move_dict = self._get_move_dict()
+        return move_dict
+
+    def move(self, direction):
+
+        # This method moves the party one tile, or across an area transition,
+        # and then rolls for an encounter. A move into a tile that cannot be
+        # entered leaves the party where it was, without an encounter.
+
+        if not self.is_fighting():
+            exit = self.world["exits"].get("|".join((self.area,) + self.coords + (direction,)))
+            if exit is not None:
+                (self.area, self.coords) = (exit[0], tuple(exit[1:]))
+                moved = True
+            else:
+                next_coords = explore.simulate_move(self.coords, direction)
+                moved = self._is_walkable(self.area, next_coords)
+                if moved:
+                    self.coords = next_coords
+            if moved:
+                self.stats["moves"] += 1
+                if self.rng.random() < self._get_encounter_rate():
+                    self.start_fight(self._get_enemy_group())
+        move_dict = self._get_move_dict()
+        return move_dict
+
+    def start_fight(self, enemy_names = None):
+
+        # This method sets up an encounter as SimDriver does, with the potions
+        # in the inventory as the ones that can be used in the fight.
+
+        super().start_fight(enemy_names)
+        self.potions = {
+            i_dict["name"]: int(i_dict["quant"]) for i_dict in self.inventory
+            if "Potion" in i_dict["type"] and i_dict["quant"]
+        }
+
+    def use_fight_potion(self, potion_name):
+
+        # This method uses a potion in a fight, removing it from the
+        # inventory as well.
+
+        if self.potions.get(potion_name, 0) > 0:
+            self._use_item(potion_name)
+        super().use_fight_potion(potion_name)
+
+    def end_fight(self):
+
+        # This method finishes the fight and applies its results: the loot and
+        # levels of a victory, or a return to the start after a defeat.
+
+        self.end_message = super().get_fight_end_message()
+        super().end_fight()
+        self.stats["fights"] += 1
+        self.stats[self.outcome] += 1
+        if self.outcome == "won":
+            self._apply_victory(self.end_message)
+        elif self.outcome == "lost":
+            (self.area, self.coords) = (self.world["start"][0], tuple(self.world["start"][1:]))
+
+    def drink_inventory_potion(self, potion_name, char_id):
+
+        # This method drinks a healing potion from the inventory, healing
+        # the party member with the passed ID by the amount in its type.
+
+        items = [i_dict for i_dict in self.inventory if i_dict["name"] == potion_name and i_dict["quant"]]
+        if not items:
+            return
+        char_names = {char_id: name for (name, char_id) in explore_parser.char_ids.items()}
+        status = self.party.get(char_names.get(str(char_id)))
+        heal = heal_pattern.search(items[0]["type"])
+        if status is not None and heal:
+            status["curr_health"] = min(status["curr_health"] + int(heal.group(1)), status["max_health"])
+        self._use_item(potion_name)
+
+    def upgrade_skill(self, char_name, skill, points):
+
+        # This method spends unspent points on a skill, which also changes
+        # the damage and speed values drawn for that party member.
+
+        points = min(int(points), int(self.skills_dict["unspent_points"][char_name]))
+        char_skills = self.skills_dict["skills"].setdefault(char_name, {})
+        skill_dict = char_skills.setdefault(skill, {"points": "0", "level_name": "", "buff": "0"})
+        skill_dict["points"] = str(int(skill_dict["points"]) + points)
+        self.skills_dict["unspent_points"][char_name] = str(int(self.skills_dict["unspent_points"][char_name]) - points)
+        self._set_skill_points()
+
+    def reset_game(self):
+
+        # This method restarts the game, as the real reset does.
+
+        self.stats["resets"] += 1
+        self._restart()
+
+    def prefetch_state(self, inventory = True):
+
+        # This method does nothing, since every section is already at hand.
+
+        pass
+
+    def load_seen_tiles(self, conn):
+
+        # This method does nothing, since the driver never logs map tiles.
+
+        pass
+
+    def quit(self):
+
+        # This method does nothing, since there is no browser or session
+        # to close.
+
+        pass
+
+    def _log_local_map(self, conn):
+
+        # This internal method does nothing, since the driver never logs
+        # map tiles.
+
+        pass
+
+    def _restart(self):
+
+        # This internal method puts the game back in its starting state.
+
+        (self.area, self.coords) = (self.world["start"][0], tuple(self.world["start"][1:]))
+        self.travel_mode = "normal"
+        self.gold = 0
+        self.inventory = copy.deepcopy(self.start["inventory"])
+        self.skills_dict = copy.deepcopy(self.start["skills"])
+        self.levels = {name: 1 for name in self.party}
+        for status in self.party.values():
+            status["curr_health"] = status["max_health"]
+        self._set_skill_points()
+        self.source = "explore"
+
+    def _set_skill_points(self):
+
+        # This internal method passes the current skill points (with buffs)
+        # on to the combat model.
+
+        self.skills = {
+            name: {skill: int(skill_dict["points"]) + int(skill_dict["buff"] or 0) for (skill, skill_dict) in char_skills.items()}
+            for (name, char_skills) in self.skills_dict["skills"].items()
+        }
+
+    def _apply_victory(self, end_message):
+
+        # This internal method adds the gold and items found, and the
+        # levels gained, as described in the passed end message.
+
+        for amount in gold_pattern.findall(end_message):
+            self.gold += int(amount.replace(",", ""))
+        state = inventory.InventoryState(self.inventory)
+        for (name, quant) in inventory.get_loot(end_message):
+            if not state.add_item(name, quant):
+                state.inventory.append({"name": name, "buffs": [], "quant": str(quant), "type": "", "equipped": False})
+        self.inventory = state.inventory
+        for name in level_pattern.findall(end_message):
+            if name in self.levels:
+                self.levels[name] += 1
+                unspent = self.skills_dict["unspent_points"]
+                unspent[name] = str(int(unspent.get(name, "0")) + 1)
+
+    def _use_item(self, name):
+
+        # This internal method removes one of the named item.
+
+        state = inventory.InventoryState(self.inventory)
+        state.remove_item(name)
+        self.inventory = state.inventory
+
+    def _is_walkable(self, area, coords):
+
+        # This internal method returns true if the tile at 'coords' can be
+        # entered: the party has stood on it, or it shows the same images as
+        # a tile that the party has stood on.
+
+        key = "|".join((area,) + coords)
+        if key in self.world["visited"]:
+            return True
+        images = self.world["tiles"].get(key)
+        if images is None:
+            walkable = world_settings["unknown_walkable"]
+        else:
+            walkable = any(image in self.world["walkable_images"] for image in images)
+        return walkable
+
+    def _get_encounter_rate(self):
+
+        # This internal method returns the chance of an encounter on the current
+        # tile: its logged rate, blended with the rate of its area (or the default
+        # for the travel mode) by 'world_settings["prior_weight"]' visits.
+
+        rates = self.world["encounter_rates"]
+        mode = self.travel_mode
+        (area_visits, area_fights) = rates.get(f"{self.area}|{mode}", (0, 0))
+        prior = (area_fights / area_visits if area_visits else world_settings["default_rates"][mode])
+        (visits, fights) = rates.get("|".join((self.area,) + self.coords + (mode,)), (0, 0))
+        weight = world_settings["prior_weight"]
+        rate = (fights + weight * prior) / (visits + weight)
+        return rate
+
+    def _get_enemy_group(self):
+
+        # This internal method draws an enemy group met in the current area,
+        # or returns None (so that 'start_fight' draws from every logged
+        # encounter) if none were logged there.
+
+        groups = self.world["area_encounters"].get(self.area)
+        group = (self.rng.choice(groups) if groups else None)
+        return group
+
+    def _get_move_dict(self):
+
+        # This internal method returns the result of a move or action, in the
+        # format of the real driver's 'move'.
+
+        fighting = self.is_fighting()
+        move_dict = {"fighting": fighting, "explore": (None if fighting else self.get_explore_dict())}
+        return move_dict
+
+def fit_world_model(conn, path_files = None):
+
+    # This function fits the world model from the logs in the passed database
+    # and the passed path files (every file in 'paths/' by default). The model
+    # holds the logged images of each map tile, every tile the party has stood
+    # on along with their images, the area transitions along the paths, the
+    # visits and fights of each tile and area in each travel mode, the enemy
+    # groups met in each area, and the most common starting tile of a game
+    # along with the inventory and skills logged at the start of the first one.
+    # Tiles and transitions are keyed by strings in the format of the path files.
+
+    world = {
+        "tiles": {}, "visited": set(), "walkable_images": set(), "exits": {},
+        "encounter_rates": {}, "area_encounters": {}, "start": None,
+        "start_inventory": [], "start_skills": None
+    }
+    for (area, x_pos, y_pos, image) in conn.execute("SELECT area, x_pos, y_pos, image FROM map;"):
+        world["tiles"].setdefault(f"{area}|{x_pos}|{y_pos}", []).append(image)
+    fights = {row for row in conn.execute("SELECT DISTINCT game_id, move_id FROM fight_end;")}
+    positions = {}
+    starts = {}
+    for (game_id, move_id, area, x_pos, y_pos, travel_mode) in conn.execute(
+        "SELECT game_id, move_id, area, x_pos, y_pos, travel_mode FROM explore;"
+    ):
+        tile = f"{area}|{x_pos}|{y_pos}"
+        positions[(game_id, move_id)] = area
+        world["visited"].add(tile)
+        if move_id == 0:
+            starts[tile] = starts.get(tile, 0) + 1
+            continue
+        fought = ((game_id, move_id) in fights)
+        for key in [f"{tile}|{travel_mode}", f"{area}|{travel_mode}"]:
+            (visits, fight_count) = world["encounter_rates"].get(key, (0, 0))
+            world["encounter_rates"][key] = (visits + 1, fight_count + fought)
+    groups = {}
+    for (game_id, move_id, char_id, name) in conn.execute(
+        "SELECT game_id, move_id, char_id, name FROM fight_status WHERE turn_id = 0 AND type = 'enemy' ORDER BY char_id;"
+    ):
+        groups.setdefault((game_id, move_id), []).append(name)
+    for (fight_id, group) in groups.items():
+        if fight_id in positions:
+            world["area_encounters"].setdefault(positions[fight_id], []).append(group)
+    world["start_inventory"] = [
+        {"type": item_type, "name": name, "buffs": [tuple(buff.split(" ", 1)) for buff in buffs.split(",") if buff],
+         "quant": quant, "equipped": bool(equipped)}
+        for (item_type, name, buffs, quant, equipped) in conn.execute(
+            "SELECT type, name, buffs, quant, equipped FROM inventory WHERE game_id = (SELECT MIN(game_id) FROM inventory WHERE move_id = 0) AND move_id = 0;"
+        )
+    ]
+    world["start_skills"] = {"skills": {}, "unspent_points": {}}
+    for (char_name, skill, level_name, points, buff) in conn.execute(
+        "SELECT char_name, skill, level_name, points, buff FROM skills WHERE game_id = (SELECT MIN(game_id) FROM skills WHERE move_id = 0) AND move_id = 0;"
+    ):
+        world["start_skills"]["skills"].setdefault(char_name, {})[skill] = {"level_name": level_name, "points": str(points), "buff": buff}
+    first_tiles = []
+    for file_path in (path_files if path_files is not None else sorted(glob.glob("paths/*"))):
+        steps = load_path_steps(file_path)
+        first_tiles += steps[:1]
+        for ((area, x_pos, y_pos, direction), next_step) in zip(steps, steps[1:]):
+            world["visited"].add(f"{area}|{x_pos}|{y_pos}")
+            world["visited"].add("|".join(next_step[:3]))
+            expected = explore.simulate_move((x_pos, y_pos), direction)
+            if next_step[0] != area or tuple(next_step[1:3]) != expected:
+                world["exits"][f"{area}|{x_pos}|{y_pos}|{direction}"] = list(next_step[:3])
+    for tile in world["visited"]:
+        world["walkable_images"].update(world["tiles"].get(tile, []))
+    if starts:
+        world["start"] = max(starts, key = starts.get).split("|")
+    elif first_tiles:
+        world["start"] = list(first_tiles[0][:3])
+    return world
+
+def load_path_steps(file_path):
+
+    # This function returns the (area, x, y, direction) steps of a path
+    # file in order, keeping repeated tiles (unlike PathFollow).
+
+    with open(file_path, "r", encoding = "utf-8") as target:
+        steps = [tuple(line.strip().split("|")) for line in target if line.strip()]
+    return steps
+
+def run_schedule(config_dict, world, model, max_steps = 100000, seed = None, **driver_args):
+
+    # This function runs the segments of a 'config.yml' dictionary against a
+    # WorldDriver, following the same steps as 'game.GameThread.run' but without
+    # logging, until the Schedule is exhausted or 'max_steps' game steps have been
+    # played (a cycling Schedule never ends by itself). The driver's counts of
+    # moves, fights and resets are returned, along with the steps and seconds taken.
+
+    driver = WorldDriver(world, model, seed = seed, **driver_args)
+    schedule = config.Schedule(config_dict)
+    log = DiscardLog()
+    start = time.perf_counter()
+    steps = 0
+    game_state = game.GameState(0, move_id = 0, driver = driver)
+    (handler, state) = schedule.get_next_handler()
+    while steps < max_steps and state != "released":
+        game_state = game.game_step(driver, game_state, handler, log)
+        steps += 1
+        if not game_state.live:
+            if state == "reset":
+                driver.reset_game()
+                game_state = game.GameState(0, move_id = 0, driver = driver)
+            (handler, state) = schedule.get_next_handler()
+            game_state.live = True
+    stats = dict(driver.stats, steps = steps, seconds = time.perf_counter() - start)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run the config.yml segments against the world simulator")
+    parser.add_argument("--config", default = "config.yml")
+    parser.add_argument("--db", default = "data.db")
+    parser.add_argument("--steps", type = int, default = 100000)
+    args = parser.parse_args()
+    with open(args.config, "r", encoding = "utf-8") as target:
+        config_dict = yaml.safe_load(target)
+    conn = sqlite3.connect(args.db)
+    (world, model) = (fit_world_model(conn), fit_combat_model(conn))
+    conn.close()
+    stats = run_schedule(config_dict, world, model, max_steps = args.steps, seed = 0)
+    print(", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}" for (key, value) in stats.items()))